@@ -0,0 +1,153 @@
+"""
+Archivio dei file esportati in static/exports.
+
+Ogni esportazione dell'ordine materiale veniva scritta con un nome a timestamp e
+mai cancellata. L'archivio:
+  - nomina i file con l'hash di (tipo, filtri, formato): la stessa richiesta entro
+    EXPORT_DEDUP_WINDOW secondi riusa il file già generato invece di rifarlo;
+  - elimina i file più vecchi di EXPORT_STORE_MAX_AGE e, se la cartella supera
+    EXPORT_STORE_MAX_MB, i meno recenti fino a rientrare nel limite;
+  - esegue la pulizia dopo ogni scrittura e periodicamente in un thread in background.
+"""
+import glob
+import os
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Optional
+
+from cache import make_key
+
+EXPORT_STORE_DIR = os.getenv("EXPORT_STORE_DIR", "static/exports")
+EXPORT_STORE_MAX_MB = float(os.getenv("EXPORT_STORE_MAX_MB", "500"))
+EXPORT_STORE_MAX_AGE = float(os.getenv("EXPORT_STORE_MAX_AGE", str(24 * 3600)))
+EXPORT_DEDUP_WINDOW = float(os.getenv("EXPORT_DEDUP_WINDOW", "300"))
+EXPORT_SWEEP_INTERVAL = float(os.getenv("EXPORT_SWEEP_INTERVAL", "600"))
+
+
+class ExportArtifactStore:
+    def __init__(self, directory: str = EXPORT_STORE_DIR, max_bytes: float = EXPORT_STORE_MAX_MB * 1024 * 1024,
+                 max_age: float = EXPORT_STORE_MAX_AGE, dedup_window: float = EXPORT_DEDUP_WINDOW,
+                 prefixes: tuple = ("ordini_materiale_",)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.dedup_window = dedup_window
+        # Solo i file con questi prefissi sono gestiti (e quindi cancellabili) dall'archivio
+        self.prefixes = prefixes
+        self._lock = threading.Lock()
+        self._sweeper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def path_for(self, prefix: str, filters: Dict[str, Any], export_format: str) -> str:
+        key = make_key(prefix, filters, export_format)[:20]
+        return os.path.join(self.directory, f"{prefix}{key}.{export_format}")
+
+    def lookup(self, path: str) -> Optional[str]:
+        """Percorso del file se è stato generato entro la finestra di deduplica."""
+        try:
+            if time.time() - os.path.getmtime(path) <= self.dedup_window:
+                return path
+        except OSError:
+            pass
+        return None
+
+    def get_or_create(self, prefix: str, filters: Dict[str, Any], export_format: str,
+                      writer: Callable[[str], Any]) -> Optional[str]:
+        """
+        Restituisce il file per questi filtri, generandolo con `writer(path)` se manca o è scaduto.
+        La scrittura avviene su un file temporaneo rinominato a fine lavoro, così chi legge
+        non vede mai un file a metà. None se `writer` non ha prodotto alcun file.
+        """
+        path = self.path_for(prefix, filters, export_format)
+        cached = self.lookup(path)
+        if cached:
+            return cached
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            writer(tmp_path)
+            if not os.path.exists(tmp_path):
+                return None
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                # Su Windows il file esistente non si può sostituire mentre è in download
+                if self.lookup(path):
+                    return path # Generato nel frattempo da una richiesta con gli stessi filtri
+                base, ext = os.path.splitext(path)
+                path = f"{base}.{threading.get_ident()}{ext}" # Nome proprio, eliminato dalla pulizia
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.sweep()
+        return path
+
+    def _managed_files(self) -> List[str]:
+        files = []
+        for prefix in self.prefixes:
+            files.extend(glob.glob(os.path.join(self.directory, f"{prefix}*")))
+        return [f for f in files if not f.endswith(".tmp") and os.path.isfile(f)]
+
+    def sweep(self) -> int:
+        """Applica i limiti di età e dimensione; restituisce il numero di file eliminati."""
+        removed = 0
+        now = time.time()
+        with self._lock:
+            entries = []
+            for path in self._managed_files():
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort() # dal più vecchio
+
+            kept = []
+            for mtime, size, path in entries:
+                if now - mtime > self.max_age:
+                    removed += self._remove(path)
+                else:
+                    kept.append((mtime, size, path))
+
+            total = sum(size for _, size, _ in kept)
+            for mtime, size, path in kept:
+                # I file appena generati (ancora riusabili o in download) non vengono toccati
+                if total <= self.max_bytes or now - mtime <= self.dedup_window:
+                    break
+                removed += self._remove(path)
+                total -= size
+        return removed
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
+
+    def start_sweeper(self, interval: float = EXPORT_SWEEP_INTERVAL) -> None:
+        if self._sweeper and self._sweeper.is_alive():
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.sweep()
+                except Exception:
+                    traceback.print_exc()
+
+        self._sweeper = threading.Thread(target=loop, name="export-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self) -> None:
+        self._stop.set()
+
+
+export_store = ExportArtifactStore()
+
+
+__all__ = ['ExportArtifactStore', 'export_store']
@@ -15,7 +15,7 @@ async def login_page(request: Request):
     return templates.TemplateResponse("login.html", {"request": request, "error": None})
 
 @router.post("/login")
-async def login(
+def login(
     request: Request,
     response: Response,
     username: str = Form(...),
@@ -0,0 +1,96 @@
+"""
+Benchmark: throughput di richieste concorrenti con query lente, prima e dopo il pool di thread DB.
+
+  - "prima": route `async def` che chiama direttamente la Session (blocca l'event loop,
+    le richieste vengono servite una alla volta);
+  - "dopo": la stessa query in una route `def` e in una route `async` con run_db(),
+    eseguite nel pool di thread limitato (DB_THREADPOOL_SIZE).
+
+La query lenta è simulata su SQLite con una funzione che dorme QUERY_MS millisecondi.
+Uso: python benchmark_db_threadpool.py [richieste] [query_ms]
+"""
+import asyncio
+import sys
+import time
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from database_config import DB_THREADPOOL_SIZE, configure_db_threadpool, run_db
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+QUERY_MS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+engine = create_engine(
+    "sqlite://", poolclass=QueuePool, pool_size=DB_THREADPOOL_SIZE, max_overflow=0,
+    connect_args={"check_same_thread": False},
+)
+
+
+@event.listens_for(engine, "connect")
+def _register_sleep(dbapi_connection, connection_record):
+    dbapi_connection.create_function("sleep_ms", 1, lambda ms: time.sleep(ms / 1000) or ms)
+
+
+SessionBench = sessionmaker(bind=engine)
+
+
+def get_bench_db():
+    db = SessionBench()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def slow_query(db: Session):
+    return db.execute(text("SELECT sleep_ms(:ms)"), {"ms": QUERY_MS}).scalar()
+
+
+app = FastAPI()
+
+
+@app.on_event("startup")
+async def startup():
+    configure_db_threadpool()
+
+
+@app.get("/bloccante")
+async def bloccante(db: Session = Depends(get_bench_db)):
+    return {"ms": slow_query(db)}
+
+
+@app.get("/pool")
+def pool(db: Session = Depends(get_bench_db)):
+    return {"ms": slow_query(db)}
+
+
+@app.get("/run_db")
+async def with_run_db(db: Session = Depends(get_bench_db)):
+    return {"ms": await run_db(slow_query, db)}
+
+
+async def measure(client: httpx.AsyncClient, path: str) -> float:
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(client.get(path) for _ in range(REQUESTS)))
+    elapsed = time.perf_counter() - start
+    assert all(r.status_code == 200 for r in responses)
+    return elapsed
+
+
+async def main():
+    await app.router.startup()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        print(f"{REQUESTS} richieste concorrenti, query da {QUERY_MS} ms, pool di {DB_THREADPOOL_SIZE} thread")
+        for label, path in (("prima (async bloccante)", "/bloccante"), ("dopo (route def)", "/pool"),
+                            ("dopo (async + run_db)", "/run_db")):
+            elapsed = await measure(client, path)
+            print(f"  {label:<25} {elapsed:6.2f} s  {REQUESTS / elapsed:7.1f} req/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
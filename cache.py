@@ -0,0 +1,264 @@
+"""
+Cache condivise a livello di processo (thread-safe) usate dalle route GE.
+
+Le istanze di FilterManager/DataManager vengono create ad ogni richiesta, quindi
+tutto ciò che deve sopravvivere tra una richiesta e l'altra vive qui.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from sqlalchemy import inspect
+
+# TTL di default (secondi) per i metadati delle tabelle, configurabile da .env
+TABLE_METADATA_TTL = float(os.getenv("TABLE_METADATA_TTL", "300"))
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Dizionario thread-safe con scadenza (TTL) e dimensione massima opzionale (LRU)."""
+
+    def __init__(self, ttl: Optional[float] = None, maxsize: Optional[int] = None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and (time.monotonic() - stored_at) > self.ttl
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or self._expired(entry[0]):
+                if entry is not _MISSING:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Restituisce il valore in cache o lo calcola con `loader` (fuori dal lock)."""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def invalidate(self, key: Hashable = _MISSING) -> None:
+        """Rimuove una chiave, o svuota l'intera cache se chiamato senza argomenti."""
+        with self._lock:
+            if key is _MISSING:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> None:
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+class TaggedCache:
+    """
+    Cache LRU con TTL e budget in byte; ogni voce ha dei tag (es. righe e colonne da cui dipende)
+    per invalidare esattamente le voci toccate da una modifica.
+    """
+
+    def __init__(self, ttl: Optional[float] = None, max_bytes: int = 64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[Hashable, Tuple[float, Any, int, frozenset]]" = OrderedDict()
+        self._by_tag: Dict[Hashable, set] = {}
+        self._lock = threading.RLock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _drop(self, key: Hashable) -> None:
+        _, _, size, tags = self._data.pop(key)
+        self.bytes -= size
+        for tag in tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (self.ttl is not None and time.monotonic() - entry[0] > self.ttl):
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[Hashable] = (), size: int = 0) -> None:
+        """Memorizza `value` con la sua dimensione stimata; le voci più vecchie escono oltre max_bytes."""
+        if size > self.max_bytes:
+            return
+        tags = frozenset(tags)
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (time.monotonic(), value, size, tags)
+            self.bytes += size
+            for tag in tags:
+                self._by_tag.setdefault(tag, set()).add(key)
+            while self.bytes > self.max_bytes and self._data:
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def invalidate_tags(self, tags: Iterable[Hashable]) -> int:
+        """Rimuove tutte le voci che hanno almeno uno dei tag; restituisce quante."""
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys |= self._by_tag.get(tag, set())
+            for key in keys:
+                self._drop(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._by_tag.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._data), "bytes": self.bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+def make_key(*parts: Any) -> str:
+    """Forma canonica (hash) di parti eterogenee: dict ordinati per chiave, valori non JSON come stringa."""
+    canonical = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+@dataclass(frozen=True)
+class ColumnInfo:
+    name: str
+    type: Any
+    nullable: bool
+    primary_key: bool
+
+
+@dataclass(frozen=True)
+class TableMetadata:
+    table_name: str
+    columns: Tuple[ColumnInfo, ...]
+
+    @property
+    def column_names(self) -> List[str]:
+        return [col.name for col in self.columns]
+
+    @property
+    def primary_key(self) -> List[str]:
+        return [col.name for col in self.columns if col.primary_key]
+
+    def column(self, name: str) -> Optional[ColumnInfo]:
+        for col in self.columns:
+            if col.name == name:
+                return col
+        return None
+
+
+table_metadata_cache = TTLCache(ttl=TABLE_METADATA_TTL)
+
+
+def engine_key(bind) -> str:
+    """Chiave stabile per un Engine/Connection: l'URL senza password."""
+    engine = getattr(bind, "engine", bind)
+    url = getattr(engine, "url", None)
+    if url is None:
+        return repr(engine)
+    return url.render_as_string(hide_password=True)
+
+
+def _load_table_metadata(bind, table_name: str) -> TableMetadata:
+    inspector = inspect(bind)
+    pk_columns = set(inspector.get_pk_constraint(table_name).get("constrained_columns") or [])
+    columns = tuple(
+        ColumnInfo(
+            name=col["name"],
+            type=col["type"],
+            nullable=bool(col.get("nullable", True)),
+            primary_key=col["name"] in pk_columns,
+        )
+        for col in inspector.get_columns(table_name)
+    )
+    return TableMetadata(table_name=table_name, columns=columns)
+
+
+def get_table_metadata(bind, table_name: str) -> TableMetadata:
+    """Metadati della tabella dalla cache; interroga information_schema solo al primo accesso o dopo il TTL."""
+    key = (engine_key(bind), table_name)
+    metadata = table_metadata_cache.get(key)
+    if metadata is None:
+        metadata = _load_table_metadata(bind, table_name)
+        # Una tabella senza colonne (inesistente o non accessibile) non viene memorizzata
+        if metadata.columns:
+            table_metadata_cache.set(key, metadata)
+    return metadata
+
+
+def invalidate_table_metadata(bind=None, table_name: Optional[str] = None) -> None:
+    """Invalida i metadati in cache (es. dopo un ALTER TABLE). Senza argomenti svuota tutto."""
+    bind_key = engine_key(bind) if bind is not None else None
+    table_metadata_cache.invalidate_where(
+        lambda key: (bind_key is None or key[0] == bind_key)
+        and (table_name is None or key[1] == table_name)
+    )
+
+
+__all__ = [
+    'TTLCache',
+    'TaggedCache',
+    'engine_key',
+    'make_key',
+    'ColumnInfo',
+    'TableMetadata',
+    'table_metadata_cache',
+    'get_table_metadata',
+    'invalidate_table_metadata',
+]
@@ -0,0 +1,100 @@
+"""
+Chiave normalizzata e indicizzata del mese di presentazione della griglia GE.
+
+Il filtro per mese, il più usato, era `UPPER(TRIM(MesePresentazione)) = :mese`: una funzione sulla
+colonna, quindi una scansione dell'intera tabella. La colonna generata MesePresentazioneNum
+(1-12, NULL per valori che non sono un mese) è calcolata dal database a ogni INSERT/UPDATE e ha
+un indice (MesePresentazioneNum, ID): FilterManager filtra su `MesePresentazioneNum = :n`, una
+lettura di un intervallo dell'indice, e /api/servizi/ge/months elenca solo i mesi con dati
+leggendo lo stesso indice.
+
+La colonna è interna: non compare tra le colonne della griglia. Per crearla sulla tabella:
+    python chiave_mese.py
+Finché non esiste, il filtro resta quello testuale.
+"""
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from cache import TTLCache, engine_key, get_table_metadata, invalidate_table_metadata
+
+MONTH_COLUMN = "MesePresentazione"
+MONTH_KEY_COLUMN = "MesePresentazioneNum"
+MONTH_KEY_INDEX = "ix_mese_presentazione_num"
+MONTHS = ("GENNAIO", "FEBBRAIO", "MARZO", "APRILE", "MAGGIO", "GIUGNO",
+          "LUGLIO", "AGOSTO", "SETTEMBRE", "OTTOBRE", "NOVEMBRE", "DICEMBRE")
+
+# Mesi presenti in tabella: cambiano di rado, la lettura dell'indice non va ripetuta a ogni apertura della pagina
+_months_cache = TTLCache(ttl=300)
+
+
+def month_number(value: Optional[str]) -> Optional[int]:
+    """Numero (1-12) del mese con la stessa normalizzazione del filtro SQL; None se non è un mese."""
+    try:
+        return MONTHS.index((value or "").strip().upper()) + 1
+    except ValueError:
+        return None
+
+
+def month_key_expression(column: str = MONTH_COLUMN) -> str:
+    """Espressione della colonna generata: equivale a confrontare UPPER(TRIM(col)) con il nome del mese."""
+    cases = " ".join(f"WHEN '{name}' THEN {i}" for i, name in enumerate(MONTHS, start=1))
+    return f"CASE UPPER(TRIM(`{column}`)) {cases} END"
+
+
+def _bind(db):
+    return getattr(db, "bind", None) or getattr(db, "engine", None)
+
+
+def has_month_key(db, table_name: str) -> bool:
+    """True se la tabella ha la colonna generata (dai metadati in cache)."""
+    try:
+        return MONTH_KEY_COLUMN in get_table_metadata(_bind(db), table_name).column_names
+    except Exception:
+        return False
+
+
+def create_month_key(connection, table_name: str) -> bool:
+    """Aggiunge colonna generata e indice se mancano; False se erano già presenti."""
+    if has_month_key(connection, table_name):
+        return False
+    # MySQL la memorizza (STORED); SQLite può aggiungere con ALTER TABLE solo colonne VIRTUAL, comunque indicizzabili
+    storage = "STORED" if _bind(connection).dialect.name == "mysql" else "VIRTUAL"
+    connection.execute(text(
+        f"ALTER TABLE `{table_name}` ADD COLUMN `{MONTH_KEY_COLUMN}` TINYINT "
+        f"GENERATED ALWAYS AS ({month_key_expression()}) {storage}"
+    ))
+    connection.execute(text(f"CREATE INDEX `{MONTH_KEY_INDEX}` ON `{table_name}` (`{MONTH_KEY_COLUMN}`, `ID`)"))
+    invalidate_table_metadata(_bind(connection), table_name)
+    return True
+
+
+def available_months(db, table_name: str) -> List[str]:
+    """Mesi con almeno una riga, in ordine di calendario (vuoto senza colonna generata)."""
+    if not has_month_key(db, table_name):
+        return []
+
+    def load() -> List[str]:
+        numbers = db.execute(text(
+            f"SELECT DISTINCT `{MONTH_KEY_COLUMN}` FROM `{table_name}` "
+            f"WHERE `{MONTH_KEY_COLUMN}` IS NOT NULL ORDER BY `{MONTH_KEY_COLUMN}`"
+        )).scalars().all()
+        return [MONTHS[n - 1] for n in numbers if 1 <= n <= len(MONTHS)]
+    return _months_cache.get_or_load((engine_key(_bind(db)), table_name), load)
+
+
+def invalidate_available_months() -> None:
+    _months_cache.invalidate()
+
+
+__all__ = ['MONTHS', 'MONTH_COLUMN', 'MONTH_KEY_COLUMN', 'available_months', 'create_month_key', 'has_month_key',
+           'invalidate_available_months', 'month_key_expression', 'month_number']
+
+
+if __name__ == "__main__":
+    from database_config import engine
+    from ordini_servizi_ge import TABLE_NAME
+
+    with engine.begin() as conn:
+        created = create_month_key(conn, TABLE_NAME)
+    print(f"Colonna {MONTH_KEY_COLUMN} e indice {MONTH_KEY_INDEX} " + ("creati." if created else "già presenti."))
@@ -0,0 +1,282 @@
+"""
+Consigli sugli indici della griglia GE a partire dal traffico reale.
+
+FilterManager/DataManager registrano la "forma" di ogni query generata per /data e
+/unique_values (colonne filtrate per uguaglianza o intervallo, filtri non indicizzabili,
+ordinamento) con la latenza misurata. Le forme uguali vengono aggregate in memoria
+(GET /internal/metrics/query-shapes) e, se QUERY_SHAPES_LOG è impostato, accodate a un
+file JSONL così da sommare più processi e più giorni.
+
+Il report propone indici composti nell'ordine classico: colonne in uguaglianza (le più
+frequenti prima), poi una colonna di intervallo oppure le colonne di ordinamento.
+Il beneficio stimato è il tempo osservato delle query che potrebbero usare l'indice:
+è un limite superiore, da confrontare con la selettività delle colonne.
+
+Uso:
+    python consigli_indici.py [query_shapes.jsonl | dump.json] [numero_indici]
+"""
+import json
+import os
+import sys
+import threading
+from collections import Counter
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+QUERY_SHAPES_ENABLED = os.getenv("GE_QUERY_SHAPES", "1").strip().lower() not in ("0", "false", "no")
+QUERY_SHAPES_LOG = os.getenv("QUERY_SHAPES_LOG", "")
+# Oltre questo numero di forme distinte le nuove vengono solo contate (memoria limitata)
+QUERY_SHAPES_MAX = int(os.getenv("QUERY_SHAPES_MAX", "1000"))
+# MySQL/InnoDB: oltre qualche colonna un indice composto raramente ripaga la scrittura
+INDEX_MAX_COLUMNS = 4
+
+
+@dataclass(frozen=True)
+class QueryShape:
+    """Struttura di una query (senza valori): cosa serve per decidere un indice."""
+    table: str
+    kind: str # 'page', 'count', 'unique_values'
+    equality: Tuple[str, ...] = ()
+    ranges: Tuple[str, ...] = () # intervalli e LIKE 'prefisso%'
+    scans: Tuple[str, ...] = () # LIKE '%testo%', CAST, funzioni: non indicizzabili
+    order_by: Tuple[Tuple[str, str], ...] = ()
+    fulltext: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {key: list(value) if isinstance(value, tuple) else value for key, value in asdict(self).items()}
+        data['order_by'] = [list(item) for item in self.order_by]
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'QueryShape':
+        return cls(
+            table=data['table'], kind=data['kind'],
+            equality=tuple(data.get('equality', ())), ranges=tuple(data.get('ranges', ())),
+            scans=tuple(data.get('scans', ())),
+            order_by=tuple(tuple(item) for item in data.get('order_by', ())),
+            fulltext=bool(data.get('fulltext', False)),
+        )
+
+
+@dataclass
+class ShapeStats:
+    count: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+
+    def add(self, count: int, total_ms: float, max_ms: float) -> None:
+        self.count += count
+        self.total_ms += total_ms
+        self.max_ms = max(self.max_ms, max_ms)
+
+
+class QueryShapeRecorder:
+    """Aggregazione thread-safe delle forme di query con conteggio e latenza."""
+
+    def __init__(self, max_shapes: int = QUERY_SHAPES_MAX, log_path: str = QUERY_SHAPES_LOG,
+                 enabled: bool = QUERY_SHAPES_ENABLED):
+        self.max_shapes = max_shapes
+        self.log_path = log_path
+        self.enabled = enabled
+        self._stats: Dict[QueryShape, ShapeStats] = {}
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def record(self, shape: Optional[QueryShape], elapsed_ms: float) -> None:
+        if not self.enabled or shape is None:
+            return
+        with self._lock:
+            stats = self._stats.get(shape)
+            if stats is None:
+                if len(self._stats) >= self.max_shapes:
+                    self._dropped += 1
+                    return
+                stats = self._stats[shape] = ShapeStats()
+            stats.add(1, elapsed_ms, elapsed_ms)
+            if self.log_path:
+                self._append(shape, elapsed_ms)
+
+    def _append(self, shape: QueryShape, elapsed_ms: float) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({**shape.to_dict(), "ms": round(elapsed_ms, 3)}) + "\n")
+        except OSError:
+            pass # La strumentazione non deve mai far fallire una richiesta
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = [(shape, ShapeStats(s.count, s.total_ms, s.max_ms)) for shape, s in self._stats.items()]
+        return [
+            {**shape.to_dict(), "count": s.count, "total_ms": round(s.total_ms, 3), "max_ms": round(s.max_ms, 3)}
+            for shape, s in sorted(items, key=lambda item: -item[1].total_ms)
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"shapes": len(self._stats), "dropped": self._dropped,
+                    "queries": sum(s.count for s in self._stats.values())}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self._dropped = 0
+
+
+query_shapes = QueryShapeRecorder()
+
+
+def aggregate(records: Iterable[Dict[str, Any]]) -> Dict[QueryShape, ShapeStats]:
+    """Somma righe del log JSONL (campo `ms`) o di uno snapshot (`count`, `total_ms`, `max_ms`)."""
+    result: Dict[QueryShape, ShapeStats] = {}
+    for record in records:
+        shape = QueryShape.from_dict(record)
+        if 'ms' in record:
+            count, total_ms, max_ms = 1, float(record['ms']), float(record['ms'])
+        else:
+            count, total_ms = int(record.get('count', 1)), float(record.get('total_ms', 0))
+            max_ms = float(record.get('max_ms', total_ms))
+        result.setdefault(shape, ShapeStats()).add(count, total_ms, max_ms)
+    return result
+
+
+def candidate_columns(shape: QueryShape, frequency: Counter) -> Tuple[str, ...]:
+    """Colonne dell'indice ideale per una forma (tuple vuota se nessun predicato è indicizzabile)."""
+    columns = sorted(set(shape.equality), key=lambda col: (-frequency[col], col))
+    if shape.ranges:
+        # Dopo una colonna di intervallo le successive non restringono più la ricerca
+        columns.append(max(shape.ranges, key=lambda col: (frequency[col], col)))
+    elif shape.order_by and len({direction.lower() for _, direction in shape.order_by}) == 1:
+        # Ordinamento in una sola direzione: l'indice evita anche il filesort
+        columns += [col for col, _ in shape.order_by if col not in columns]
+    return tuple(columns[:INDEX_MAX_COLUMNS])
+
+
+def _usable_prefix(index: Tuple[str, ...], shape: QueryShape) -> int:
+    """Quante colonne iniziali dell'indice la query può usare."""
+    used = 0
+    for col in index:
+        if col in shape.equality:
+            used += 1
+            continue
+        if col in shape.ranges:
+            used += 1
+        break
+    if used == 0 and not shape.equality and not shape.ranges and shape.order_by:
+        # Solo ordinamento: l'indice serve se inizia con le colonne ordinate
+        order = [col for col, _ in shape.order_by]
+        if tuple(order[:len(index)]) == index[:len(order)]:
+            used = min(len(index), len(order))
+    return used
+
+
+def suggest_indexes(stats: Dict[QueryShape, ShapeStats],
+                    existing: Optional[Dict[str, List[Tuple[str, ...]]]] = None,
+                    top: int = 10) -> List[Dict[str, Any]]:
+    """
+    Indici composti proposti, dal beneficio stimato maggiore.
+    `existing` (tabella -> colonne degli indici presenti) marca le proposte già coperte.
+    """
+    existing = existing or {}
+    total_ms = sum(s.total_ms for s in stats.values()) or 1.0
+    frequency: Dict[str, Counter] = {}
+    for shape, s in stats.items():
+        counter = frequency.setdefault(shape.table, Counter())
+        for col in set(shape.equality) | set(shape.ranges):
+            counter[col] += s.count
+
+    candidates = {(shape.table, candidate_columns(shape, frequency[shape.table])) for shape in stats}
+    candidates = {(table, cols) for table, cols in candidates if cols}
+
+    proposals = []
+    for table, cols in candidates:
+        served = [(shape, s, _usable_prefix(cols, shape)) for shape, s in stats.items() if shape.table == table]
+        served = [(shape, s, used) for shape, s, used in served if used]
+        if not served:
+            continue
+        benefit = sum(s.total_ms for _, s, _ in served)
+        proposals.append({
+            "table": table,
+            "columns": list(cols),
+            "queries": sum(s.count for _, s, _ in served),
+            "shapes": len(served),
+            "benefit_ms": round(benefit, 3),
+            "share": round(benefit / total_ms, 4),
+            "existing": any(idx[:len(cols)] == cols for idx in existing.get(table, [])),
+        })
+
+    # Un indice che è prefisso di uno già proposto è superfluo
+    proposals.sort(key=lambda p: (-p["benefit_ms"], -len(p["columns"])))
+    chosen: List[Dict[str, Any]] = []
+    for proposal in proposals:
+        cols = tuple(proposal["columns"])
+        if any(tuple(c["columns"][:len(cols)]) == cols and c["table"] == proposal["table"] for c in chosen):
+            continue
+        chosen.append(proposal)
+    return chosen[:top]
+
+
+def create_index_sql(proposal: Dict[str, Any]) -> str:
+    name = "ix_" + "_".join(col.lower() for col in proposal["columns"])
+    columns = ", ".join(f"`{col}`" for col in proposal["columns"])
+    return f"CREATE INDEX `{name[:64]}` ON `{proposal['table']}` ({columns});"
+
+
+def load_records(path: str) -> List[Dict[str, Any]]:
+    """Log JSONL delle forme o dump JSON di /internal/metrics/query-shapes."""
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    try:
+        data = json.loads(content)
+        return data.get("shapes", []) if isinstance(data, dict) else data
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def existing_indexes(bind, tables: Iterable[str]) -> Dict[str, List[Tuple[str, ...]]]:
+    from sqlalchemy import inspect
+    inspector = inspect(bind)
+    result = {}
+    for table in tables:
+        indexes = [tuple(index["column_names"]) for index in inspector.get_indexes(table)]
+        pk = inspector.get_pk_constraint(table).get("constrained_columns") or []
+        result[table] = indexes + ([tuple(pk)] if pk else [])
+    return result
+
+
+def format_report(stats: Dict[QueryShape, ShapeStats], proposals: List[Dict[str, Any]]) -> str:
+    lines = [f"Query osservate: {sum(s.count for s in stats.values())} in {len(stats)} forme distinte", ""]
+    lines.append("Forme più costose:")
+    for shape, s in sorted(stats.items(), key=lambda item: -item[1].total_ms)[:10]:
+        parts = [f"= {','.join(shape.equality)}" if shape.equality else "",
+                 f"range {','.join(shape.ranges)}" if shape.ranges else "",
+                 f"scan {','.join(shape.scans)}" if shape.scans else "",
+                 "fulltext" if shape.fulltext else "",
+                 "order " + ",".join(f"{c} {d}" for c, d in shape.order_by) if shape.order_by else ""]
+        lines.append(f"  {shape.kind:<14} {s.count:>7}x  {s.total_ms:>10.1f} ms  max {s.max_ms:>8.1f} ms  "
+                     + "; ".join(p for p in parts if p))
+    lines += ["", "Indici proposti (beneficio = tempo delle query che potrebbero usarli):"]
+    if not proposals:
+        lines.append("  nessuno: le query osservate non hanno predicati indicizzabili")
+    for p in proposals:
+        note = "  [già presente]" if p["existing"] else ""
+        lines.append(f"  {p['share']:>6.1%}  {p['benefit_ms']:>10.1f} ms  {p['queries']:>7} query  "
+                     f"{create_index_sql(p)}{note}")
+    return "\n".join(lines)
+
+
+__all__ = ['QueryShape', 'QueryShapeRecorder', 'query_shapes', 'aggregate', 'suggest_indexes',
+           'create_index_sql', 'QUERY_SHAPES_ENABLED']
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else (QUERY_SHAPES_LOG or os.path.join("journal", "query_shapes.jsonl"))
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    stats = aggregate(load_records(path))
+    try:
+        from database_config import engine
+        existing = existing_indexes(engine, {shape.table for shape in stats})
+    except Exception as e:
+        print(f"Indici esistenti non letti ({type(e).__name__}): le proposte non sono confrontate con il database.")
+        existing = None
+    print(format_report(stats, suggest_indexes(stats, existing, top)))
@@ -30,12 +30,127 @@ if not SQLALCHEMY_DATABASE_URL:
 
 
 
+def _mode_env(name: str, default: str) -> str:
+    """Valore per la modalità attiva (es. DB_POOL_SIZE_REMOTO), altrimenti quello generico (DB_POOL_SIZE)."""
+    return os.getenv(f"{name}_{APP_MODE}", os.getenv(name, default))
+
+# Pool di connessioni, configurabile per modalità dal file .env
+DB_POOL_SIZE = int(_mode_env("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(_mode_env("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(_mode_env("DB_POOL_TIMEOUT", "30"))
+# Le connessioni vengono riciclate prima del wait_timeout di MySQL ("server has gone away")
+DB_POOL_RECYCLE = int(_mode_env("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = _mode_env("DB_POOL_PRE_PING", "1").strip().lower() in ("1", "true", "yes", "si")
+
+
 # Setup SQLAlchemy
-from sqlalchemy import create_engine
+import threading
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy import exc as sa_exc
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from statistiche_sql import instrument_engine
+
+
+class PoolMetrics:
+    """Contatori del pool di connessioni: checkout, attese, timeout e connessioni invalidate."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.invalidations = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_invalidation(self):
+        with self._lock:
+            self.invalidations += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "invalidations": self.invalidations,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class MonitoredQueuePool(QueuePool):
+    """QueuePool che misura il tempo per ottenere una connessione (attesa + eventuale connect/pre-ping)."""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except sa_exc.TimeoutError:
+            pool_metrics.record_timeout()
+            raise
+        pool_metrics.record_wait(time.perf_counter() - start)
+        return connection
+
+
+def pool_status(pool) -> dict:
+    """Stato istantaneo del pool (connessioni in uso, libere, overflow) più i contatori cumulativi."""
+    status = {"class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "max_overflow": DB_MAX_OVERFLOW,
+            "timeout": pool.timeout(),
+        })
+    status.update(pool_metrics.snapshot())
+    return status
+
+
+def build_engine(url: str):
+    if url.startswith("sqlite"):
+        # SQLite (test/sviluppo) usa il pool di default del dialetto
+        return create_engine(url)
+    return create_engine(
+        url,
+        poolclass=MonitoredQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+    )
+
+
+engine = build_engine(SQLALCHEMY_DATABASE_URL)
+# Conteggio e tempi delle query per richiesta, registro delle query lente (vedi statistiche_sql)
+instrument_engine(engine)
+
+
+@event.listens_for(engine, "invalidate")
+def _count_invalidation(dbapi_connection, connection_record, exception):
+    pool_metrics.record_invalidation()
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -51,7 +166,25 @@ def get_db():
     finally:
         db.close()
 
+# Tutto il lavoro SQLAlchemy (sincrono) gira fuori dall'event loop, in un unico pool
+# di thread limitato: le route che usano il DB sono `def` (FastAPI le esegue nel pool)
+# e le route `async` che devono leggere il body passano la parte DB a run_db().
+# La dimensione di default coincide con le connessioni disponibili nel pool SQLAlchemy
+# (pool_size + max_overflow), così i thread non restano in attesa di una connessione.
+DB_THREADPOOL_SIZE = int(_mode_env("DB_THREADPOOL_SIZE", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+
+def configure_db_threadpool(size: int = DB_THREADPOOL_SIZE):
+    """Imposta la dimensione del pool di thread (da chiamare nell'event loop, es. allo startup)."""
+    from anyio import to_thread
+    to_thread.current_default_thread_limiter().total_tokens = size
+
+async def run_db(func, *args, **kwargs):
+    """Esegue `func` (chiamate sincrone alla Session) nel pool di thread senza bloccare l'event loop."""
+    from starlette.concurrency import run_in_threadpool
+    return await run_in_threadpool(func, *args, **kwargs)
+
 # Debug
 print(f"Modalità attiva: {APP_MODE}")  # Opzionale, per debug
 
-__all__ = ['Base', 'engine', 'SessionLocal', 'init_db', 'get_db', 'APP_MODE']
+__all__ = ['Base', 'engine', 'SessionLocal', 'init_db', 'get_db', 'run_db', 'configure_db_threadpool',
+           'pool_metrics', 'pool_status', 'APP_MODE']
@@ -0,0 +1,302 @@
+"""
+Dizionari dei valori distinti per i menu dei filtri della griglia GE.
+
+Ogni tasto premuto nel filtro di una colonna chiamava /unique_values, cioè un
+SELECT DISTINCT UPPER(TRIM(CAST(col AS CHAR))) sull'intera tabella filtrata.
+Qui la tabella viene letta in un thread in background (all'avvio o alla prima richiesta, poi
+quando sono passati DISTINCT_INDEX_TTL secondi) e per ogni colonna con pochi valori distinti si tiene:
+  - il dizionario valore normalizzato -> bitmap delle righe (un int Python, un bit per riga);
+  - per le colonne numeriche/date un valore originale per chiave, su cui valutare i filtri.
+
+I valori distinti di una colonna sotto gli altri filtri attivi si ottengono facendo l'OR
+delle bitmap dei valori che soddisfano ciascun filtro, l'AND tra i filtri e tenendo le chiavi
+della colonna richiesta con almeno un bit in comune. Le modifiche fatte da questo processo
+aggiornano le bitmap in modo incrementale (anche durante una costruzione, riapplicate al
+nuovo indice); quelle di altri processi arrivano col TTL.
+
+Finché il primo indice non è pronto, per le colonne con troppi valori distinti (o oltre il budget
+di memoria, che comprende le liste di posizioni usate durante la costruzione) e quando un
+filtro le riguarda, il chiamante torna alla query SQL.
+"""
+import os
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+DISTINCT_INDEX_ENABLED = os.getenv("GE_DISTINCT_INDEX", "1").strip().lower() not in ("0", "false", "no")
+DISTINCT_INDEX_TTL = float(os.getenv("GE_DISTINCT_INDEX_TTL", "600"))
+# Oltre questo numero di valori distinti una colonna non è adatta a un menu a tendina
+DISTINCT_MAX_VALUES = int(os.getenv("GE_DISTINCT_MAX_VALUES", "1000"))
+DISTINCT_MAX_MB = float(os.getenv("GE_DISTINCT_MAX_MB", "128"))
+# Come il LIMIT della query SQL equivalente
+UNIQUE_VALUES_LIMIT = 200
+# Costo di una posizione nelle liste temporanee della costruzione (un riferimento, l'int è condiviso)
+POSITION_BYTES = 8
+
+
+def normalize_value(value: Any) -> Optional[str]:
+    """Stessa normalizzazione della query SQL: UPPER(TRIM(CAST(col AS CHAR))), vuoti esclusi."""
+    if value is None:
+        return None
+    normalized = str(value).strip().upper()
+    return normalized or None
+
+
+def _same_sample(sample: Any, value: Any) -> bool:
+    try:
+        return bool(sample == value)
+    except TypeError:
+        return False
+
+
+def _bitmap(positions: List[int], size: int) -> int:
+    bits = bytearray((size + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, "little")
+
+
+class ColumnDictionary:
+    __slots__ = ("bitmaps", "samples")
+
+    def __init__(self):
+        self.bitmaps: Dict[str, int] = {}
+        # Valore su cui valutare i filtri: la chiave stessa per il testo, l'originale per numeri e date
+        self.samples: Dict[str, Any] = {}
+
+
+class DistinctValueIndex:
+    """Dizionari di una tabella; `positions` associa la PK alla posizione del bit."""
+
+    def __init__(self, table_name: str, pk_column: str, columns: Dict[str, ColumnDictionary],
+                 positions: Dict[Any, int], size: int, nbytes: int):
+        self.table_name = table_name
+        self.pk_column = pk_column
+        self.columns = columns
+        self.positions = positions
+        self.size = size
+        self.nbytes = nbytes
+        self.built_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def build(cls, db, table_name: str, pk_column: str = "ID", max_values: int = DISTINCT_MAX_VALUES,
+              max_bytes: float = DISTINCT_MAX_MB * 1024 * 1024) -> "DistinctValueIndex":
+        result = db.execute(text(f"SELECT * FROM `{table_name}` ORDER BY `{pk_column}`"))
+        column_names = list(result.keys())
+        groups: Dict[str, Optional[Dict[str, List[int]]]] = {name: {} for name in column_names}
+        samples: Dict[str, Dict[str, Any]] = {name: {} for name in column_names}
+        # Posizioni accumulate per colonna: le liste temporanee contano nel budget di memoria
+        pending = {name: 0 for name in column_names}
+        pending_bytes = 0
+        positions: Dict[Any, int] = {}
+        pk_index = column_names.index(pk_column)
+
+        def drop(name: str) -> None:
+            nonlocal pending_bytes
+            groups[name] = None
+            samples.pop(name, None)
+            pending_bytes -= pending.pop(name) * POSITION_BYTES
+
+        for position, row in enumerate(result):
+            positions[row[pk_index]] = position
+            for name, value in zip(column_names, row):
+                column_groups = groups[name]
+                if column_groups is None:
+                    continue
+                key = normalize_value(value)
+                if key is None:
+                    continue
+                rows = column_groups.get(key)
+                if rows is None:
+                    if len(column_groups) >= max_values:
+                        drop(name) # Troppi valori distinti: niente dizionario
+                        continue
+                    rows = column_groups[key] = []
+                    samples[name][key] = key if isinstance(value, str) else value
+                rows.append(position)
+                pending[name] += 1
+                pending_bytes += POSITION_BYTES
+                if pending_bytes > max_bytes:
+                    # Budget superato già dalle liste temporanee: si rinuncia alla colonna con più valori
+                    drop(max(pending, key=lambda n: len(groups[n])))
+
+        size = len(positions)
+        row_bytes = (size + 7) // 8 or 1
+        columns, nbytes = {}, 0
+        # Prima le colonne con meno valori: più utili nei menu e più economiche
+        for name in sorted((n for n in column_names if groups[n] is not None), key=lambda n: len(groups[n])):
+            cost = len(groups[name]) * row_bytes
+            if nbytes + cost > max_bytes:
+                continue
+            dictionary = ColumnDictionary()
+            dictionary.bitmaps = {key: _bitmap(rows, size) for key, rows in groups[name].items()}
+            dictionary.samples = samples[name]
+            columns[name] = dictionary
+            nbytes += cost
+            groups[name] = None # Le liste della colonna non servono più
+        return cls(table_name, pk_column, columns, positions, size, nbytes)
+
+    def covers(self, columns) -> bool:
+        return all(column in self.columns for column in columns)
+
+    def unique_values(self, column: str, predicates: Dict[str, Callable[[Any], bool]],
+                      limit: int = UNIQUE_VALUES_LIMIT) -> Optional[List[str]]:
+        """
+        Valori distinti (normalizzati, ordinati) di `column` sulle righe che soddisfano tutti i
+        predicati, valutati una volta per chiave. None se una colonna manca.
+        """
+        if not self.covers([column, *predicates]):
+            return None
+        with self.lock:
+            rows = (1 << self.size) - 1
+            for name, predicate in predicates.items():
+                dictionary = self.columns[name]
+                matching = 0
+                for key, bitmap in dictionary.bitmaps.items():
+                    if predicate(dictionary.samples[key]):
+                        matching |= bitmap
+                rows &= matching
+                if not rows:
+                    return []
+            values = [key for key, bitmap in self.columns[column].bitmaps.items() if bitmap & rows]
+        return sorted(values)[:limit]
+
+    def apply_update(self, pk: Any, column: str, value: Any) -> bool:
+        """
+        Sposta la riga `pk` sulla chiave del nuovo valore; False solo per una riga sconosciuta.
+        Per le colonne numeriche/date `value` deve avere il tipo della colonna (vedi
+        ordini_servizi_ge.apply_committed_cells, che rilegge le celle salvate).
+        """
+        dictionary = self.columns.get(column)
+        if dictionary is None:
+            return True
+        position = self.positions.get(pk)
+        if position is None and isinstance(pk, str) and pk.strip().lstrip('-').isdigit():
+            position = self.positions.get(int(pk)) # PK numerica arrivata come testo dal client
+        if position is None:
+            return False
+        bit = 1 << position
+        key = normalize_value(value)
+        with self.lock:
+            if key not in dictionary.bitmaps and value is not None and not isinstance(value, str):
+                # Stesso valore in un altro tipo (es. 250 e Decimal('250.00')): si riusa la chiave del DB
+                key = next((k for k, sample in dictionary.samples.items()
+                            if not isinstance(sample, str) and _same_sample(sample, value)), key)
+            for old_key, bitmap in list(dictionary.bitmaps.items()):
+                if bitmap & bit and old_key != key:
+                    bitmap &= ~bit
+                    if bitmap:
+                        dictionary.bitmaps[old_key] = bitmap
+                    else:
+                        del dictionary.bitmaps[old_key]
+                        del dictionary.samples[old_key]
+            if key is not None:
+                dictionary.bitmaps[key] = dictionary.bitmaps.get(key, 0) | bit
+                dictionary.samples.setdefault(key, key if isinstance(value, str) else value)
+        return True
+
+
+class DistinctValueStore:
+    """
+    Indici per (engine, tabella), costruiti in background e ricostruiti dopo il TTL.
+    Le richieste non attendono mai una costruzione: senza indice il chiamante usa la query SQL,
+    con un indice scaduto lo si usa finché il nuovo non è pronto.
+    """
+
+    def __init__(self, ttl: float = DISTINCT_INDEX_TTL, enabled: bool = DISTINCT_INDEX_ENABLED):
+        self.ttl = ttl
+        self.enabled = enabled
+        self._indexes: Dict[Hashable, DistinctValueIndex] = {}
+        self._lock = threading.Lock()
+        self._builders: Dict[Hashable, threading.Thread] = {}
+        # Modifiche arrivate durante una costruzione, riapplicate al nuovo indice
+        self._updates_during_build: Dict[Hashable, List[Tuple[Any, str, Any]]] = {}
+        self.hits = 0
+        self.builds = 0
+
+    def get(self, db, key: Hashable, table_name: str, pk_column: str = "ID") -> Optional[DistinctValueIndex]:
+        if not self.enabled:
+            return None
+        index = self._indexes.get(key)
+        if index is None or time.monotonic() - index.built_at > self.ttl:
+            self.schedule_build(db.get_bind(), key, table_name, pk_column)
+        if index is not None:
+            self.hits += 1
+        return index
+
+    def schedule_build(self, bind, key: Hashable, table_name: str, pk_column: str = "ID") -> bool:
+        """Avvia la costruzione in un thread con una sessione propria; False se già in corso o disabilitato."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            if key in self._builders:
+                return False
+            self._updates_during_build[key] = []
+            thread = self._builders[key] = threading.Thread(
+                target=self._build, args=(bind, key, table_name, pk_column), name="distinct-values", daemon=True)
+        thread.start()
+        return True
+
+    def _build(self, bind, key: Hashable, table_name: str, pk_column: str) -> None:
+        try:
+            with Session(bind=bind) as db:
+                index = DistinctValueIndex.build(db, table_name, pk_column)
+        except Exception:
+            traceback.print_exc() # Si riprova alla prossima richiesta, intanto si usa SQL
+            index = None
+        with self._lock:
+            updates = self._updates_during_build.pop(key, [])
+            if index is not None:
+                # La lettura può non comprendere le modifiche fatte nel frattempo
+                replayed = [index.apply_update(pk, column, value) for pk, column, value in updates]
+                if not all(replayed):
+                    # Riga inserita dopo la lettura: l'indice si usa già, scaduto, e si ricostruisce
+                    index.built_at = float("-inf")
+                self._indexes[key] = index
+                self.builds += 1
+            del self._builders[key]
+
+    def wait(self, key: Hashable, timeout: Optional[float] = None) -> None:
+        """Attende la costruzione in corso per `key` (script e test)."""
+        thread = self._builders.get(key)
+        if thread is not None:
+            thread.join(timeout)
+
+    def apply_update(self, key: Hashable, pk: Any, column: str, value: Any) -> None:
+        with self._lock:
+            if key in self._updates_during_build:
+                self._updates_during_build[key].append((pk, column, value))
+        index = self._indexes.get(key)
+        if index is not None and not index.apply_update(pk, column, value):
+            self.invalidate(key) # Riga sconosciuta: l'indice verrà ricostruito
+
+    def invalidate(self, key: Hashable = None) -> None:
+        with self._lock:
+            if key is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        indexes = list(self._indexes.values())
+        return {
+            "size": len(indexes),
+            "rows": sum(index.size for index in indexes),
+            "columns": sum(len(index.columns) for index in indexes),
+            "bytes": sum(index.nbytes for index in indexes),
+            "hits": self.hits,
+            "builds": self.builds,
+            "building": len(self._builders),
+        }
+
+
+distinct_values = DistinctValueStore()
+
+
+__all__ = ['DistinctValueIndex', 'DistinctValueStore', 'distinct_values', 'normalize_value',
+           'DISTINCT_INDEX_ENABLED']
@@ -0,0 +1,338 @@
+"""
+Pipeline di esportazione a memoria limitata, condivisa da GE e ordini materiale.
+
+Le righe vengono lette dal database a blocchi (cursore lato server) e scritte
+una alla volta nel formato richiesto:
+  - xlsx: xlsxwriter in modalità constant_memory
+  - csv: generato riga per riga direttamente durante la risposta
+  - parquet: un row group per blocco con pyarrow (dipendenza opzionale)
+I formati a file (xlsx, parquet) possono essere spediti solo a file chiuso,
+quindi vengono scritti su un file temporaneo inviato a pezzi e poi cancellato.
+"""
+import csv
+import io
+import os
+import tempfile
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import chain, islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import xlsxwriter
+from fastapi.responses import Response, StreamingResponse
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # pyarrow è opzionale: senza, il formato parquet non è disponibile
+    pa = None
+    pq = None
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+# Righe usate per stimare la larghezza delle colonne
+WIDTH_SAMPLE_ROWS = 500
+MAX_COLUMN_WIDTH = 100
+STREAM_CHUNK_SIZE = 64 * 1024
+# Precisione dei DECIMAL in parquet quando il tipo della colonna non è noto: il primo blocco non
+# dice quante cifre avranno i valori successivi
+PARQUET_DECIMAL_PRECISION = 38
+
+# Codici di tipo MySQL (pymysql.constants.FIELD_TYPE) nella description del cursore
+_MYSQL_DECIMAL_TYPES = (0, 246)
+_MYSQL_INTEGER_TYPES = (1, 2, 3, 8, 9, 13)
+_MYSQL_FLOAT_TYPES = (4, 5)
+_MYSQL_DATETIME_TYPES = (7, 12)
+_MYSQL_DATE_TYPES = (10,)
+_MYSQL_STRING_TYPES = (15, 245, 247, 248, 253, 254)
+
+XLSX_MEDIA_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+EXPORT_MEDIA_TYPES = {
+    'xlsx': XLSX_MEDIA_TYPE,
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+
+class ExportFormatError(ValueError):
+    """Formato di esportazione sconosciuto o non disponibile in questa installazione."""
+
+
+def check_export_format(export_format: str) -> str:
+    export_format = (export_format or 'xlsx').strip().lower()
+    if export_format not in EXPORT_MEDIA_TYPES:
+        raise ExportFormatError(f"Formato '{export_format}' non supportato. Formati ammessi: {sorted(EXPORT_MEDIA_TYPES)}")
+    if export_format == 'parquet' and pa is None:
+        raise ExportFormatError("Formato 'parquet' non disponibile: installare pyarrow.")
+    return export_format
+
+
+def batched(rows: Iterable[Sequence[Any]], batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[List[Sequence[Any]]]:
+    iterator = iter(rows)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class QueryRows:
+    """Risultato di una query letto a blocchi con cursore lato server."""
+
+    def __init__(self, db, query, params: Optional[Dict[str, Any]] = None, batch_size: int = EXPORT_BATCH_SIZE):
+        self.result = db.execute(query.execution_options(stream_results=True), params or {})
+        self.columns: List[str] = list(self.result.keys())
+        # Tipi delle colonne secondo il driver (per lo schema parquet); None se non disponibile
+        self.description = getattr(getattr(self.result, 'cursor', None), 'description', None)
+        self.batch_size = batch_size
+
+    def batches(self) -> Iterator[Sequence[Any]]:
+        try:
+            while True:
+                batch = self.result.fetchmany(self.batch_size)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            self.result.close()
+
+    def __iter__(self) -> Iterator[Sequence[Any]]:
+        for batch in self.batches():
+            yield from batch
+
+
+def write_xlsx(path: str, columns: Sequence[str], rows: Iterable[Sequence[Any]], sheet_name: str = "Dati",
+               header_format: Optional[Dict[str, Any]] = None,
+               column_formats: Optional[Dict[str, Dict[str, Any]]] = None) -> int:
+    """Scrive le righe in un XLSX in constant_memory e restituisce il numero di righe scritte."""
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    try:
+        worksheet = workbook.add_worksheet(sheet_name)
+        header_fmt = workbook.add_format(header_format) if header_format else None
+        datetime_fmt = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+        date_fmt = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+        col_formats = {
+            idx: workbook.add_format(column_formats[col])
+            for idx, col in enumerate(columns) if column_formats and col in column_formats
+        }
+
+        worksheet.write_row(0, 0, columns, header_fmt)
+        widths = [len(str(col)) for col in columns]
+
+        row_count = 0
+        for row_count, row in enumerate(rows, start=1):
+            for col_idx, value in enumerate(row):
+                if isinstance(value, datetime):
+                    worksheet.write_datetime(row_count, col_idx, value, datetime_fmt)
+                elif isinstance(value, date):
+                    worksheet.write_datetime(row_count, col_idx, value, date_fmt)
+                else:
+                    worksheet.write(row_count, col_idx, value, col_formats.get(col_idx))
+                if row_count <= WIDTH_SAMPLE_ROWS and value is not None:
+                    widths[col_idx] = max(widths[col_idx], len(str(value)))
+
+        # In constant_memory le colonne vengono scritte alla chiusura: si possono impostare ora
+        for col_idx, width in enumerate(widths):
+            worksheet.set_column(col_idx, col_idx, min(width + 2, MAX_COLUMN_WIDTH), col_formats.get(col_idx))
+        return row_count
+    finally:
+        workbook.close()
+
+
+def _arrow_type_from_description(column: Sequence[Any]):
+    """Tipo arrow di una colonna dalla description DB-API (MySQL); None se non determinabile."""
+    type_code = column[1] if len(column) > 1 else None
+    if type_code in _MYSQL_DECIMAL_TYPES:
+        # internal_size (lunghezza di visualizzazione) è almeno la precisione dichiarata
+        precision = min(max(int(column[3] or 0), PARQUET_DECIMAL_PRECISION), 76)
+        scale = int(column[5] or 0)
+        return pa.decimal128(precision, scale) if precision <= 38 else pa.decimal256(precision, scale)
+    if type_code in _MYSQL_INTEGER_TYPES:
+        return pa.int64()
+    if type_code in _MYSQL_FLOAT_TYPES:
+        return pa.float64()
+    if type_code in _MYSQL_DATETIME_TYPES:
+        return pa.timestamp('us')
+    if type_code in _MYSQL_DATE_TYPES:
+        return pa.date32()
+    if type_code in _MYSQL_STRING_TYPES:
+        return pa.string()
+    return None
+
+
+def _inferred_arrow_type(values: Sequence[Any]):
+    """Tipo dedotto dai valori del primo blocco, allargato dove i blocchi successivi potrebbero non starci."""
+    arrow_type = pa.array(values).type
+    if pa.types.is_null(arrow_type):
+        return pa.string() # Colonna tutta NULL nel primo blocco: testo (i valori successivi convertiti in str)
+    if pa.types.is_decimal(arrow_type):
+        return pa.decimal128(PARQUET_DECIMAL_PRECISION, max(arrow_type.scale, 0))
+    return arrow_type
+
+
+def _parquet_array(values: Sequence[Any], arrow_type):
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if pa.types.is_string(arrow_type):
+            return pa.array([None if value is None else str(value) for value in values], type=arrow_type)
+        if pa.types.is_decimal(arrow_type):
+            # Valori con più decimali della scala scelta: arrotondati alla scala della colonna
+            quantum = Decimal(1).scaleb(-arrow_type.scale)
+            return pa.array([None if value is None else Decimal(value).quantize(quantum) for value in values],
+                            type=arrow_type)
+        raise
+
+
+def write_parquet(path: str, columns: Sequence[str], batches: Iterable[Sequence[Sequence[Any]]],
+                  description: Optional[Sequence[Sequence[Any]]] = None) -> int:
+    """
+    Scrive un row group per blocco. Lo schema viene dai tipi del cursore (`description`) quando il
+    driver li fornisce, altrimenti dal primo blocco con i DECIMAL allargati. Senza righe viene
+    comunque scritto un file vuoto con lo schema.
+    """
+    if pa is None:
+        raise ExportFormatError("Formato 'parquet' non disponibile: installare pyarrow.")
+    known_types = [_arrow_type_from_description(column) for column in description] \
+        if description and len(description) == len(columns) else [None] * len(columns)
+    writer = None
+    schema = None
+    row_count = 0
+    try:
+        for batch in batches:
+            values = list(zip(*batch))
+            if schema is None:
+                schema = pa.schema([
+                    pa.field(name, known or _inferred_arrow_type(col))
+                    for name, known, col in zip(columns, known_types, values)
+                ])
+                writer = pq.ParquetWriter(path, schema)
+            arrays = [_parquet_array(col, field.type) for col, field in zip(values, schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            row_count += len(batch)
+        if writer is None:
+            schema = pa.schema([pa.field(name, known or pa.string()) for name, known in zip(columns, known_types)])
+            pq.write_table(schema.empty_table(), path)
+    finally:
+        if writer is not None:
+            writer.close()
+    return row_count
+
+
+def iter_csv(columns: Sequence[str], batches: Iterable[Sequence[Sequence[Any]]]) -> Iterator[bytes]:
+    """CSV generato blocco per blocco, senza materializzare il risultato."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def write_export_file(export_format: str, path: str, columns: Sequence[str],
+                      batches: Iterable[Sequence[Sequence[Any]]], sheet_name: str = "Dati",
+                      header_format: Optional[Dict[str, Any]] = None,
+                      column_formats: Optional[Dict[str, Dict[str, Any]]] = None,
+                      description: Optional[Sequence[Sequence[Any]]] = None) -> int:
+    """
+    Scrive l'esportazione su file nel formato indicato e restituisce il numero di righe.
+    `description` (QueryRows.description) serve solo allo schema parquet.
+    """
+    if export_format == 'xlsx':
+        return write_xlsx(path, columns, chain.from_iterable(batches), sheet_name=sheet_name,
+                          header_format=header_format, column_formats=column_formats)
+    if export_format == 'parquet':
+        return write_parquet(path, columns, batches, description=description)
+    if export_format == 'csv':
+        sizes = []
+        counted = (sizes.append(len(batch)) or batch for batch in batches)
+        with open(path, 'wb') as f:
+            for chunk in iter_csv(columns, counted):
+                f.write(chunk)
+        return sum(sizes)
+    raise ExportFormatError(f"Formato '{export_format}' non supportato.")
+
+
+def csv_streaming_response(columns: Sequence[str], batches: Iterable[Sequence[Sequence[Any]]],
+                           filename: str) -> Response:
+    """Risposta CSV in streaming diretto dal cursore (204 se non ci sono righe)."""
+    batches = iter(batches)
+    first = next(batches, None)
+    if not first:
+        return Response(status_code=204)
+    return StreamingResponse(
+        iter_csv(columns, chain([first], batches)),
+        media_type=EXPORT_MEDIA_TYPES['csv'],
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+
+def export_response(export_format: str, columns: Sequence[str], batches: Iterable[Sequence[Sequence[Any]]],
+                    filename_base: str, **file_options) -> Response:
+    """Risposta di esportazione nel formato richiesto; 204 se non ci sono righe."""
+    filename = f"{filename_base}.{export_format}"
+    if export_format == 'csv':
+        return csv_streaming_response(columns, batches, filename)
+
+    path = temporary_export_path(f'.{export_format}')
+    try:
+        row_count = write_export_file(export_format, path, columns, batches, **file_options)
+    except Exception:
+        os.remove(path)
+        raise
+    if not row_count:
+        os.remove(path)
+        return Response(status_code=204)
+    return file_streaming_response(path, filename, EXPORT_MEDIA_TYPES[export_format])
+
+
+def temporary_export_path(suffix: str) -> str:
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=suffix)
+    os.close(fd)
+    return path
+
+
+def iter_file_and_remove(path: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+def file_streaming_response(path: str, filename: str, media_type: str) -> StreamingResponse:
+    """Invia un file temporaneo a pezzi e lo cancella a fine trasferimento."""
+    return StreamingResponse(
+        iter_file_and_remove(path),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            "Content-Length": str(os.path.getsize(path)),
+        }
+    )
+
+
+__all__ = [
+    'QueryRows',
+    'ExportFormatError',
+    'check_export_format',
+    'batched',
+    'write_xlsx',
+    'write_parquet',
+    'iter_csv',
+    'write_export_file',
+    'csv_streaming_response',
+    'export_response',
+    'temporary_export_path',
+    'file_streaming_response',
+    'XLSX_MEDIA_TYPE',
+    'EXPORT_MEDIA_TYPES',
+]
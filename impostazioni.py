@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Request, Depends
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import RedirectResponse, JSONResponse
-from database_config import APP_MODE, get_db
+from database_config import APP_MODE, get_db, run_db
 from sqlalchemy.orm import Session
 from sqlalchemy import select
 
@@ -33,7 +33,7 @@ async def impostazioni(request: Request):
     return templates.TemplateResponse("impostazioni.html", {"request": request, "username": username, "app_mode": APP_MODE})
 
 @router.get("/impostazioni/api/tema")
-async def get_tema_utente(request: Request, db: Session = Depends(get_db)):
+def get_tema_utente(request: Request, db: Session = Depends(get_db)):
     session_cookie = request.cookies.get("session")
     import json
     if not session_cookie:
@@ -57,11 +57,15 @@ async def set_tema_utente(request: Request, db: Session = Depends(get_db)):
     tema = data.get("tema")
     if not tema:
         return JSONResponse({"ok": False})
-    row = db.query(UtenteUtentiPermessi).filter_by(utente_id=user_id).first()
-    if not row:
-        row = UtenteUtentiPermessi(utente_id=user_id, tema=tema)
-        db.add(row)
-    else:
-        row.tema = tema
-    db.commit()
+
+    def salva():
+        row = db.query(UtenteUtentiPermessi).filter_by(utente_id=user_id).first()
+        if not row:
+            row = UtenteUtentiPermessi(utente_id=user_id, tema=tema)
+            db.add(row)
+        else:
+            row.tema = tema
+        db.commit()
+
+    await run_db(salva)
     return JSONResponse({"ok": True})
@@ -0,0 +1,284 @@
+"""
+Esportazioni in background.
+
+Le esportazioni grandi non girano più dentro la richiesta HTTP: il client crea un
+job (POST sulle route di esportazione `.../export/jobs`), riceve un id, interroga
+`/api/exports/{id}` per l'avanzamento (righe scritte / totale stimato) e scarica
+il file con `/api/exports/{id}/download` quando il job è completato.
+
+I job girano in un pool di thread limitato, con una sessione DB propria, un
+limite di job attivi per utente e pulizia dei file scaduti (anche quelli lasciati in
+EXPORT_JOB_DIR da un'esecuzione precedente) solo nello sweeper, all'avvio e periodicamente:
+mai durante una richiesta, quando il file può essere ancora in download.
+Serve una sessione: ogni utente vede e scarica solo i propri job.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse
+
+from database_config import SessionLocal
+from esportazione import EXPORT_MEDIA_TYPES, write_export_file
+
+EXPORT_JOB_WORKERS = int(os.getenv("EXPORT_JOB_WORKERS", "2"))
+EXPORT_JOB_MAX_PER_USER = int(os.getenv("EXPORT_JOB_MAX_PER_USER", "2"))
+# Secondi dopo i quali un job terminato (e il suo file) viene eliminato
+EXPORT_JOB_TTL = float(os.getenv("EXPORT_JOB_TTL", "3600"))
+EXPORT_JOB_DIR = os.getenv("EXPORT_JOB_DIR", os.path.join(tempfile.gettempdir(), "bomweb_export_jobs"))
+EXPORT_JOB_SWEEP_INTERVAL = float(os.getenv("EXPORT_JOB_SWEEP_INTERVAL", "300"))
+
+router = APIRouter()
+
+
+@dataclass
+class ExportSource:
+    """Ciò che un job deve scrivere: colonne, blocchi di righe e totale stimato."""
+    columns: Sequence[str]
+    batches: Iterable[Sequence[Sequence[Any]]]
+    total_estimate: Optional[int] = None
+    file_options: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class ExportJob:
+    id: str
+    user: str
+    export_format: str
+    filename: str
+    status: str = "queued" # queued, running, done, error
+    rows_written: int = 0
+    total_estimate: Optional[int] = None
+    path: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ("queued", "running")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "format": self.export_format,
+            "filename": self.filename,
+            "rows_written": self.rows_written,
+            "total_estimate": self.total_estimate,
+            "error": self.error,
+            "download_url": f"/api/exports/{self.id}/download" if self.status == "done" else None,
+        }
+
+
+class ExportJobLimitError(Exception):
+    """L'utente ha già il numero massimo di esportazioni in corso."""
+
+
+class ExportJobManager:
+    def __init__(self, max_workers: int = EXPORT_JOB_WORKERS, max_per_user: int = EXPORT_JOB_MAX_PER_USER,
+                 ttl: float = EXPORT_JOB_TTL, directory: str = EXPORT_JOB_DIR,
+                 session_factory: Callable[[], Any] = SessionLocal):
+        self.max_per_user = max_per_user
+        self.ttl = ttl
+        self.directory = directory
+        self.session_factory = session_factory
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export-job")
+        self._jobs: Dict[str, ExportJob] = {}
+        self._lock = threading.Lock()
+        self._sweeper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def submit(self, user: str, export_format: str, filename_base: str,
+               prepare: Callable[[Any], ExportSource]) -> ExportJob:
+        """Accoda un job; `prepare(db)` viene eseguito nel worker con una sessione dedicata."""
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if job.user == user and job.active)
+            if active >= self.max_per_user:
+                raise ExportJobLimitError(
+                    f"Hai già {active} esportazioni in corso (massimo {self.max_per_user}).")
+            job = ExportJob(id=uuid.uuid4().hex, user=user, export_format=export_format,
+                            filename=f"{filename_base}.{export_format}")
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, prepare)
+        return job
+
+    def _run(self, job: ExportJob, prepare: Callable[[Any], ExportSource]) -> None:
+        job.status = "running"
+        db = self.session_factory()
+        try:
+            source = prepare(db)
+            job.total_estimate = source.total_estimate
+            os.makedirs(self.directory, exist_ok=True)
+            job.path = os.path.join(self.directory, f"{job.id}.{job.export_format}")
+
+            def counted(batches):
+                for batch in batches:
+                    yield batch
+                    job.rows_written += len(batch)
+
+            write_export_file(job.export_format, job.path, source.columns, counted(source.batches),
+                              **source.file_options)
+            if not os.path.exists(job.path):
+                raise RuntimeError("Il file dell'esportazione non è stato scritto.")
+            job.status = "done"
+        except Exception as e:
+            traceback.print_exc()
+            job.status = "error"
+            job.error = str(e)
+            self._remove_file(job)
+        finally:
+            job.finished_at = time.time()
+            db.close()
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        # Niente pulizia qui: un file scaduto può essere ancora in download (su Windows non si cancella)
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None and job.finished_at is not None and time.time() - job.finished_at > self.ttl:
+            return None # Scaduto: lo eliminerà lo sweeper
+        return job
+
+    def jobs_for(self, user: str) -> List[ExportJob]:
+        with self._lock:
+            return [job for job in self._jobs.values() if job.user == user]
+
+    def _remove_file(self, job: ExportJob) -> None:
+        try:
+            if job.path and os.path.exists(job.path):
+                os.remove(job.path)
+        except OSError:
+            traceback.print_exc() # File ancora aperto (es. download in corso su Windows): ritentato dallo sweeper
+
+    def cleanup(self) -> None:
+        """Elimina i job terminati da più di `ttl` secondi insieme ai loro file."""
+        now = time.time()
+        with self._lock:
+            expired = [job for job in self._jobs.values()
+                       if job.finished_at is not None and now - job.finished_at > self.ttl]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            self._remove_file(job)
+
+    def sweep(self) -> int:
+        """
+        Esegue cleanup() ed elimina da `directory` i file di nessun job noto più vecchi di `ttl`
+        (esecuzioni precedenti o altri processi); restituisce il numero di file orfani eliminati.
+        """
+        self.cleanup()
+        with self._lock:
+            known = {job.path for job in self._jobs.values() if job.path}
+        removed = 0
+        now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if path in known or not os.path.isfile(path) or now - os.path.getmtime(path) <= self.ttl:
+                    continue
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue
+        return removed
+
+    def start_sweeper(self, interval: float = EXPORT_JOB_SWEEP_INTERVAL) -> None:
+        if self._sweeper and self._sweeper.is_alive():
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.sweep()
+                except Exception:
+                    traceback.print_exc()
+
+        self._sweeper = threading.Thread(target=loop, name="export-job-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self) -> None:
+        self._stop.set()
+
+
+export_jobs = ExportJobManager()
+
+
+def session_user(request: Request) -> str:
+    """Utente della sessione (login dal cookie JSON), come usato per il log delle modifiche."""
+    session_cookie = request.cookies.get("session")
+    if not session_cookie:
+        return "UtenteNonIdentificato"
+    try:
+        return json.loads(session_cookie).get("login", "UtenteNonIdentificato")
+    except Exception:
+        return str(session_cookie)
+
+
+def session_login(request: Request) -> Optional[str]:
+    """Login dal cookie di sessione JSON, None se la sessione manca o non è valida."""
+    try:
+        login = json.loads(request.cookies.get("session", "")).get("login")
+    except Exception:
+        return None
+    return login if isinstance(login, str) and login else None
+
+
+def submit_export_job(request: Request, export_format: str, filename_base: str,
+                      prepare: Callable[[Any], ExportSource]) -> JSONResponse:
+    user = session_login(request)
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Utente non autenticato."})
+    try:
+        job = export_jobs.submit(user, export_format, filename_base, prepare)
+    except ExportJobLimitError as e:
+        return JSONResponse(status_code=429, content={"error": str(e)})
+    return JSONResponse(status_code=202, content=job.to_dict())
+
+
+def _job_for_request(job_id: str, request: Request) -> ExportJob:
+    user = session_login(request)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Utente non autenticato.")
+    job = export_jobs.get(job_id)
+    if job is None or job.user != user:
+        raise HTTPException(status_code=404, detail="Esportazione non trovata o scaduta.")
+    return job
+
+
+@router.get("/api/exports/{job_id}")
+async def get_export_job(job_id: str, request: Request):
+    return JSONResponse(_job_for_request(job_id, request).to_dict())
+
+
+@router.get("/api/exports/{job_id}/download")
+async def download_export_job(job_id: str, request: Request):
+    job = _job_for_request(job_id, request)
+    if job.status != "done" or not job.path or not os.path.exists(job.path):
+        raise HTTPException(status_code=409, detail=f"Esportazione non pronta (stato: {job.status}).")
+    return FileResponse(job.path, filename=job.filename, media_type=EXPORT_MEDIA_TYPES[job.export_format])
+
+
+__all__ = [
+    'router',
+    'ExportSource',
+    'ExportJob',
+    'ExportJobManager',
+    'ExportJobLimitError',
+    'export_jobs',
+    'session_user',
+    'session_login',
+    'submit_export_job',
+]
@@ -10,13 +10,20 @@ from sqlalchemy import text
 from datetime import datetime, timedelta, date
 import json
 
-from database_config import init_db, APP_MODE, get_db
+from database_config import init_db, APP_MODE, get_db, run_db, configure_db_threadpool, engine
+from statistiche_sql import SQLStatsMiddleware
 from ordini_materiale_articoli import router as materiali_router
 from impostazioni import router as impostazioni_router
 from ordini_servizi import router as servizi_router
 # Importa il nuovo router per ordini_servizi_ge
 from ordini_servizi_ge import router as servizi_ge_router
 from auth import router as auth_router
+from job_esportazione import router as export_jobs_router, export_jobs
+from archivio_esportazioni import export_store
+from metriche import router as metriche_router
+from registro_modifiche import audit_log
+from storico_modifiche import router as storico_router
+from ordini_servizi_ge import ge_replica, warm_distinct_values
 
 from protocolli import router as protocolli_router
 
@@ -30,11 +37,62 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Query, tempo sul database e query lente per ogni richiesta (vedi statistiche_sql)
+app.add_middleware(SQLStatsMiddleware)
+
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 init_db()
 
+@app.on_event("startup")
+async def configura_pool_db():
+    # Dimensione del pool di thread in cui gira tutto il lavoro sul database
+    configure_db_threadpool()
+
+@app.on_event("startup")
+async def avvia_pulizia_esportazioni():
+    # Pulizia periodica di static/exports (età e dimensione massima)
+    export_store.sweep()
+    export_store.start_sweeper()
+
+@app.on_event("shutdown")
+async def ferma_pulizia_esportazioni():
+    export_store.stop_sweeper()
+
+@app.on_event("startup")
+async def avvia_pulizia_job_esportazione():
+    # File dei job scaduti, compresi quelli lasciati in EXPORT_JOB_DIR da un'esecuzione precedente
+    export_jobs.sweep()
+    export_jobs.start_sweeper()
+
+@app.on_event("shutdown")
+async def ferma_pulizia_job_esportazione():
+    export_jobs.stop_sweeper()
+
+@app.on_event("startup")
+async def avvia_registro_modifiche():
+    # In modalità journal: riproduce il journal rimasto (I/O sul DB, fuori dall'event loop) e avvia il flush
+    await run_db(audit_log.start)
+
+@app.on_event("shutdown")
+async def ferma_registro_modifiche():
+    await run_db(audit_log.stop)
+
+@app.on_event("startup")
+async def avvia_dizionari_valori():
+    # Dizionari dei filtri a tendina costruiti in background: finché non sono pronti /unique_values usa SQL
+    warm_distinct_values(engine)
+
+@app.on_event("startup")
+async def avvia_replica_ge():
+    # Con GE_REPLICA=1: caricamento della replica in memoria e aggiornamento periodico in background
+    ge_replica.start()
+
+@app.on_event("shutdown")
+async def ferma_replica_ge():
+    ge_replica.stop()
+
 @app.middleware("http")
 async def aggiorna_accesso_middleware(request: Request, call_next):
     return await call_next(request)
@@ -46,9 +104,12 @@ app.include_router(servizi_router)
 # Includi il nuovo router nell'applicazione
 app.include_router(servizi_ge_router)
 app.include_router(protocolli_router)
+app.include_router(export_jobs_router)
+app.include_router(metriche_router)
+app.include_router(storico_router)
 
 @app.get("/")
-async def index(request: Request, db: Session = Depends(get_db)):
+def index(request: Request, db: Session = Depends(get_db)):
     session_cookie = request.cookies.get("session")
     username = None
     if session_cookie:
@@ -77,7 +138,7 @@ async def index(request: Request, db: Session = Depends(get_db)):
 
 
 @app.get("/chat/messages/public")
-async def get_messaggi_pubblici(db: Session = Depends(get_db)):
+def get_messaggi_pubblici(db: Session = Depends(get_db)):
     today = date.today().isoformat()
     query = text("""
         SELECT id, mittente, messaggio, data, 
@@ -109,18 +170,21 @@ async def invia_messaggio_pubblico(request: Request, db: Session = Depends(get_d
         user = request.cookies.get("session", "Anonimo")
         now = datetime.now()
 
-        db.execute(text("""
-            INSERT INTO utenti_chat (mittente, tipo, messaggio, data)
-            VALUES (:user, 'pubblico', :messaggio, :data)
-        """), {"user": user, "messaggio": messaggio, "data": now})
-        db.commit()
+        def salva():
+            db.execute(text("""
+                INSERT INTO utenti_chat (mittente, tipo, messaggio, data)
+                VALUES (:user, 'pubblico', :messaggio, :data)
+            """), {"user": user, "messaggio": messaggio, "data": now})
+            db.commit()
+
+        await run_db(salva)
 
         return JSONResponse({"status": "ok"})
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
 @app.delete("/chat/delete/{id}")
-async def delete_message(id: int, request: Request, db: Session = Depends(get_db)):
+def delete_message(id: int, request: Request, db: Session = Depends(get_db)):
     user = request.cookies.get("session", "")
     msg = db.execute(text("SELECT mittente FROM utenti_chat WHERE id = :id"), {"id": id}).fetchone()
     if msg and msg[0] == user:
@@ -130,7 +194,7 @@ async def delete_message(id: int, request: Request, db: Session = Depends(get_db
     return JSONResponse({"deleted": False}, status_code=403)
 
 @app.get("/api/utenti-online")
-async def utenti_online_api(db: Session = Depends(get_db)):
+def utenti_online_api(db: Session = Depends(get_db)):
     tre_minuti_fa = datetime.now() - timedelta(minutes=3)
     query = text("""
         SELECT login FROM utente_utenti 
@@ -142,7 +206,7 @@ async def utenti_online_api(db: Session = Depends(get_db)):
     return JSONResponse([u["login"] for u in utenti])
 
 @app.get("/ping")
-async def ping(request: Request, db: Session = Depends(get_db)):
+def ping(request: Request, db: Session = Depends(get_db)):
     username = request.cookies.get("session")
     if username:
         db.execute(
@@ -153,7 +217,7 @@ async def ping(request: Request, db: Session = Depends(get_db)):
     return JSONResponse({"status": "ok"})
 
 @app.get("/chat/messages/gruppo")
-async def chat_messaggi_gruppo(request: Request, db: Session = Depends(get_db)):
+def chat_messaggi_gruppo(request: Request, db: Session = Depends(get_db)):
     username = request.cookies.get("session")
     if not username:
         return JSONResponse([])
@@ -207,26 +271,29 @@ async def invia_messaggio_gruppo(request: Request, db: Session = Depends(get_db)
         data = await request.json()
         messaggio = data.get("message", "")
 
-        # Recupera il ruolo/gruppo corretto dell'utente
-        row = db.execute(text("SELECT ruolo_id FROM utente_utenti WHERE login = :login"), {"login": username}).fetchone()
-        if not row:
-            return JSONResponse({"error": "Ruolo non trovato"}, status_code=400)
-
-        gruppo = str(row[0])
-        now = datetime.now()
-
-        query = text("""
-            INSERT INTO utenti_chat (mittente, destinatario, gruppo, tipo, messaggio, data)
-            VALUES (:mittente, NULL, :gruppo, 'gruppo', :messaggio, :data)
-        """)
-        db.execute(query, {
-            "mittente": username,
-            "gruppo": gruppo,
-            "messaggio": messaggio,
-            "data": now
-        })
-        db.commit()
-        return JSONResponse({"status": "ok"})
+        def salva():
+            # Recupera il ruolo/gruppo corretto dell'utente
+            row = db.execute(text("SELECT ruolo_id FROM utente_utenti WHERE login = :login"), {"login": username}).fetchone()
+            if not row:
+                return JSONResponse({"error": "Ruolo non trovato"}, status_code=400)
+
+            gruppo = str(row[0])
+            now = datetime.now()
+
+            query = text("""
+                INSERT INTO utenti_chat (mittente, destinatario, gruppo, tipo, messaggio, data)
+                VALUES (:mittente, NULL, :gruppo, 'gruppo', :messaggio, :data)
+            """)
+            db.execute(query, {
+                "mittente": username,
+                "gruppo": gruppo,
+                "messaggio": messaggio,
+                "data": now
+            })
+            db.commit()
+            return JSONResponse({"status": "ok"})
+
+        return await run_db(salva)
 
     except Exception as e:
         print("[ERRORE chat/send/gruppo]", e)
@@ -234,7 +301,7 @@ async def invia_messaggio_gruppo(request: Request, db: Session = Depends(get_db)
 
 
 @app.get("/api/mio-id")
-async def get_mio_id(request: Request, db: Session = Depends(get_db)):
+def get_mio_id(request: Request, db: Session = Depends(get_db)):
     username = request.cookies.get("session")
     result = db.execute(text("SELECT id FROM utente_utenti WHERE login = :login"), {"login": username}).fetchone()
     if result:
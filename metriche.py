@@ -0,0 +1,81 @@
+"""
+Endpoint interni di monitoraggio (non esposti nello schema OpenAPI).
+
+Accessibili agli utenti con ruolo amministratore. Con INTERNAL_ALLOW_LOCALHOST=1 anche alle
+richieste da localhost senza sessione: da attivare solo se il server non è dietro un reverse proxy
+sulla stessa macchina, che farebbe arrivare da localhost ogni richiesta esterna.
+"""
+import json
+import os
+from typing import Any, Dict
+
+from anyio import to_thread
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+from cache import table_metadata_cache
+from consigli_indici import aggregate, query_shapes, suggest_indexes
+from database_config import APP_MODE, engine, pool_status
+from statistiche_sql import sql_stats
+
+router = APIRouter()
+
+# Cache di processo le cui statistiche (dimensione, hit/miss) compaiono in /internal/metrics/cache
+_caches: Dict[str, Any] = {"table_metadata": table_metadata_cache}
+
+
+def register_cache(name: str, cache: Any) -> None:
+    """Registra una cache con metodo stats() tra quelle monitorate."""
+    _caches[name] = cache
+
+# Ruoli amministratori (come per la chat di gruppo)
+ADMIN_ROLES = (1, 2)
+LOCAL_HOSTS = ("127.0.0.1", "::1", "localhost")
+INTERNAL_ALLOW_LOCALHOST = os.getenv("INTERNAL_ALLOW_LOCALHOST", "0").strip().lower() in ("1", "true", "yes")
+
+
+def require_internal_access(request: Request) -> None:
+    if INTERNAL_ALLOW_LOCALHOST and request.client and request.client.host in LOCAL_HOSTS:
+        return
+    try:
+        ruolo_id = json.loads(request.cookies.get("session", "")).get("ruolo_id")
+    except Exception:
+        ruolo_id = None
+    if ruolo_id not in ADMIN_ROLES:
+        raise HTTPException(status_code=403, detail="Accesso riservato.")
+
+
+@router.get("/internal/metrics/db", include_in_schema=False)
+async def db_pool_metrics(request: Request):
+    require_internal_access(request)
+    limiter = to_thread.current_default_thread_limiter()
+    return JSONResponse({
+        "app_mode": APP_MODE,
+        "pool": pool_status(engine.pool),
+        "threadpool": {"size": limiter.total_tokens, "busy": limiter.borrowed_tokens},
+    })
+
+
+@router.get("/internal/metrics/cache", include_in_schema=False)
+async def cache_metrics(request: Request):
+    require_internal_access(request)
+    return JSONResponse({name: cache.stats() for name, cache in sorted(_caches.items())})
+
+
+@router.get("/internal/metrics/query-shapes", include_in_schema=False)
+def query_shape_metrics(request: Request):
+    """Forme delle query GE osservate e indici proposti (il JSON è accettato da consigli_indici.py)."""
+    require_internal_access(request)
+    shapes = query_shapes.snapshot()
+    return JSONResponse({**query_shapes.stats(), "shapes": shapes,
+                         "suggestions": suggest_indexes(aggregate(shapes))})
+
+
+@router.get("/internal/metrics/sql", include_in_schema=False)
+async def sql_metrics(request: Request):
+    """Query, tempo sul database e righe per route; ultime query lente con il loro piano di esecuzione."""
+    require_internal_access(request)
+    return JSONResponse({**sql_stats.stats(), "routes": sql_stats.snapshot(), "slow": sql_stats.slow_queries()})
+
+
+__all__ = ['router', 'require_internal_access', 'register_cache']
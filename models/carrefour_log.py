@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Index
 from datetime import datetime
 from database_config import Base
 
@@ -12,3 +12,12 @@ class CarrefourLog(Base):
     data = Column(DateTime, default=datetime.utcnow)
     id_tabella = Column(Integer)
     colonna = Column(String(255))
+
+    # Indici per lo storico (/api/servizi/ge/history): ogni filtro è un prefisso seguito da (data, id),
+    # così filtro + ordinamento + paginazione a cursore sono una lettura dell'indice
+    __table_args__ = (
+        Index('ix_carrefour_log_record', 'id_tabella', 'data', 'id'),
+        Index('ix_carrefour_log_utente', 'utente', 'data', 'id'),
+        Index('ix_carrefour_log_colonna', 'colonna', 'data', 'id'),
+        Index('ix_carrefour_log_data', 'data', 'id'),
+    )
@@ -1,16 +1,34 @@
+import time
 import traceback
 from fastapi import APIRouter, Depends, Request, HTTPException, Query
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
-from sqlalchemy import text, inspect
-from database_config import get_db
+from sqlalchemy import bindparam, event, text
+from database_config import get_db, run_db
+from cache import TaggedCache, TTLCache, engine_key, get_table_metadata, make_key
+from ricerca_globale import GlobalSearchIndex, FULLTEXT_SEARCH_ENABLED
+from esportazione import QueryRows, ExportFormatError, check_export_format, export_response
+from job_esportazione import ExportSource, session_user, submit_export_job
+from metriche import register_cache, require_internal_access
+from registro_modifiche import audit_log
+from consigli_indici import QueryShape, query_shapes
+from dizionario_valori import distinct_values, normalize_value
+from risposta_compatta import columnar_response, wants_msgpack
+from replica_colonnare import ColumnarReplica
+from chiave_mese import (MONTH_COLUMN, MONTH_KEY_COLUMN, MONTHS, available_months, has_month_key,
+                         invalidate_available_months, month_number)
 from urllib.parse import unquote
-import pandas as pd
-import io
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from contextlib import contextmanager
+from dataclasses import dataclass
 from typing import Dict, List, Any, Optional
 import json
+import operator
+import os
+import re
 
 # Import per il logging
 from models.carrefour_log import CarrefourLog
@@ -19,16 +37,417 @@ from models.utente import UtenteRuoliPermessi, Utente
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 TABLE_NAME = "carrefour_contabilizzazione_originale" # Come da conferma, questa è la tabella di riferimento
+PK_COLUMN = "ID"
+
+# Cache dei COUNT(*): ordinare o paginare senza cambiare filtri non riconta la tabella
+COUNT_CACHE_TTL = float(os.getenv("GE_COUNT_CACHE_TTL", "60"))
+# 'exact' (default) o 'estimated': il totale non filtrato viene dalle statistiche della tabella
+COUNT_MODE = os.getenv("GE_COUNT_MODE", "exact").strip().lower()
+count_cache = TTLCache(ttl=COUNT_CACHE_TTL, maxsize=1024)
+
+def invalidate_counts(table_name: str) -> None:
+    """Invalida i conteggi in cache della tabella (chiamata dopo ogni modifica)."""
+    count_cache.invalidate_where(lambda key: key[1] == table_name)
+
+# Cache delle pagine della griglia: chiave = forma canonica di (filtri, parametri, ordinamento, pagina).
+# Ogni pagina è etichettata con gli ID delle righe che contiene e le colonne usate da filtri e
+# ordinamento: una modifica invalida solo le pagine che potrebbe aver cambiato.
+PAGE_CACHE_ENABLED = os.getenv("GE_PAGE_CACHE", "1").strip().lower() not in ("0", "false", "no")
+PAGE_CACHE_TTL = float(os.getenv("GE_PAGE_CACHE_TTL", "30"))
+PAGE_CACHE_MAX_MB = float(os.getenv("GE_PAGE_CACHE_MAX_MB", "64"))
+page_cache = TaggedCache(ttl=PAGE_CACHE_TTL, max_bytes=int(PAGE_CACHE_MAX_MB * 1024 * 1024))
+ALL_COLUMNS_TAG = '*' # pagine con ricerca globale: dipendono da tutte le colonne
+
+register_cache("ge_counts", count_cache)
+register_cache("ge_pages", page_cache)
+
+def invalidate_pages(table_name: str, pks: List[Any], fields: List[str]) -> int:
+    """Invalida le pagine che contengono le righe modificate o che filtrano/ordinano sui campi modificati."""
+    tags = [('pk', table_name, str(pk)) for pk in pks]
+    tags += [('col', table_name, field) for field in fields]
+    tags.append(('col', table_name, ALL_COLUMNS_TAG))
+    return page_cache.invalidate_tags(tags)
+
+# Dizionari dei valori distinti per /unique_values (vedi dizionario_valori)
+register_cache("ge_distinct_values", distinct_values)
+
+def warm_distinct_values(bind) -> bool:
+    """Avvia in background la costruzione dei dizionari della griglia (all'avvio dell'applicazione)."""
+    return distinct_values.schedule_build(bind, (engine_key(bind), TABLE_NAME), TABLE_NAME, PK_COLUMN)
+
+# Replica a colonne in memoria per /data (vedi replica_colonnare, attiva con GE_REPLICA=1)
+ge_replica = ColumnarReplica(TABLE_NAME, pk_column=PK_COLUMN)
+register_cache("ge_replica", ge_replica)
+
+def _stored_cells(db: Session, cells: List[tuple]) -> List[tuple]:
+    """
+    Le celle (pk, colonna, valore) con il valore riletto dal database: il client invia testo,
+    la tabella restituisce il tipo della colonna (es. Decimal('250.00') per '250').
+    """
+    fields = sorted({field for _, field, _ in cells})
+    query = text(
+        f"SELECT `{PK_COLUMN}`, {', '.join(f'`{f}`' for f in fields)} FROM `{TABLE_NAME}` WHERE `{PK_COLUMN}` IN :pks"
+    ).bindparams(bindparam("pks", expanding=True))
+    stored = {str(row[0]): dict(zip(fields, row[1:]))
+              for row in db.execute(query, {"pks": list({pk for pk, _, _ in cells})})}
+    return [(pk, field, stored[str(pk)][field] if str(pk) in stored else value) for pk, field, value in cells]
+
+def apply_committed_cells(db: Session, cells: List[tuple]) -> None:
+    """Riporta le celle salvate (pk, colonna, valore) nei dizionari dei valori distinti e nella replica."""
+    key = (engine_key(db.bind), TABLE_NAME)
+    try:
+        cells, typed = _stored_cells(db, cells), True
+    except Exception:
+        traceback.print_exc()
+        typed = False
+        distinct_values.invalidate(key) # Senza il tipo della colonna il dizionario si ricostruisce
+    for pk, field, value in cells:
+        if typed:
+            distinct_values.apply_update(key, pk, field, value)
+        if ge_replica.serves(db.bind):
+            ge_replica.apply_update(pk, field, value)
+        if field == MONTH_COLUMN:
+            invalidate_available_months() # Il mese modificato può comparire o sparire dal menu
+
+def dictionary_unique_values(db: Session, filter_manager: 'FilterManager', column: str, month_filter: Optional[str],
+                             search_value: Optional[str], column_searches: Dict[str, Any]) -> Optional[List[str]]:
+    """
+    Valori distinti di `column` sotto gli altri filtri, calcolati sulle bitmap in memoria.
+    None quando serve la query SQL: ricerca globale attiva, colonne senza dizionario o
+    dizionari non ancora costruiti.
+    """
+    if search_value or not distinct_values.enabled:
+        return None
+    predicates = {}
+    if month_filter and month_filter.strip().upper() != 'TUTTO':
+        month = month_filter.strip().upper()
+        predicates['MesePresentazione'] = lambda value: normalize_value(value) == month
+    for col_name, search_obj in column_searches.items():
+        val = search_obj.get('value') if isinstance(search_obj, dict) else search_obj
+        is_regex = search_obj.get('regex', False) if isinstance(search_obj, dict) else False
+        if val and col_name in filter_manager.column_names:
+            predicates[col_name] = filter_manager.column_matcher(col_name, str(val), is_regex)
+    try:
+        index = distinct_values.get(db, (engine_key(db.bind), filter_manager.table_name), filter_manager.table_name)
+    except Exception:
+        traceback.print_exc() # Dizionario non costruibile: si usa la query SQL
+        return None
+    return index.unique_values(column, predicates) if index is not None else None
+
+# Colonne con convalida a elenco → campo di carrefour_configurazione (chiavi in MAIUSCOLO)
+VALIDATION_MAP = {
+    'CATEGORIA_CLIENTE': 'competenza',
+    'TIPO_INTERVENTO': 'tipologia',
+    'CATEGORIA_INTERVENTO': 'categoria',
+    'TIPOLOGIA_OPEX': 'tipo',
+    'PRESENZA_GAS': 'CONFERMA',
+    'STATO_APPROVAZIONE': 'approvazionecarrefour',
+    'STATO_APPROVAZIONE_BACKOFFICE': 'stati',
+}
+CONFIG_TABLE = "carrefour_configurazione"
+# Gli elenchi cambiano di rado: ricaricati allo scadere del TTL o con invalidate_validation_lists()
+VALIDATION_CACHE_TTL = float(os.getenv("GE_VALIDATION_CACHE_TTL", "600"))
+validation_cache = TTLCache(ttl=VALIDATION_CACHE_TTL)
+register_cache("ge_validation_lists", validation_cache)
+
+def _load_validation_lists(db: Session) -> Dict[str, frozenset]:
+    # Una sola lettura della tabella di configurazione per tutti i campi
+    fields = sorted(set(VALIDATION_MAP.values()))
+    rows = db.execute(text(f"SELECT {', '.join(fields)} FROM {CONFIG_TABLE}")).fetchall()
+    values = {field: set() for field in fields}
+    for row in rows:
+        for field, raw in zip(fields, row):
+            if raw is not None and str(raw).strip() != '':
+                values[field].add(str(raw).strip())
+    return {field: frozenset(vals) for field, vals in values.items()}
+
+def get_validation_lists(db: Session) -> Dict[str, frozenset]:
+    """Valori ammessi per ogni campo di configurazione, condivisi tra /columns e /update."""
+    return validation_cache.get_or_load(engine_key(db.bind), lambda: _load_validation_lists(db))
+
+def get_allowed_values(db: Session, column: str) -> Optional[frozenset]:
+    """Insieme dei valori ammessi per la colonna, o None se la colonna non ha convalida a elenco."""
+    config_field = VALIDATION_MAP.get(column.upper())
+    if not config_field:
+        return None
+    return get_validation_lists(db).get(config_field, frozenset())
+
+def invalidate_validation_lists() -> None:
+    """Da chiamare dopo una modifica di carrefour_configurazione."""
+    validation_cache.invalidate()
+
+# Permessi per ruolo (colonne nascoste/editabili), già divisi in insiemi
+PERMISSIONS_CACHE_TTL = float(os.getenv("GE_PERMISSIONS_CACHE_TTL", "300"))
+role_permissions_cache = TTLCache(ttl=PERMISSIONS_CACHE_TTL)
+register_cache("ge_role_permissions", role_permissions_cache)
+
+@dataclass(frozen=True)
+class RolePermissions:
+    hidden_columns: frozenset = frozenset()
+    editable_columns: frozenset = frozenset()
+
+def _split_columns(value: Optional[str]) -> frozenset:
+    return frozenset(c.strip() for c in (value or '').split(',') if c.strip())
+
+def _load_role_permissions(db: Session, ruolo_id: int) -> RolePermissions:
+    permessi = db.query(UtenteRuoliPermessi).filter_by(ruolo_id=ruolo_id).first()
+    if not permessi:
+        return RolePermissions()
+    return RolePermissions(
+        hidden_columns=_split_columns(permessi.colonne_ordini_servizio_ge),
+        editable_columns=_split_columns(getattr(permessi, 'colonne_ordini_servizio_ge_edit', None)),
+    )
+
+def get_role_permissions(db: Session, ruolo_id: int) -> RolePermissions:
+    """Permessi del ruolo sulla griglia GE dalla cache di processo."""
+    return role_permissions_cache.get_or_load((engine_key(db.bind), ruolo_id), lambda: _load_role_permissions(db, ruolo_id))
+
+def invalidate_role_permissions(ruolo_id: Optional[int] = None) -> None:
+    """Invalida i permessi di un ruolo (o di tutti se ruolo_id è None)."""
+    if ruolo_id is None:
+        role_permissions_cache.invalidate()
+    else:
+        role_permissions_cache.invalidate_where(lambda key: key[1] == ruolo_id)
+
+@event.listens_for(UtenteRuoliPermessi, "after_insert")
+@event.listens_for(UtenteRuoliPermessi, "after_update")
+@event.listens_for(UtenteRuoliPermessi, "after_delete")
+def _permissions_changed(mapper, connection, target):
+    # Modifiche ai permessi fatte tramite ORM: la cache del ruolo viene scartata subito
+    invalidate_role_permissions(target.ruolo_id)
+
+def session_role(request: Request) -> Optional[int]:
+    """ruolo_id dal cookie di sessione JSON, None se assente o non valido."""
+    try:
+        return json.loads(request.cookies.get("session", "")).get("ruolo_id")
+    except Exception:
+        return None
+
+def grid_columns(column_names: List[str]) -> List[str]:
+    """Colonne della tabella esposte dalla griglia: esclusa la chiave interna del mese (vedi chiave_mese)."""
+    return [col for col in column_names if col != MONTH_KEY_COLUMN]
+
+def column_projection(db: Session, ruolo_id: Optional[int], requested: Optional[List[str]] = None) -> Optional[List[str]]:
+    """
+    Colonne da leggere per il ruolo: quelle non nascoste più ID, eventualmente ristrette a
+    `requested` (le colonne visibili nella griglia, per l'esportazione). None = tutte (SELECT *).
+    """
+    hidden = get_role_permissions(db, ruolo_id).hidden_columns if ruolo_id else frozenset()
+    if not hidden and not requested:
+        return None
+    column_names = grid_columns(get_table_metadata(db.bind, TABLE_NAME).column_names)
+    wanted = set(requested) if requested else None
+    columns = [col for col in column_names if col not in hidden and (wanted is None or col in wanted)]
+    if PK_COLUMN in column_names and PK_COLUMN not in columns:
+        columns.insert(0, PK_COLUMN) # Serve alla griglia per le modifiche e al cursore keyset
+    return columns
+
+def _requested_columns(value: Any) -> Optional[List[str]]:
+    """Elenco di colonne inviato dal client (lista o stringa JSON); None se assente o malformato."""
+    if isinstance(value, str):
+        try:
+            value = json.loads(unquote(value)) if value else None
+        except json.JSONDecodeError:
+            return None
+    return [str(col) for col in value if col] if isinstance(value, list) else None
+
+# Operatori ammessi nei filtri su colonne numeriche e date (i più lunghi prima)
+RANGE_OPERATORS = ('>=', '<=', '>', '<', '=')
+COMPARISONS = {'>=': operator.ge, '<=': operator.le, '>': operator.gt, '<': operator.lt, '=': operator.eq}
+
+def _unescape_regex(value: str) -> str:
+    """Inverso di escapeRegex() lato client: '\\.' → '.'."""
+    return re.sub(r'\\(.)', r'\1', value)
+
+def _split_regex(value: str, is_regex: bool) -> tuple:
+    """(valore esatto, prefisso) per i filtri regex `^v$` e `^v`; (None, None) per il testo libero."""
+    if not (is_regex and value.startswith('^')):
+        return None, None
+    exact = value.endswith('$') and len(value) > 1
+    body = _unescape_regex(value[1:-1] if exact else value[1:])
+    return (body, None) if exact else (None, body)
+
+def _escape_like(value: str) -> str:
+    return value.replace('!', '!!').replace('%', '!%').replace('_', '!_')
+
+def _parse_number(value: str):
+    value = value.strip().replace(',', '.')
+    number = Decimal(value)
+    if not number.is_finite():
+        raise ValueError(value)
+    return int(number) if number == number.to_integral_value() and '.' not in value else float(number)
+
+def _parse_date(value: str):
+    value = value.strip()
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return datetime.fromisoformat(value)
+
+def _parser_for(kind: str):
+    if kind == 'number':
+        return _parse_number
+    if kind == 'date':
+        return lambda value: _parse_date(value).date()
+    return _parse_date
+
+def _typed_conditions(value: str, kind: str) -> Optional[List[tuple]]:
+    """Condizioni (operatore, valore) di un filtro su colonna numerica/data; None se non interpretabile."""
+    parse = _parser_for(kind)
+    try:
+        if '..' in value:
+            low, high = (part.strip() for part in value.split('..', 1))
+            conditions = []
+            if low:
+                conditions.append(('>=', parse(low)))
+            if high:
+                upper = parse(high)
+                if kind == 'datetime' and len(high) <= 10:
+                    # Estremo superiore senza orario: tutto il giorno incluso
+                    conditions.append(('<', upper + timedelta(days=1)))
+                else:
+                    conditions.append(('<=', upper))
+            return conditions or None
+
+        op = next((candidate for candidate in RANGE_OPERATORS if value.startswith(candidate)), None)
+        operand = value[len(op):] if op else value
+        parsed = parse(operand)
+        if kind == 'datetime' and len(operand.strip()) <= 10 and op in (None, '='):
+            # Uguaglianza su un giorno per una colonna DATETIME: intervallo [giorno, giorno+1)
+            return [('>=', parsed), ('<', parsed + timedelta(days=1))]
+        return [(op or '=', parsed)]
+    except (ValueError, ArithmeticError):
+        return None
+
+def _compile_typed_filter(column: str, param: str, conditions: List[tuple]) -> tuple:
+    if len(conditions) == 1:
+        op, value = conditions[0]
+        return f'{column} {op} :{param}', {param: value}
+    clauses = [f'{column} {op} :{param}_{i}' for i, (op, _) in enumerate(conditions)]
+    return '(' + ' AND '.join(clauses) + ')', {f'{param}_{i}': value for i, (_, value) in enumerate(conditions)}
+
+def _typed_matcher(conditions: List[tuple], kind: str):
+    """Equivalente Python di _compile_typed_filter, per i dizionari dei valori distinti."""
+    parse = _parser_for(kind)
+
+    def matches(value: Any) -> bool:
+        if value is None:
+            return False
+        try:
+            if isinstance(value, str): # SQLite restituisce date e orari come testo
+                value = parse(value)
+            return all(COMPARISONS[op](value, bound) for op, bound in conditions)
+        except (TypeError, ValueError, ArithmeticError):
+            return False
+    return matches
 
 class FilterManager:
-    def __init__(self, db: Session, table_name: str):
+    def __init__(self, db: Session, table_name: str, search_index: Optional[GlobalSearchIndex] = None):
         self.db = db
         self.table_name = table_name
+        self.search_index = search_index
         self.column_names = self._get_column_names()
 
     def _get_column_names(self) -> List[str]:
-        inspector = inspect(self.db.bind)
-        return [col['name'] for col in inspector.get_columns(self.table_name)]
+        # Metadati condivisi tra le richieste: information_schema viene letto solo a cache fredda
+        return grid_columns(get_table_metadata(self.db.bind, self.table_name).column_names)
+
+    @property
+    def table_metadata(self):
+        """Metadati completi (tipi, nullable, PK) dalla cache di processo."""
+        return get_table_metadata(self.db.bind, self.table_name)
+
+    def _column_kind(self, col_name: str) -> str:
+        """'number', 'date', 'datetime' o 'text' dal tipo della colonna nei metadati in cache."""
+        try:
+            column = self.table_metadata.column(col_name)
+            python_type = column.type.python_type if column is not None else str
+        except Exception:
+            return 'text' # Tipo non determinabile: confronto testuale come in precedenza
+        if python_type is bool:
+            return 'text'
+        if issubclass(python_type, (int, float, Decimal)):
+            return 'number'
+        if issubclass(python_type, datetime):
+            return 'datetime'
+        if issubclass(python_type, date):
+            return 'date'
+        return 'text'
+
+    def _text_collation(self) -> str:
+        # In MySQL le collation *_ci confrontano già senza distinzione di maiuscole; SQLite (test) no
+        dialect = getattr(getattr(getattr(self.db, 'bind', None), 'dialect', None), 'name', 'mysql')
+        return ' COLLATE NOCASE' if dialect == 'sqlite' else ''
+
+    def parse_column_filter(self, col_name: str, val: str, is_regex: bool = False) -> tuple:
+        """
+        Interpretazione del filtro di una colonna, condivisa da SQL, dizionari e replica in memoria:
+        (modo, operando, tipo colonna) con modo 'typed' (operando = condizioni), 'exact', 'prefix' o 'contains'.
+        """
+        kind = self._column_kind(col_name)
+        exact, prefix = _split_regex(val, is_regex)
+        # Un numero senza operatore resta una ricerca per sottostringa ('12' trova 112 e 12,50):
+        # l'uguaglianza si chiede con '=12' o scegliendo il valore dall'elenco (^12$)
+        bare_number = (kind == 'number' and exact is None and '..' not in val
+                       and not val.strip().startswith(RANGE_OPERATORS))
+        if kind != 'text' and not bare_number:
+            conditions = _typed_conditions(exact if exact is not None else val.strip(), kind)
+            if conditions:
+                return 'typed', conditions, kind
+        if exact is not None:
+            return 'exact', exact.strip(), kind
+        if prefix is not None:
+            return 'prefix', prefix.strip(), kind
+        return 'contains', val.strip(), kind
+
+    def compile_column_filter(self, col_name: str, val: str, is_regex: bool = False) -> tuple:
+        clause, params, _ = self._compile_column_filter(col_name, val, is_regex)
+        return clause, params
+
+    def _compile_column_filter(self, col_name: str, val: str, is_regex: bool = False) -> tuple:
+        """
+        Condizione per il filtro di una colonna in base al tipo, senza funzioni sulla colonna quando
+        possibile (così l'indice è utilizzabile):
+          - ^valore$ (scelta da elenco): uguaglianza `col = :v`
+          - ^valore (regex): prefisso `col LIKE 'v%'`
+          - colonne numeriche e date: >, >=, <, <=, = e intervalli `da..a`; una data da sola
+            è il giorno, un numero da solo una sottostringa come il testo
+          - altro testo: `col LIKE '%v%'`
+        Il terzo elemento indica l'accesso possibile via indice: 'equality', 'range' o 'scan'.
+        """
+        param = f'col_filter_{col_name}'
+        mode, operand, kind = self.parse_column_filter(col_name, val, is_regex)
+        column = f'`{col_name}`'
+
+        if mode == 'typed':
+            clause, params = _compile_typed_filter(column, param, operand)
+            access = 'equality' if all(op == '=' for op, _ in operand) else 'range'
+            return clause, params, access
+
+        collate = self._text_collation()
+        if kind != 'text':
+            # Valore non interpretabile su colonna numerica/data: confronto testuale come in precedenza
+            column, collate = f'CAST({column} AS CHAR)', ''
+        if mode == 'exact':
+            return f'{column}{collate} = :{param}', {param: operand}, 'equality' if kind == 'text' else 'scan'
+        if mode == 'prefix':
+            return (f"{column}{collate} LIKE :{param} ESCAPE '!'", {param: f'{_escape_like(operand)}%'},
+                    'range' if kind == 'text' else 'scan')
+        return f"{column}{collate} LIKE :{param} ESCAPE '!'", {param: f'%{_escape_like(operand)}%'}, 'scan'
+
+    def column_matcher(self, col_name: str, val: str, is_regex: bool = False):
+        """Predicato Python equivalente a compile_column_filter, valutato sul valore di una cella."""
+        mode, operand, kind = self.parse_column_filter(col_name, val, is_regex)
+        if mode == 'typed':
+            return _typed_matcher(operand, kind)
+        target = operand.casefold()
+        if mode == 'exact':
+            return lambda value: value is not None and str(value).rstrip().casefold() == target
+        if mode == 'prefix':
+            return lambda value: value is not None and str(value).casefold().startswith(target)
+        return lambda value: value is not None and target in str(value).casefold()
 
     def build_where_clause(self,
                           month_filter: Optional[str] = None,
@@ -36,17 +455,35 @@ class FilterManager:
                           column_searches: Optional[Dict[str, Any]] = None) -> tuple:
         where_clauses = []
         query_params = {}
+        # Forma dei predicati (senza valori) per la strumentazione degli indici
+        self.predicates = {'equality': [], 'range': [], 'scan': [], 'fulltext': False}
 
         if month_filter and month_filter.strip().upper() != 'TUTTO':
-            # Assumendo che MesePresentazione sia una colonna valida per TABLE_NAME
-            where_clauses.append('UPPER(TRIM(`MesePresentazione`)) = :month_filter')
-            query_params['month_filter'] = month_filter.strip().upper()
-
-        if search_value:
+            month_key = month_number(month_filter) if has_month_key(self.db, self.table_name) else None
+            if month_key is not None:
+                # Colonna generata e indicizzata: lettura di un intervallo dell'indice invece della scansione
+                where_clauses.append(f'`{MONTH_KEY_COLUMN}` = :month_filter')
+                query_params['month_filter'] = month_key
+                self.predicates['equality'].append(MONTH_KEY_COLUMN)
+            else:
+                # Assumendo che MesePresentazione sia una colonna valida per TABLE_NAME
+                where_clauses.append('UPPER(TRIM(`MesePresentazione`)) = :month_filter')
+                query_params['month_filter'] = month_filter.strip().upper()
+                self.predicates['scan'].append('MesePresentazione')
+
+        indexed_search = self.search_index.compile_match(search_value) if search_value and self.search_index else None
+        if indexed_search:
+            # Lookup sull'indice full-text invece della scansione LIKE su tutte le colonne
+            search_clause, search_params = indexed_search
+            where_clauses.append(search_clause)
+            query_params.update(search_params)
+            self.predicates['fulltext'] = True
+        elif search_value:
             search_clauses = [f'UPPER(TRIM(CAST(`{col}` AS CHAR))) LIKE :search_value'
                             for col in self.column_names]
             where_clauses.append(f"({' OR '.join(search_clauses)})")
             query_params['search_value'] = f'%{search_value.upper()}%'
+            self.predicates['scan'].append(ALL_COLUMNS_TAG)
 
         if column_searches:
             for col_name, search_obj in column_searches.items():
@@ -59,14 +496,10 @@ class FilterManager:
                 if not val:
                     continue
 
-                param_name = f'col_filter_{col_name}'
-                if is_regex and val.startswith('^') and val.endswith('$'):
-                    exact_val = val[1:-1]
-                    where_clauses.append(f'UPPER(TRIM(CAST(`{col_name}` AS CHAR))) = :{param_name}')
-                    query_params[param_name] = exact_val.upper()
-                else:
-                    where_clauses.append(f'UPPER(TRIM(CAST(`{col_name}` AS CHAR))) LIKE :{param_name}')
-                    query_params[param_name] = f'%{val.upper()}%'
+                clause, params, access = self._compile_column_filter(col_name, str(val), is_regex)
+                where_clauses.append(clause)
+                query_params.update(params)
+                self.predicates[access].append(col_name)
 
         where_sql = " WHERE " + " AND ".join(where_clauses) if where_clauses else ""
         # Rimosso print per pulizia codice produzione
@@ -74,10 +507,32 @@ class FilterManager:
         # print(f"Query parameters: {query_params}")
         return where_sql, query_params
 
+    def query_shape(self, kind: str, orderings=()) -> Optional[QueryShape]:
+        """Forma dell'ultima clausola WHERE costruita, per consigli_indici."""
+        predicates = getattr(self, 'predicates', None)
+        if predicates is None:
+            return None
+        return QueryShape(
+            table=self.table_name, kind=kind,
+            equality=tuple(sorted(predicates['equality'])), ranges=tuple(sorted(predicates['range'])),
+            scans=tuple(sorted(predicates['scan'])), fulltext=predicates['fulltext'],
+            order_by=tuple((col, dir.lower()) for col, dir in orderings),
+        )
+
+@contextmanager
+def record_query_shape(filter_manager: FilterManager, kind: str, orderings=()):
+    """Misura la query eseguita nel blocco e ne registra la forma (vedi consigli_indici)."""
+    started = time.perf_counter()
+    yield
+    query_shapes.record(filter_manager.query_shape(kind, orderings), (time.perf_counter() - started) * 1000)
+
 class QueryBuilder:
-    def __init__(self, table_name: str):
+    def __init__(self, table_name: str, columns: Optional[List[str]] = None):
         self.table_name = table_name
-        self.base_query = f"SELECT * FROM `{self.table_name}`"
+        self.columns = columns
+        # Proiezione sulle colonne richieste (visibili per il ruolo); senza elenco tutte le colonne
+        select_list = ', '.join(f'`{col}`' for col in columns) if columns else '*'
+        self.base_query = f"SELECT {select_list} FROM `{self.table_name}`"
 
     def _build_where_clause(self, where_sql: str) -> str:
         return f"{self.base_query}{where_sql}"
@@ -99,6 +554,42 @@ class QueryBuilder:
             else:
                 return text(f"{base} LIMIT :limit OFFSET :offset")
 
+    def build_keyset_query(self, where_sql: str, orderings, limit: int,
+                           cursor_values: List[Any], backward: bool = False) -> tuple:
+        """
+        Pagina "seek": invece di OFFSET filtra le righe successive (o precedenti) alla
+        tupla di ordinamento del cursore, così il costo non dipende dalla profondità.
+        `orderings` deve terminare con una colonna univoca (ID).
+        """
+        # NULL come in MySQL: primi in ordine crescente, ultimi in decrescente. I valori NULL del
+        # cursore diventano IS NULL / IS NOT NULL, altrimenti `col > :v` scarterebbe le righe NULL
+        keyset_params = {f'ks_{i}': value for i, value in enumerate(cursor_values) if value is not None}
+        branches = []
+        for i, (col, dir) in enumerate(orderings):
+            forward_asc = (dir.lower() == 'asc') != backward
+            value = cursor_values[i]
+            if value is None:
+                if not forward_asc:
+                    continue # Nulla segue NULL quando i NULL sono in fondo
+                after = f'`{col}` IS NOT NULL'
+            elif forward_asc:
+                after = f'`{col}` > :ks_{i}'
+            else:
+                after = f'(`{col}` < :ks_{i} OR `{col}` IS NULL)'
+            equals = [f'`{prev_col}` IS NULL' if cursor_values[j] is None else f'`{prev_col}` = :ks_{j}'
+                      for j, (prev_col, _) in enumerate(orderings[:i])]
+            branches.append('(' + ' AND '.join(equals + [after]) + ')')
+        seek_sql = '(' + ' OR '.join(branches) + ')'
+        where_seek = f"{where_sql} AND {seek_sql}" if where_sql else f" WHERE {seek_sql}"
+
+        # All'indietro si legge in ordine inverso e si ribaltano le righe in DataManager
+        order_sql = ', '.join([
+            f'`{col}` {(dir if not backward else ("desc" if dir.lower() == "asc" else "asc")).upper()}'
+            for col, dir in orderings
+        ])
+        keyset_params['limit'] = limit
+        return text(f"{self._build_where_clause(where_seek)} ORDER BY {order_sql} LIMIT :limit"), keyset_params
+
     def build_export_query(self, where_sql: str) -> text:
         return text(self._build_where_clause(where_sql))
 
@@ -118,17 +609,86 @@ class QueryBuilder:
         """) # Limite per performance
 
 class DataManager:
-    def __init__(self, db: Session, table_name: str):
+    KEYSET_TIEBREAKER = 'ID'
+
+    def __init__(self, db: Session, table_name: str, columns: Optional[List[str]] = None,
+                 replica: Optional[ColumnarReplica] = None):
         self.db = db
         self.table_name = table_name
-        self.filter_manager = FilterManager(db, table_name)
-        self.query_builder = QueryBuilder(table_name)
-
-    def get_total_records(self) -> int:
-        query = text(f"SELECT COUNT(*) FROM `{self.table_name}`")
-        result = self.db.execute(query).scalar()
-        return result if result is not None else 0
-
+        self.columns = columns
+        self.replica = replica
+        search_index = GlobalSearchIndex(db, table_name) if FULLTEXT_SEARCH_ENABLED else None
+        self.filter_manager = FilterManager(db, table_name, search_index=search_index)
+        if columns is None and has_month_key(db, table_name):
+            # SELECT * restituirebbe anche la chiave interna del mese
+            self.columns = columns = self.filter_manager.column_names
+        self.query_builder = QueryBuilder(table_name, columns)
+
+    def _count_key(self, where_sql: str, query_params: Dict[str, Any]) -> tuple:
+        return (engine_key(self.db.bind), self.table_name, make_key(" ".join(where_sql.split()), query_params))
+
+    def get_estimated_total_records(self) -> Optional[int]:
+        """Numero di righe stimato dalle statistiche di MySQL (None se non disponibile)."""
+        try:
+            if self.db.bind.dialect.name != 'mysql':
+                return None
+        except AttributeError:
+            return None
+        query = text(
+            "SELECT TABLE_ROWS FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name"
+        )
+        return self.db.execute(query, {'table_name': self.table_name}).scalar()
+
+    def get_total_records(self, estimated: bool = False) -> int:
+        key = self._count_key("", {}) + (('estimated',) if estimated else ())
+        cached = count_cache.get(key)
+        if cached is not None:
+            return cached
+        result = self.get_estimated_total_records() if estimated else None
+        if result is None:
+            query = text(f"SELECT COUNT(*) FROM `{self.table_name}`")
+            result = self.db.execute(query).scalar()
+        result = result if result is not None else 0
+        count_cache.set(key, result)
+        return result
+
+    def get_filtered_count(self, where_sql: str, query_params: Dict[str, Any], estimated: bool = False) -> int:
+        if not where_sql: # Senza filtri coincide con il totale
+            return self.get_total_records(estimated=estimated)
+        key = self._count_key(where_sql, query_params)
+        cached = count_cache.get(key)
+        if cached is not None:
+            return cached
+        count_query = self.query_builder.build_count_query(where_sql)
+        with record_query_shape(self.filter_manager, 'count'):
+            result = self.db.execute(count_query, query_params).scalar()
+        result = result if result is not None else 0
+        count_cache.set(key, result)
+        return result
+
+    def _resolve_seek(self, cursor: Optional[Dict[str, Any]], query_key: str, start: int, length: int, width: int):
+        """
+        Decide se la pagina richiesta è adiacente a quella del cursore ricevuto dal client.
+        Restituisce (valori, backward) per una pagina seek, None per il fallback su OFFSET
+        (salti di pagina casuali, filtri/ordinamento cambiati, ID mancante nel cursore).
+        """
+        if not isinstance(cursor, dict) or cursor.get('key') != query_key:
+            return None
+        try:
+            cursor_start = int(cursor.get('start'))
+        except (TypeError, ValueError):
+            return None
+        if start == cursor_start + length:
+            values, backward = cursor.get('last'), False
+        elif start == cursor_start - length:
+            values, backward = cursor.get('first'), True
+        else:
+            return None
+        # NULL ammessi nelle colonne di ordinamento (gestiti nella query), non nell'ID finale
+        if not isinstance(values, list) or len(values) != width or values[-1] is None:
+            return None
+        return values, backward
 
     def get_filtered_data(self, params: Dict[str, Any]) -> Dict[str, Any]:
         try:
@@ -145,6 +705,12 @@ class DataManager:
                 orderings.append((col_name, dir))
             month_filter = params.get('month_filter', '').strip()
             rtc_filter = params.get('rtc_filter', '').strip() # Specifico per questo contesto?
+            keyset = params.get('pagination') == 'keyset' and length != -1
+            if keyset and self.KEYSET_TIEBREAKER in column_names and \
+                    all(col != self.KEYSET_TIEBREAKER for col, _ in orderings):
+                # Il cursore deve identificare una riga in modo univoco
+                orderings.append((self.KEYSET_TIEBREAKER, 'asc'))
+            keyset = keyset and self.KEYSET_TIEBREAKER in column_names
 
             if not column_names: # Caso tabella vuota o non esistente
                  return {
@@ -163,36 +729,60 @@ class DataManager:
             if rtc_filter: # Assumendo che 'RTC' sia una colonna valida
                 column_searches['RTC'] = {'value': rtc_filter, 'regex': True} # o come deve essere gestito
 
+            if self.replica is not None and self.replica.ready:
+                # Filtri, ordinamento e pagina calcolati sulla replica in memoria, senza query
+                # (nessun cursore keyset: lo slice della replica non ne ha bisogno)
+                return self.replica.page(self.filter_manager, draw, start, length, orderings,
+                                         month_filter, search_value, column_searches, self.columns)
+
             where_sql, query_params = self.filter_manager.build_where_clause(
                 month_filter=month_filter,
                 search_value=search_value,
                 column_searches=column_searches
             )
 
-            total_records = self.get_total_records()
-            count_query = self.query_builder.build_count_query(where_sql)
-            records_filtered_result = self.db.execute(count_query, query_params).scalar()
-            records_filtered = records_filtered_result if records_filtered_result is not None else 0
-
-
-            data_query = self.query_builder.build_data_query(
-                where_sql, orderings, length, start
-            )
-
-            final_params = {**query_params}
-            if length != -1: # Solo se length non è -1 (tutti i record)
-                final_params['limit'] = length
-                final_params['offset'] = start
-
-            result = self.db.execute(data_query, final_params).fetchall()
-            data = [dict(row._mapping) for row in result]
-
-            return {
+            estimated = str(params.get('count_mode', COUNT_MODE)).lower() == 'estimated'
+            total_records = self.get_total_records(estimated=estimated)
+            records_filtered = self.get_filtered_count(where_sql, query_params, estimated=estimated)
+
+
+            query_key = make_key(where_sql, query_params, orderings) if keyset else None
+            seek = self._resolve_seek(params.get('cursor'), query_key, start, length, len(orderings)) if keyset else None
+
+            # Colonne di ordinamento fuori dalla proiezione: lette solo per il cursore keyset
+            extra_columns = [col for col, _ in orderings if col not in self.columns] if keyset and self.columns else []
+
+            page_key = make_key(engine_key(self.db.bind), self.table_name, where_sql, query_params,
+                                orderings, start, length, seek, self.columns)
+            data = page_cache.get(page_key) if PAGE_CACHE_ENABLED else None
+            if data is None:
+                data = self._fetch_page(where_sql, query_params, orderings, start, length, seek, extra_columns)
+                if PAGE_CACHE_ENABLED:
+                    filter_columns = set(column_searches) | {col for col, _ in orderings}
+                    if month_filter and month_filter.upper() != 'TUTTO':
+                        filter_columns.add('MesePresentazione')
+                    if search_value:
+                        filter_columns.add(ALL_COLUMNS_TAG)
+                    tags = [('col', self.table_name, col) for col in filter_columns]
+                    tags += [('pk', self.table_name, str(row.get(self.KEYSET_TIEBREAKER))) for row in data]
+                    page_cache.set(page_key, data, tags=tags, size=len(json.dumps(data, default=str)))
+
+            response = {
                 "draw": draw,
                 "recordsTotal": total_records,
                 "recordsFiltered": records_filtered,
-                "data": data,
+                "data": [{k: v for k, v in row.items() if k not in extra_columns} for row in data]
+                        if extra_columns else data,
             }
+            if keyset:
+                # Il client rimanda il cursore con la richiesta successiva
+                response["cursor"] = {
+                    "key": query_key,
+                    "start": start,
+                    "first": [data[0].get(col) for col, _ in orderings] if data else None,
+                    "last": [data[-1].get(col) for col, _ in orderings] if data else None,
+                }
+            return response
         except Exception as e:
             # print("!!! ERROR IN get_filtered_data !!!") # Usare un logger in produzione
             traceback.print_exc()
@@ -201,27 +791,65 @@ class DataManager:
                 "error": f"Errore Interno del Server: {str(e)}" # Non esporre dettagli dell'errore in produzione
             }
 
-    def get_export_data(self, month: str, global_search: str, column_filters: str) -> List[Dict[str, Any]]:
-        try:
-            column_searches = {}
-            if column_filters:
-                try:
-                    filters_dict = json.loads(unquote(column_filters))
-                    column_searches = {
-                        col: val for col, val in filters_dict.items()
-                        if col in self.filter_manager.column_names and val # Valida colonna e valore
-                    }
-                except json.JSONDecodeError:
-                    # print("Errore nel decodificare i filtri per colonna JSON.") # Usare logger
-                    pass # Non bloccare l'esportazione per filtri malformati, ma loggare
-
-            where_sql, query_params = self.filter_manager.build_where_clause(
-                month_filter=month,
-                search_value=global_search,
-                column_searches=column_searches
+    def _fetch_page(self, where_sql: str, query_params: Dict[str, Any], orderings, start: int, length: int,
+                    seek: Optional[tuple], extra_columns: List[str] = ()) -> List[Dict[str, Any]]:
+        query_builder = QueryBuilder(self.table_name, self.columns + extra_columns) if extra_columns else self.query_builder
+        if seek:
+            cursor_values, backward = seek
+            data_query, keyset_params = query_builder.build_keyset_query(
+                where_sql, orderings, length, cursor_values, backward
             )
+            with record_query_shape(self.filter_manager, 'page', orderings):
+                result = self.db.execute(data_query, {**query_params, **keyset_params}).fetchall()
+            if backward:
+                result = list(reversed(result))
+        else:
+            data_query = query_builder.build_data_query(
+                where_sql, orderings, length, start
+            )
+
+            final_params = {**query_params}
+            if length != -1: # Solo se length non è -1 (tutti i record)
+                final_params['limit'] = length
+                final_params['offset'] = start
+
+            with record_query_shape(self.filter_manager, 'page', orderings):
+                result = self.db.execute(data_query, final_params).fetchall()
+        return [dict(row._mapping) for row in result]
 
-            query = self.query_builder.build_export_query(where_sql)
+    def build_export_where(self, month: str, global_search: str, column_filters: str) -> tuple:
+        """Clausola WHERE e parametri dell'esportazione per i filtri ricevuti dal client."""
+        column_searches = {}
+        if column_filters:
+            try:
+                filters_dict = json.loads(unquote(column_filters))
+                column_searches = {
+                    col: val for col, val in filters_dict.items()
+                    if col in self.filter_manager.column_names and val # Valida colonna e valore
+                }
+            except json.JSONDecodeError:
+                # print("Errore nel decodificare i filtri per colonna JSON.") # Usare logger
+                pass # Non bloccare l'esportazione per filtri malformati, ma loggare
+
+        return self.filter_manager.build_where_clause(
+            month_filter=month,
+            search_value=global_search,
+            column_searches=column_searches
+        )
+
+    def build_export_query(self, month: str, global_search: str, column_filters: str) -> tuple:
+        """Query e parametri dell'esportazione per i filtri ricevuti dal client."""
+        where_sql, query_params = self.build_export_where(month, global_search, column_filters)
+        return self.query_builder.build_export_query(where_sql), query_params
+
+    def get_export_rows(self, month: str, global_search: str, column_filters: str) -> QueryRows:
+        """Righe dell'esportazione lette a blocchi con cursore lato server."""
+        query, query_params = self.build_export_query(month, global_search, column_filters)
+        return QueryRows(self.db, query, query_params)
+
+    def get_export_data(self, month: str, global_search: str, column_filters: str) -> List[Dict[str, Any]]:
+        try:
+            query, query_params = self.build_export_query(month, global_search, column_filters)
             result = self.db.execute(query, query_params).fetchall()
             return [dict(row._mapping) for row in result]
         except Exception as e:
@@ -237,7 +865,7 @@ async def get_gestione_gs_tab(request: Request):
     return templates.TemplateResponse("ordini_servizi_ge.html", {"request": request})
 
 @router.get("/api/servizi/ge/columns")
-async def get_gestione_gs_columns(request: Request, db: Session = Depends(get_db)):
+def get_gestione_gs_columns(request: Request, db: Session = Depends(get_db)):
     try:
         # Leggi il cookie di sessione come JSON
         session_cookie = request.cookies.get("session")
@@ -256,38 +884,20 @@ async def get_gestione_gs_columns(request: Request, db: Session = Depends(get_db
             return JSONResponse(status_code=404, content={"error": "Utente non trovato"})
         if not ruolo_id:
             return JSONResponse(status_code=400, content={"error": "Ruolo non trovato per l'utente"})
-        permessi = db.query(UtenteRuoliPermessi).filter_by(ruolo_id=ruolo_id).first()
-        colonne_nascoste = []
-        colonne_editabili = []
-        if permessi and permessi.colonne_ordini_servizio_ge:
-            colonne_nascoste = [c.strip() for c in permessi.colonne_ordini_servizio_ge.split(',') if c.strip()]
-        if permessi and hasattr(permessi, 'colonne_ordini_servizio_ge_edit') and permessi.colonne_ordini_servizio_ge_edit:
-            colonne_editabili = [c.strip() for c in permessi.colonne_ordini_servizio_ge_edit.split(',') if c.strip()]
+        permessi = get_role_permissions(db, ruolo_id)
+        colonne_nascoste = permessi.hidden_columns
+        colonne_editabili = permessi.editable_columns
         filter_manager = FilterManager(db, TABLE_NAME)
         columns = filter_manager.column_names
         if not columns:
             return JSONResponse([])
-        # Mappatura colonne → campo configurazione (tutto MAIUSCOLO per robustezza)
-        validation_map = {
-            'CATEGORIA_CLIENTE': 'competenza',
-            'TIPO_INTERVENTO': 'tipologia',
-            'CATEGORIA_INTERVENTO': 'categoria',
-            'TIPOLOGIA_OPEX': 'tipo',
-            'PRESENZA_GAS': 'CONFERMA',
-            'STATO_APPROVAZIONE': 'approvazionecarrefour',
-            'STATO_APPROVAZIONE_BACKOFFICE': 'stati',
-        }
         columns_out = []
         for col in columns:
             validation = None
-            config_field = validation_map.get(col.upper())
-            if config_field:
-                # Estrai tutti i valori distinti non nulli/non vuoti per quella colonna
-                value_query = text(f"SELECT DISTINCT {config_field} FROM carrefour_configurazione WHERE {config_field} IS NOT NULL AND TRIM({config_field}) != ''")
-                value_rows = db.execute(value_query).fetchall()
-                values = sorted({str(row[0]).strip() for row in value_rows if row[0] is not None and str(row[0]).strip() != ''})
-                if values:
-                    validation = {"type": "list", "values": values}
+            # Elenchi di convalida dalla cache (nessuna query su carrefour_configurazione a cache calda)
+            allowed = get_allowed_values(db, col)
+            if allowed:
+                validation = {"type": "list", "values": sorted(allowed)}
             columns_out.append({
                 "field": col,
                 "title": col.replace('_', ' ').title(),
@@ -304,15 +914,23 @@ async def get_gestione_gs_columns(request: Request, db: Session = Depends(get_db
         print("[DEBUG ERRORE /api/servizi/ge/columns]\n", tb_str)
         raise HTTPException(status_code=500, detail=f"Errore nel recupero delle colonne: {str(e)}\nTRACEBACK:\n{tb_str}")
 
+@router.post("/api/servizi/ge/validation/refresh", include_in_schema=False)
+async def refresh_validation_lists(request: Request):
+    """Forza il ricaricamento di elenchi di convalida e permessi (es. dopo modifiche fatte direttamente sul DB)."""
+    require_internal_access(request)
+    invalidate_validation_lists()
+    invalidate_role_permissions()
+    return JSONResponse({"status": "ok"})
+
 @router.get("/api/servizi/ge/months")
-async def get_presentation_months():
-    # Questa route sembra generica, ma la lascio qui come da piano
-    months = [
-        "GENNAIO", "FEBBRAIO", "MARZO", "APRILE", "MAGGIO", "GIUGNO",
-        "LUGLIO", "AGOSTO", "SETTEMBRE", "OTTOBRE", "NOVEMBRE", "DICEMBRE",
-        "TUTTO"
-    ]
-    return JSONResponse(months)
+def get_presentation_months(db: Session = Depends(get_db)):
+    # Solo i mesi con dati, letti dall'indice della chiave del mese; senza chiave (o tabella vuota) l'elenco fisso
+    try:
+        months = available_months(db, TABLE_NAME)
+    except Exception:
+        traceback.print_exc()
+        months = []
+    return JSONResponse([*(months or MONTHS), "TUTTO"])
 
 @router.post("/api/servizi/ge/data")
 async def get_gestione_gs_data(request: Request, db: Session = Depends(get_db)):
@@ -320,16 +938,33 @@ async def get_gestione_gs_data(request: Request, db: Session = Depends(get_db)):
         params = await request.json()
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Payload JSON malformato.")
-    data_manager = DataManager(db, TABLE_NAME)
-    return data_manager.get_filtered_data(params) # La gestione errori è interna
-
-@router.post("/api/servizi/ge/update")
-async def update_gestione_gs_data(request: Request, db: Session = Depends(get_db)):
+    accept = request.headers.get("accept", "")
+
+    def load():
+        # Solo le colonne visibili per il ruolo (più ID) vengono lette e inviate
+        columns = column_projection(db, session_role(request))
+        replica = ge_replica if ge_replica.serves(db.bind) else None
+        result = DataManager(db, TABLE_NAME, columns, replica=replica).get_filtered_data(params)
+        if str(params.get('format', '')).lower() == 'columnar' or wants_msgpack(accept):
+            # Formato compatto su richiesta: nomi delle colonne una volta sola, orjson/msgpack
+            return columnar_response(result, accept)
+        return result
+    # La gestione errori è interna
+    return await run_db(load)
+
+def _same_value(current: Any, expected: Any) -> bool:
+    """Confronto tra il valore in tabella e quello visto dal client (serializzato in JSON dalla griglia)."""
+    if current in (None, '') or expected in (None, ''):
+        return current in (None, '') and expected in (None, '')
+    if str(current) == str(expected):
+        return True
     try:
-        data = await request.json()
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Payload JSON malformato per l'aggiornamento.")
+        return float(current) == float(expected)
+    except (TypeError, ValueError):
+        return False
 
+def _update_record(request: Request, db: Session, data: Dict[str, Any]) -> JSONResponse:
+    """Aggiornamento di una cella con log della modifica (lavoro sincrono sul DB)."""
     pk = data.get('pk')
     field = data.get('field')
     value = data.get('value') # value può essere None, '', 0 etc. quindi non check 'not value'
@@ -341,17 +976,39 @@ async def update_gestione_gs_data(request: Request, db: Session = Depends(get_db
     if field not in filter_manager.column_names:
         raise HTTPException(status_code=400, detail=f"Campo '{field}' non valido.")
 
+    # Autorizzazione: il campo deve essere tra le colonne editabili del ruolo (controllo in memoria)
+    ruolo_id = session_role(request)
+    if not ruolo_id:
+        raise HTTPException(status_code=401, detail="Utente non autenticato.")
+    if field not in get_role_permissions(db, ruolo_id).editable_columns:
+        raise HTTPException(status_code=403, detail=f"Il campo '{field}' non è modificabile per il tuo ruolo.")
+
+    # Modalità condizionale: il client invia il valore che vedeva (old_value) e l'UPDATE
+    # viene applicato solo se la cella ha ancora quel valore (stesso confronto dell'aggiornamento multiplo)
+    conditional = 'old_value' in data
+    expected = data.get('old_value')
+
     # --- Inizio implementazione logging ---
     campo_old = None
     try:
         # 1. Recuperare il valore attuale del campo (campo_old)
-        # Assumendo che la tabella abbia una colonna 'ID' come chiave primaria
-        select_query = text(f"SELECT `{field}` FROM `{TABLE_NAME}` WHERE ID = :pk")
+        # La riga resta bloccata fino al commit: il confronto con old_value e l'UPDATE sono atomici
+        lock_sql = " FOR UPDATE" if db.bind.dialect.name == "mysql" else ""
+        select_query = text(f"SELECT `{field}` FROM `{TABLE_NAME}` WHERE ID = :pk{lock_sql}")
         result_old = db.execute(select_query, {'pk': pk}).fetchone()
 
         if result_old is None:
             raise HTTPException(status_code=404, detail="Record non trovato per il recupero del valore originale.")
 
+        if conditional and not _same_value(result_old[0], expected):
+            # Un altro utente ha cambiato la cella dopo che il client l'ha letta
+            db.rollback()
+            return JSONResponse(status_code=409, content={
+                "status": "conflict",
+                "message": "Il valore è stato modificato da un altro utente.",
+                "current_value": jsonable_encoder(result_old[0]),
+            })
+
         # Gestione del caso in cui il campo sia di tipo binario o non facilmente serializzabile
         try:
             campo_old = str(result_old[0]) if result_old[0] is not None else None
@@ -367,22 +1024,9 @@ async def update_gestione_gs_data(request: Request, db: Session = Depends(get_db
     # --- Fine recupero campo_old ---
 
     # --- Inizio controllo convalida dati a elenco ---
-    validation_map = {
-        'CATEGORIA_CLIENTE': 'competenza',
-        'TIPO_INTERVENTO': 'tipologia',
-        'CATEGORIA_INTERVENTO': 'categoria',
-        'TIPOLOGIA_OPEX': 'tipo',
-        'PRESENZA_GAS': 'CONFERMA',
-        'stato_approvazione': 'approvazionecarrefour',
-        'stato_approvazione_backoffice': 'stati',
-    }
-    config_field = validation_map.get(field.upper())
-    if config_field:
-        value_query = text(f"SELECT DISTINCT {config_field} FROM carrefour_configurazione WHERE {config_field} IS NOT NULL AND TRIM({config_field}) != ''")
-        value_rows = db.execute(value_query).fetchall()
-        values = {str(row[0]).strip() for row in value_rows if row[0] is not None and str(row[0]).strip() != ''}
-        if str(value).strip() != '' and str(value).strip() not in values:
-            raise HTTPException(status_code=400, detail=f"Valore '{value}' non ammesso per la colonna '{field}'. Valori ammessi: {sorted(values)}")
+    allowed = get_allowed_values(db, field)
+    if allowed is not None and str(value).strip() != '' and str(value).strip() not in allowed:
+        raise HTTPException(status_code=400, detail=f"Valore '{value}' non ammesso per la colonna '{field}'. Valori ammessi: {sorted(allowed)}")
     # --- Fine controllo convalida dati a elenco ---
 
     try:
@@ -392,9 +1036,7 @@ async def update_gestione_gs_data(request: Request, db: Session = Depends(get_db
             WHERE ID = :pk
         """) # Assumendo ID come chiave primaria
 
-        query_params = {'value': value, 'pk': pk}
-
-        result = db.execute(update_query, query_params)
+        result = db.execute(update_query, {'value': value, 'pk': pk})
 
         if result.rowcount == 0:
             # Questo potrebbe accadere se il record viene eliminato tra la lettura di campo_old e l'update.
@@ -413,16 +1055,28 @@ async def update_gestione_gs_data(request: Request, db: Session = Depends(get_db
                 except Exception:
                     utente_session = str(utente_session)
 
-            log_entry = CarrefourLog(
-                utente=utente_session,
-                campo_old=str(campo_old) if campo_old is not None else None, # Assicura sia stringa o None
-                campo_new=str(value) if value is not None else None,       # Assicura sia stringa o None
-                data=datetime.utcnow(),
-                id_tabella=pk,
-                colonna=field
-            )
-            db.add(log_entry)
+            # Nella transazione (modalità sync) o nel journal dopo il commit (modalità journal)
+            audit_log.record(db, [{
+                "utente": utente_session,
+                "campo_old": str(campo_old) if campo_old is not None else None, # Assicura sia stringa o None
+                "campo_new": str(value) if value is not None else None,       # Assicura sia stringa o None
+                "data": datetime.utcnow(),
+                "id_tabella": pk,
+                "colonna": field,
+            }])
+
+            # Riallinea l'indice della ricerca globale per la riga modificata
+            search_index = GlobalSearchIndex(db, TABLE_NAME)
+            if FULLTEXT_SEARCH_ENABLED and search_index.exists():
+                try:
+                    search_index.refresh_rows([pk], filter_manager.column_names)
+                except Exception:
+                    traceback.print_exc() # L'indice verrà riallineato dalla prossima ricostruzione
+
             db.commit() # Commit sia dell'update che del log
+            invalidate_counts(TABLE_NAME)
+            invalidate_pages(TABLE_NAME, [pk], [field])
+            apply_committed_cells(db, [(pk, field, value)])
             return JSONResponse({"status": "success", "message": "Record aggiornato e loggato con successo."})
 
         except Exception as log_e:
@@ -440,55 +1094,213 @@ async def update_gestione_gs_data(request: Request, db: Session = Depends(get_db
         raise HTTPException(status_code=500, detail=f"Errore durante l'aggiornamento del record: {str(e)}")
 
 
+@router.post("/api/servizi/ge/update")
+async def update_gestione_gs_data(request: Request, db: Session = Depends(get_db)):
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Payload JSON malformato per l'aggiornamento.")
+
+    return await run_db(_update_record, request, db, data)
+
+# Numero massimo di celle per una singola richiesta di aggiornamento multiplo
+BATCH_UPDATE_MAX = int(os.getenv("GE_BATCH_UPDATE_MAX", "1000"))
+
+def _cell_error(index: int, change: Any, code: int, message: str) -> Dict[str, Any]:
+    change = change if isinstance(change, dict) else {}
+    return {"index": index, "pk": change.get('pk'), "field": change.get('field'),
+            "status": "error", "code": code, "error": message}
+
+def _update_records_batch(request: Request, db: Session, changes: List[Dict[str, Any]]) -> JSONResponse:
+    """
+    Aggiornamento di più celle in un'unica transazione:
+    una SELECT per i valori originali, convalida su elenchi e permessi in cache,
+    un UPDATE executemany per colonna, inserimento del log in blocco e un solo commit.
+    """
+    ruolo_id = session_role(request)
+    if not ruolo_id:
+        raise HTTPException(status_code=401, detail="Utente non autenticato.")
+    permessi = get_role_permissions(db, ruolo_id)
+    filter_manager = FilterManager(db, TABLE_NAME)
+    column_names = set(filter_manager.column_names)
+
+    results: List[Optional[Dict[str, Any]]] = [None] * len(changes)
+    valid = [] # (indice, pk, field, value)
+    for index, change in enumerate(changes):
+        if not isinstance(change, dict) or change.get('pk') is None or change.get('field') is None:
+            results[index] = _cell_error(index, change, 400, "Parametri 'pk' e 'field' sono obbligatori.")
+            continue
+        pk, field, value = change['pk'], change['field'], change.get('value')
+        if field not in column_names:
+            results[index] = _cell_error(index, change, 400, f"Campo '{field}' non valido.")
+        elif field not in permessi.editable_columns:
+            results[index] = _cell_error(index, change, 403, f"Il campo '{field}' non è modificabile per il tuo ruolo.")
+        else:
+            allowed = get_allowed_values(db, field)
+            if allowed is not None and str(value).strip() != '' and str(value).strip() not in allowed:
+                results[index] = _cell_error(index, change, 400, f"Valore '{value}' non ammesso per la colonna '{field}'.")
+            else:
+                valid.append((index, pk, field, value))
+
+    if valid:
+        try:
+            # Valori attuali di tutte le righe/colonne coinvolte in una sola query
+            fields = sorted({field for _, _, field, _ in valid})
+            pks = list({pk for _, pk, _, _ in valid})
+            # Le righe restano bloccate fino al commit: il confronto con old_value e l'UPDATE sono atomici
+            lock_sql = " FOR UPDATE" if db.bind.dialect.name == "mysql" else ""
+            select_query = text(
+                f"SELECT ID, {', '.join(f'`{f}`' for f in fields)} FROM `{TABLE_NAME}` WHERE ID IN :pks{lock_sql}"
+            ).bindparams(bindparam("pks", expanding=True))
+            current = {str(row[0]): dict(zip(fields, row[1:])) for row in db.execute(select_query, {"pks": pks})}
+
+            utente = session_user(request)
+            now = datetime.utcnow()
+            updates: Dict[str, Dict[str, Any]] = {} # colonna → {pk: valore finale}
+            log_rows = []
+            applied = []
+            for index, pk, field, value in valid:
+                row = current.get(str(pk))
+                if row is None:
+                    results[index] = _cell_error(index, changes[index], 404, "Record non trovato.")
+                    continue
+                old = row[field]
+                change = changes[index]
+                if 'old_value' in change and not _same_value(old, change['old_value']):
+                    conflict = _cell_error(index, change, 409, "Il valore è stato modificato da un altro utente.")
+                    conflict["current_value"] = jsonable_encoder(old)
+                    results[index] = conflict
+                    continue
+                # Più modifiche alla stessa cella: ognuna viene loggata, vale l'ultima
+                row[field] = value
+                updates.setdefault(field, {})[pk] = value
+                log_rows.append({
+                    "utente": utente,
+                    "campo_old": str(old) if old is not None else None,
+                    "campo_new": str(value) if value is not None else None,
+                    "data": now,
+                    "id_tabella": pk,
+                    "colonna": field,
+                })
+                applied.append(index)
+
+            for field, values in updates.items():
+                db.execute(
+                    text(f"UPDATE `{TABLE_NAME}` SET `{field}` = :value WHERE ID = :pk"),
+                    [{"value": value, "pk": pk} for pk, value in values.items()]
+                )
+            audit_log.record(db, log_rows)
+
+            search_index = GlobalSearchIndex(db, TABLE_NAME)
+            if applied and FULLTEXT_SEARCH_ENABLED and search_index.exists():
+                try:
+                    search_index.refresh_rows(list({changes[i]['pk'] for i in applied}), filter_manager.column_names)
+                except Exception:
+                    traceback.print_exc() # L'indice verrà riallineato dalla prossima ricostruzione
+
+            db.commit()
+            if applied:
+                invalidate_counts(TABLE_NAME)
+                invalidate_pages(TABLE_NAME, [changes[i]['pk'] for i in applied], list(updates))
+                apply_committed_cells(db, [(pk, field, value) for field, values in updates.items()
+                                            for pk, value in values.items()])
+            for index in applied:
+                results[index] = {"index": index, "pk": changes[index]['pk'], "field": changes[index]['field'],
+                                  "status": "success"}
+        except Exception as e:
+            db.rollback()
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail=f"Errore durante l'aggiornamento multiplo, nessuna modifica applicata: {str(e)}")
+
+    updated = sum(1 for r in results if r["status"] == "success")
+    failed = len(results) - updated
+    status = "success" if not failed else ("partial" if updated else "error")
+    return JSONResponse({"status": status, "updated": updated, "failed": failed, "results": results})
+
+@router.post("/api/servizi/ge/update/batch")
+async def update_gestione_gs_data_batch(request: Request, db: Session = Depends(get_db)):
+    """
+    Aggiornamento di più celle (es. incolla su una colonna): {"changes": [{"pk", "field", "value"}, ...]}.
+    Con "old_value" la cella viene aggiornata solo se ha ancora quel valore (altrimenti esito 409).
+    """
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Payload JSON malformato per l'aggiornamento.")
+    changes = data.get('changes') if isinstance(data, dict) else None
+    if not isinstance(changes, list) or not changes:
+        raise HTTPException(status_code=400, detail="Il parametro 'changes' deve essere una lista non vuota.")
+    if len(changes) > BATCH_UPDATE_MAX:
+        raise HTTPException(status_code=400, detail=f"Massimo {BATCH_UPDATE_MAX} celle per richiesta.")
+
+    return await run_db(_update_records_batch, request, db, changes)
+
 @router.get("/api/servizi/ge/export")
-async def export_gestione_gs_data(
+def export_gestione_gs_data(
+    request: Request,
     month: str = Query(''),
     global_search: str = Query(''),
     column_filters: str = Query(''), # JSON string dei filtri per colonna
+    visible_columns: str = Query(''), # JSON string delle colonne visibili nella griglia
+    export_format: str = Query('xlsx', alias='format'), # xlsx, csv o parquet
     db: Session = Depends(get_db)
 ):
     try:
-        data_manager = DataManager(db, TABLE_NAME)
-        rows = data_manager.get_export_data(month, global_search, column_filters)
-
-        if not rows:
-            # Non è un errore, semplicemente non ci sono dati per i filtri
-            return JSONResponse(status_code=204) # No Content
-            # raise HTTPException(status_code=404, detail="Nessun dato trovato per l'esportazione con i filtri applicati.")
-
-        df = pd.DataFrame(rows)
-        output = io.BytesIO()
-
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name="Dati")
-            workbook = writer.book
-            worksheet = writer.sheets["Dati"]
-
-            header_format = workbook.add_format({
-                'bold': True, 'bg_color': '#F7DC6F', 'border': 1
-            })
-
-            for col_num, df_col_name in enumerate(df.columns.values): # Usa df.columns per consistenza
-                worksheet.write(0, col_num, df_col_name, header_format)
-
-            for i, column in enumerate(df.columns):
-                column_data = df[column].astype(str)
-                max_len = max(column_data.map(len).max(), len(column)) + 2
-                worksheet.set_column(i, i, max_len)
-
-        output.seek(0)
-        filename = f"gestione_servizi_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.xlsx"
-        return StreamingResponse(
-            output,
-            media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        export_format = check_export_format(export_format)
+    except ExportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        columns = column_projection(db, session_role(request), _requested_columns(visible_columns))
+        data_manager = DataManager(db, TABLE_NAME, columns)
+        rows = data_manager.get_export_rows(month, global_search, column_filters)
+        # Una risposta 204 indica che non ci sono dati per i filtri (non è un errore)
+        return export_response(
+            export_format, rows.columns, rows.batches(),
+            filename_base=f"gestione_servizi_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}",
+            sheet_name="Dati",
+            header_format={'bold': True, 'bg_color': '#F7DC6F', 'border': 1},
+            description=rows.description
         )
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Errore durante l'esportazione dei dati: {str(e)}")
 
+@router.post("/api/servizi/ge/export/jobs")
+async def create_gestione_gs_export_job(request: Request):
+    """Crea un'esportazione in background con gli stessi filtri di /api/servizi/ge/export."""
+    try:
+        params = await request.json()
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Payload JSON malformato.")
+    try:
+        export_format = check_export_format(params.get('format', 'xlsx'))
+    except ExportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    month = params.get('month', '')
+    global_search = params.get('global_search', '')
+    column_filters = params.get('column_filters', '')
+    if isinstance(column_filters, dict):
+        column_filters = json.dumps(column_filters)
+    ruolo_id = session_role(request)
+    requested_columns = _requested_columns(params.get('visible_columns'))
+
+    def prepare(db: Session) -> ExportSource:
+        data_manager = DataManager(db, TABLE_NAME, column_projection(db, ruolo_id, requested_columns))
+        where_sql, query_params = data_manager.build_export_where(month, global_search, column_filters)
+        total_estimate = data_manager.get_filtered_count(where_sql, query_params)
+        rows = QueryRows(db, data_manager.query_builder.build_export_query(where_sql), query_params)
+        return ExportSource(
+            columns=rows.columns, batches=rows.batches(), total_estimate=total_estimate,
+            file_options={'sheet_name': "Dati", 'header_format': {'bold': True, 'bg_color': '#F7DC6F', 'border': 1},
+                          'description': rows.description}
+        )
+
+    filename_base = f"gestione_servizi_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}"
+    return submit_export_job(request, export_format, filename_base, prepare)
+
 @router.get("/api/servizi/ge/unique_values")
-async def get_unique_column_values(
+def get_unique_column_values(
     column: str,
     month: str = Query(''),
     filters: str = Query(''), # JSON string dei filtri globali e per colonna
@@ -518,6 +1330,10 @@ async def get_unique_column_values(
             except json.JSONDecodeError:
                 raise HTTPException(status_code=400, detail="Formato filtri JSON non valido.")
 
+        values = dictionary_unique_values(db, filter_manager, column, month, search_value, column_searches)
+        if values is not None:
+            return JSONResponse(values)
+
         where_sql, query_params = filter_manager.build_where_clause(
             month_filter=month,
             search_value=search_value,
@@ -525,7 +1341,8 @@ async def get_unique_column_values(
         )
 
         query = query_builder.build_unique_values_query(column, where_sql)
-        result = db.execute(query, query_params).fetchall()
+        with record_query_shape(filter_manager, 'unique_values', [(column, 'asc')]):
+            result = db.execute(query, query_params).fetchall()
 
         values = []
         seen = set() # Per evitare duplicati post-elaborazione (es. trim)
@@ -550,20 +1367,8 @@ async def get_unique_column_values(
         raise HTTPException(status_code=500, detail=f"Errore nel recupero dei valori unici: {str(e)}")
 
 
-@router.post("/api/servizi/ge/unique_values") # Spesso usato per RTC o filtri complessi
-async def post_unique_column_values(request: Request, db: Session = Depends(get_db)):
-    # Questa route era specifica per 'RTC' nel codice originale, la generalizzo leggermente
-    # o si potrebbe dedicare a un campo specifico se necessario.
-    # Per ora, assumo che il client invii il nome della colonna nel payload.
-    try:
-        params = await request.json()
-        column_to_filter = params.get("column") # Il client deve specificare su quale colonna
-        if not column_to_filter:
-            raise HTTPException(status_code=400, detail="Il parametro 'column' è richiesto nel payload.")
-
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Payload JSON malformato.")
-
+def _post_unique_values(db: Session, params: Dict[str, Any], column_to_filter: str) -> JSONResponse:
+    """Valori distinti di una colonna con i filtri DataTables (lavoro sincrono sul DB)."""
     data_manager = DataManager(db, TABLE_NAME)
     filter_manager = data_manager.filter_manager
     query_builder = QueryBuilder(TABLE_NAME)
@@ -583,6 +1388,10 @@ async def post_unique_column_values(request: Request, db: Session = Depends(get_
                 if column_names[i] != column_to_filter:
                      column_searches[column_names[i]] = col_param['search']
 
+    values = dictionary_unique_values(db, filter_manager, column_to_filter, month_filter, search_value, column_searches)
+    if values is not None:
+        return JSONResponse(values)
+
     where_sql, query_params = filter_manager.build_where_clause(
         month_filter=month_filter,
         search_value=search_value,
@@ -591,7 +1400,8 @@ async def post_unique_column_values(request: Request, db: Session = Depends(get_
 
     try:
         query = query_builder.build_unique_values_query(column_to_filter, where_sql)
-        result = db.execute(query, query_params).fetchall()
+        with record_query_shape(filter_manager, 'unique_values', [(column_to_filter, 'asc')]):
+            result = db.execute(query, query_params).fetchall()
 
         values = []
         seen = set()
@@ -612,5 +1422,21 @@ async def post_unique_column_values(request: Request, db: Session = Depends(get_
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Errore nel recupero dei valori unici (POST): {str(e)}")
 
+@router.post("/api/servizi/ge/unique_values") # Spesso usato per RTC o filtri complessi
+async def post_unique_column_values(request: Request, db: Session = Depends(get_db)):
+    # Questa route era specifica per 'RTC' nel codice originale, la generalizzo leggermente
+    # o si potrebbe dedicare a un campo specifico se necessario.
+    # Per ora, assumo che il client invii il nome della colonna nel payload.
+    try:
+        params = await request.json()
+        column_to_filter = params.get("column") # Il client deve specificare su quale colonna
+        if not column_to_filter:
+            raise HTTPException(status_code=400, detail="Il parametro 'column' è richiesto nel payload.")
+
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Payload JSON malformato.")
+
+    return await run_db(_post_unique_values, db, params, column_to_filter)
+
 # Eventuali altre funzioni o classi di utilità specifiche per ordini_servizi_ge possono essere aggiunte qui.
 # Ad esempio, se ci fossero funzioni helper che erano in ordini_servizi.py ma usate solo da queste route.
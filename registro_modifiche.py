@@ -0,0 +1,295 @@
+"""
+Scrittura del log delle modifiche (carrefour_log) per la griglia GE.
+
+Due modalità, scelte con GE_AUDIT_LOG_MODE:
+  - sync (default): le righe di log vengono inserite in blocco nella stessa transazione dell'UPDATE;
+  - journal: subito prima del commit dell'UPDATE le righe vengono accodate (con fsync) a un journal
+    locale append-only; un thread in background le trasferisce in carrefour_log a blocchi.
+    All'avvio il journal rimasto da un'esecuzione precedente viene riprodotto.
+
+Il journal garantisce la consegna "almeno una volta": se il processo si interrompe tra
+l'inserimento in carrefour_log e la cancellazione del file, quel blocco viene reinserito.
+Dopo il commit le righe accodate vengono confermate da una riga di commit, se il commit fallisce
+annullate da una riga di rollback; il thread inserisce solo righe confermate e lascia nel journal
+quelle la cui transazione non è ancora conclusa. Se il processo si interrompe durante il commit,
+all'avvio successivo le righe senza esito vengono inserite (meglio un log in più che uno perso).
+Le righe illeggibili (es. l'ultima riga troncata da un crash) finiscono in `<file>.corrupt`
+e non bloccano il resto del journal.
+"""
+import glob
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+from database_config import SessionLocal
+from models.carrefour_log import CarrefourLog
+
+AUDIT_LOG_MODE = os.getenv("GE_AUDIT_LOG_MODE", "sync").strip().lower()
+AUDIT_JOURNAL_PATH = os.getenv("AUDIT_JOURNAL_PATH", os.path.join("journal", "carrefour_log.jsonl"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "2"))
+AUDIT_FLUSH_BATCH = int(os.getenv("AUDIT_FLUSH_BATCH", "500"))
+
+_PENDING_KEY = "audit_log_pending"
+_JOURNALED_KEY = "audit_log_journaled"
+_TX_FIELD = "__tx__"
+_ROLLBACK_FIELD = "__rollback__"
+_COMMIT_FIELD = "__commit__"
+
+
+class AuditJournal:
+    """Journal append-only su file, svuotato in carrefour_log a blocchi."""
+
+    def __init__(self, path: str = AUDIT_JOURNAL_PATH, batch_size: int = AUDIT_FLUSH_BATCH,
+                 session_factory: Callable[[], Session] = SessionLocal):
+        self.path = path
+        self.batch_size = batch_size
+        self.session_factory = session_factory
+        self._append_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def append(self, entries: Iterable[Dict[str, Any]], tx: Optional[str] = None) -> None:
+        """Accoda le righe; `tx` le lega a una transazione che può ancora essere annullata con `discard`."""
+        lines = "".join(json.dumps({**entry, _TX_FIELD: tx} if tx else entry, default=_to_json) + "\n"
+                        for entry in entries)
+        self._write(lines)
+
+    def confirm(self, tx: str) -> None:
+        """Conferma le righe accodate con `tx` (transazione salvata)."""
+        # Senza fsync: se la riga va persa in un crash, all'avvio le righe vengono inserite comunque
+        self._write(json.dumps({_COMMIT_FIELD: tx}) + "\n", sync=False)
+
+    def discard(self, tx: str) -> None:
+        """Annulla le righe accodate con `tx` (transazione non andata a buon fine)."""
+        self._write(json.dumps({_ROLLBACK_FIELD: tx}) + "\n")
+
+    def _write(self, lines: str, sync: bool = True) -> None:
+        if not lines:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._append_lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                f.flush()
+                if sync:
+                    os.fsync(f.fileno())
+
+    def _pending_files(self) -> List[str]:
+        return sorted(glob.glob(f"{self.path}.*.flushing"))
+
+    def flush(self, unresolved: bool = False) -> int:
+        """
+        Trasferisce in carrefour_log le righe confermate del journal; restituisce le righe inserite.
+        Le righe di transazioni senza esito restano nel journal, salvo con `unresolved` (avvio).
+        """
+        with self._flush_lock:
+            # Il journal corrente viene "congelato" con un rename: le nuove righe vanno in un file nuovo
+            with self._append_lock:
+                if os.path.exists(self.path) and os.path.getsize(self.path):
+                    os.replace(self.path, f"{self.path}.{time.time_ns()}.flushing")
+            paths = self._pending_files()
+            parsed = [self._read_file(path) for path in paths]
+            committed = set().union(*(confirmed for _, confirmed, _ in parsed))
+            rolled_back = set().union(*(discarded for _, _, discarded in parsed))
+            inserted = 0
+            for path, (entries, _, _) in zip(paths, parsed):
+                ready, waiting = [], []
+                for entry in entries:
+                    tx = entry.get(_TX_FIELD)
+                    if tx in rolled_back:
+                        continue
+                    (ready if unresolved or tx is None or tx in committed else waiting).append(entry)
+                inserted += self._flush_file(path, ready, waiting)
+            return inserted
+
+    def _read_file(self, path: str):
+        """Righe del file, transazioni confermate e annullate; le righe illeggibili vanno in `<file>.corrupt`."""
+        entries, confirmed, discarded, corrupt = [], set(), set(), []
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    corrupt.append(line if line.endswith("\n") else line + "\n")
+                    continue
+                if _ROLLBACK_FIELD in entry:
+                    discarded.add(entry[_ROLLBACK_FIELD])
+                elif _COMMIT_FIELD in entry:
+                    confirmed.add(entry[_COMMIT_FIELD])
+                else:
+                    entries.append(_from_json(entry))
+        if corrupt:
+            print(f"[AUDIT] {len(corrupt)} righe illeggibili di {path} spostate in {self.path}.corrupt")
+            with open(f"{self.path}.corrupt", "a", encoding="utf-8") as f:
+                f.writelines(corrupt)
+        return entries, confirmed, discarded
+
+    def _flush_file(self, path: str, entries: List[Dict[str, Any]], waiting: List[Dict[str, Any]]) -> int:
+        """Inserisce `entries`; il file resta con le sole righe `waiting`, in attesa dell'esito."""
+        if entries:
+            self._insert(entries)
+        if waiting:
+            with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(entry, default=_to_json) + "\n" for entry in waiting)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f"{path}.tmp", path)
+        else:
+            os.remove(path)
+        return len(entries)
+
+    def _insert(self, entries: List[Dict[str, Any]]) -> None:
+        db = self.session_factory()
+        try:
+            iterator = ({key: value for key, value in entry.items() if key != _TX_FIELD} for entry in entries)
+            while True:
+                batch = list(islice(iterator, self.batch_size))
+                if not batch:
+                    break
+                db.execute(insert(CarrefourLog), batch)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise # Il file resta e verrà riprovato al prossimo flush
+        finally:
+            db.close()
+
+    def pending_count(self) -> int:
+        count = 0
+        for path in [self.path] + self._pending_files():
+            if os.path.exists(path):
+                with open(path, encoding="utf-8", errors="replace") as f:
+                    count += sum(1 for line in f if line.strip() and _ROLLBACK_FIELD not in line
+                                 and _COMMIT_FIELD not in line)
+        return count
+
+    def start(self, interval: float = AUDIT_FLUSH_INTERVAL) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.flush()
+                except Exception:
+                    traceback.print_exc()
+
+        self._thread = threading.Thread(target=loop, name="audit-journal", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    return str(value)
+
+
+def _from_json(entry: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        key: datetime.fromisoformat(value["__datetime__"]) if isinstance(value, dict) and "__datetime__" in value else value
+        for key, value in entry.items()
+    }
+
+
+class AuditLogWriter:
+    """Punto unico di scrittura del log modifiche, nella modalità configurata."""
+
+    def __init__(self, mode: str = AUDIT_LOG_MODE, journal: Optional[AuditJournal] = None):
+        if mode not in ("sync", "journal"):
+            raise ValueError(f"GE_AUDIT_LOG_MODE non valido: {mode}")
+        self.mode = mode
+        self.journal = journal or AuditJournal()
+
+    def record(self, db: Session, entries: List[Dict[str, Any]]) -> None:
+        """
+        Registra le righe di log per la transazione corrente di `db`.
+        In modalità journal vengono accodate al journal al commit e annullate se il commit fallisce.
+        """
+        if not entries:
+            return
+        if self.mode == "sync":
+            db.execute(insert(CarrefourLog), entries)
+        else:
+            if not db.in_transaction():
+                db.begin() # Le righe restano legate alla transazione che le ha prodotte
+            db.info.setdefault(_PENDING_KEY, []).append((self, entries))
+
+    def start(self) -> None:
+        """Riproduce il journal rimasto dall'esecuzione precedente e avvia il thread di flush."""
+        if self.mode != "journal":
+            return
+        try:
+            # Le transazioni senza esito appartengono all'esecuzione precedente, interrotta
+            self.journal.flush(unresolved=True)
+        except Exception:
+            traceback.print_exc() # Il journal resta su disco e verrà ritentato dal thread
+        self.journal.start()
+
+    def stop(self) -> None:
+        if self.mode != "journal":
+            return
+        self.journal.stop()
+        try:
+            self.journal.flush()
+        except Exception:
+            traceback.print_exc()
+
+
+@event.listens_for(Session, "before_commit")
+def _append_pending_before_commit(session: Session) -> None:
+    # Il journal è scritto prima del commit: un crash tra commit e scrittura non perde il log
+    for writer, entries in session.info.pop(_PENDING_KEY, []):
+        tx = uuid.uuid4().hex
+        try:
+            writer.journal.append(entries, tx=tx)
+        except Exception:
+            # Journal non scrivibile: il log viene inserito nella stessa transazione, come in modalità sync
+            traceback.print_exc()
+            session.execute(insert(CarrefourLog), entries)
+            continue
+        session.info.setdefault(_JOURNALED_KEY, []).append((writer, tx))
+
+
+@event.listens_for(Session, "after_commit")
+def _confirm_journaled_after_commit(session: Session) -> None:
+    for writer, tx in session.info.pop(_JOURNALED_KEY, []):
+        try:
+            writer.journal.confirm(tx)
+        except Exception:
+            traceback.print_exc() # Le righe restano nel journal e vengono inserite al prossimo avvio
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_pending_after_rollback(session: Session, transaction) -> None:
+    # Dopo un commit le liste sono già state svuotate: se resta qualcosa la transazione è stata annullata
+    if transaction.parent is None:
+        session.info.pop(_PENDING_KEY, None)
+        for writer, tx in session.info.pop(_JOURNALED_KEY, []):
+            try:
+                writer.journal.discard(tx)
+            except Exception:
+                traceback.print_exc()
+
+
+audit_log = AuditLogWriter()
+
+
+__all__ = ['AuditJournal', 'AuditLogWriter', 'audit_log', 'AUDIT_LOG_MODE']
@@ -0,0 +1,360 @@
+"""
+Replica in memoria, a colonne, della tabella della griglia GE (opzionale, GE_REPLICA=1).
+
+La griglia è quasi solo lettura: centinaia di richieste di filtro/ordinamento/pagina per
+ogni modifica. Con la replica attiva DataManager serve /data senza interrogare il database:
+  - ogni colonna è tenuta come array NumPy dei valori originali (restituiti tali e quali)
+    più la forma normalizzata UPPER(TRIM(...)) usata dai filtri; le colonne con pochi valori
+    distinti sono codificate come pandas.Categorical e i filtri testuali vengono valutati
+    una volta per categoria;
+  - i filtri hanno la stessa semantica di FilterManager (parse_column_filter) e diventano
+    maschere vettoriali; la ricerca globale è il LIKE '%testo%' su tutte le colonne;
+  - l'ordinamento usa np.lexsort su ranghi interi calcolati una volta per colonna
+    (NULL primi in ordine crescente, come in MySQL).
+
+Freschezza: le modifiche fatte da /update e /update/batch vengono applicate subito; un thread
+rilegge ogni REPLICA_REFRESH secondi le righe comparse in carrefour_log dall'ultimo controllo
+(per id del log, non per data: in modalità journal le righe arrivano in ritardo con la data
+originale) e ricarica tutto se cambiano numero di righe o ID massimo, o dopo REPLICA_FULL_RELOAD secondi.
+
+Concorrenza: ReplicaData non viene mai modificata dopo la pubblicazione; ogni modifica crea una
+nuova istantanea (copiando solo le colonne toccate) e la sostituisce sotto lock. Le letture
+prendono l'istantanea corrente senza lock e non si bloccano a vicenda.
+"""
+import copy
+import os
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import Session
+
+from cache import engine_key
+from database_config import SessionLocal
+
+REPLICA_ENABLED = os.getenv("GE_REPLICA", "0").strip().lower() in ("1", "true", "yes")
+REPLICA_REFRESH = float(os.getenv("GE_REPLICA_REFRESH", "30"))
+REPLICA_FULL_RELOAD = float(os.getenv("GE_REPLICA_FULL_RELOAD", "3600"))
+# Colonne con al massimo tanti valori distinti sono codificate come Categorical
+REPLICA_CATEGORY_MAX = int(os.getenv("GE_REPLICA_CATEGORY_MAX", "2000"))
+
+_SEPARATOR = "\x1f" # Tra le colonne nel testo della ricerca globale: non compare nei valori cercati
+
+
+def _normalize(value: Any) -> str:
+    return "" if value is None else str(value).strip().upper()
+
+
+class ReplicaData:
+    """Contenuto della replica: valori originali, normalizzati e strutture derivate (calcolate su richiesta)."""
+
+    def __init__(self, columns: List[str], rows: List[tuple], pk_column: str, category_max: int):
+        self.columns = columns
+        self.pk_column = pk_column
+        self.size = len(rows)
+        self.raw: Dict[str, np.ndarray] = {}
+        self.norm: Dict[str, Any] = {}
+        for i, column in enumerate(columns):
+            raw = np.empty(self.size, dtype=object)
+            raw[:] = [row[i] for row in rows]
+            self.raw[column] = raw
+            norm = np.array([_normalize(value) for value in raw], dtype=object)
+            categorical = pd.Categorical(norm)
+            self.norm[column] = categorical if len(categorical.categories) <= category_max else norm
+        pks = self.raw[pk_column]
+        self.positions = {pk: position for position, pk in enumerate(pks)}
+        self.max_pk = max(pks) if self.size else None
+        # Strutture derivate calcolate alla prima lettura: idempotenti, condivise dalle letture concorrenti
+        self.typed: Dict[str, np.ndarray] = {}
+        self.ranks: Dict[str, np.ndarray] = {}
+        self.search_cache: Optional[Tuple[List[str], np.ndarray]] = None # (colonne, testo per riga)
+
+    # --- maschere ---
+
+    def text_mask(self, column: str, predicate: Callable[[pd.Series], Any]) -> np.ndarray:
+        """Maschera di un predicato sulle stringhe normalizzate (per le Categorical: una volta per categoria)."""
+        values = self.norm[column]
+        if isinstance(values, pd.Categorical):
+            categories = np.asarray(predicate(pd.Series(values.categories, dtype=object)), dtype=bool)
+            codes = values.codes
+            if not len(categories):
+                return np.zeros(self.size, dtype=bool)
+            return np.where(codes >= 0, categories[np.maximum(codes, 0)], False)
+        return np.asarray(predicate(pd.Series(values, dtype=object)), dtype=bool)
+
+    def typed_values(self, column: str, kind: str) -> np.ndarray:
+        values = self.typed.get(column)
+        if values is None:
+            series = pd.Series(self.raw[column], dtype=object)
+            if kind == 'number':
+                values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=float)
+            else:
+                values = pd.to_datetime(series, errors='coerce', format='mixed').to_numpy()
+            self.typed[column] = values
+        return values
+
+    def rank(self, column: str, kind: str) -> np.ndarray:
+        """Rango intero della colonna per l'ordinamento; i NULL hanno -1 (primi in ordine crescente)."""
+        ranks = self.ranks.get(column)
+        if ranks is None:
+            if kind == 'text':
+                values = np.asarray(self.norm[column], dtype=object)
+                ranks, _ = pd.factorize(values, sort=True)
+                ranks[pd.isna(pd.Series(self.raw[column], dtype=object)).to_numpy()] = -1
+            else:
+                ranks, _ = pd.factorize(self.typed_values(column, kind), sort=True)
+            self.ranks[column] = ranks = ranks.astype(np.int64)
+        return ranks
+
+    def global_search_text(self, columns: List[str]) -> np.ndarray:
+        """Testo normalizzato delle colonne cercate dalla ricerca globale, una stringa per riga."""
+        columns = [column for column in columns if column in self.norm]
+        cached = self.search_cache
+        if cached is None or cached[0] != columns:
+            values = [np.asarray(self.norm[column], dtype=object) for column in columns]
+            search_text = np.array([_SEPARATOR.join(row) for row in zip(*values)], dtype=object) \
+                if values and self.size else np.full(self.size, '', dtype=object)
+            self.search_cache = cached = (columns, search_text) # Un solo assegnamento: coppia sempre coerente
+        return cached[1]
+
+    # --- modifiche ---
+
+    def with_changes(self, changes: Dict[int, Dict[str, Any]]) -> "ReplicaData":
+        """Nuova istantanea con le celle {posizione: {colonna: valore}}; le colonne non toccate sono condivise."""
+        clone = copy.copy(self)
+        changed = {column for values in changes.values() for column in values}
+        clone.raw, clone.norm = dict(self.raw), dict(self.norm)
+        for column in changed:
+            clone.raw[column] = self.raw[column].copy()
+            norm = self.norm[column]
+            if isinstance(norm, pd.Categorical):
+                keys = sorted({_normalize(values[column]) for values in changes.values() if column in values})
+                new_keys = [key for key in keys if key not in norm.categories]
+                norm = norm.add_categories(new_keys) if new_keys else norm.copy()
+            else:
+                norm = norm.copy()
+            clone.norm[column] = norm
+        for position, values in changes.items():
+            for column, value in values.items():
+                clone.raw[column][position] = value
+                clone.norm[column][position] = _normalize(value)
+        # dict() copia in un colpo solo: le letture possono aggiungere voci all'originale nel frattempo
+        clone.typed, clone.ranks = dict(self.typed), dict(self.ranks)
+        for column in changed:
+            clone.typed.pop(column, None)
+            clone.ranks.pop(column, None)
+        cached = self.search_cache
+        if cached is not None and changed & set(cached[0]):
+            search_text = cached[1].copy()
+            for position in changes:
+                search_text[position] = _SEPARATOR.join(str(clone.norm[c][position]) for c in cached[0])
+            clone.search_cache = (cached[0], search_text)
+        return clone
+
+
+class ColumnarReplica:
+    def __init__(self, table_name: str, session_factory: Callable[[], Session] = SessionLocal,
+                 pk_column: str = "ID", log_table: str = "carrefour_log", enabled: bool = REPLICA_ENABLED,
+                 category_max: int = REPLICA_CATEGORY_MAX):
+        self.table_name = table_name
+        self.session_factory = session_factory
+        self.pk_column = pk_column
+        self.log_table = log_table
+        self.enabled = enabled
+        self.category_max = category_max
+        self.data: Optional[ReplicaData] = None
+        self.engine_key = None
+        self.loaded_at = 0.0
+        self.log_watermark = None
+        self.needs_reload = False
+        self._lock = threading.RLock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.reads = 0
+        self.full_loads = 0
+        self.delta_rows = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.enabled and self.data is not None
+
+    def serves(self, bind) -> bool:
+        """True se la replica è pronta ed è stata caricata dallo stesso database della richiesta."""
+        return self.ready and self.engine_key == engine_key(bind)
+
+    # --- caricamento ---
+
+    def load(self, db: Session) -> None:
+        watermark = self._log_watermark(db)
+        result = db.execute(text(f"SELECT * FROM `{self.table_name}` ORDER BY `{self.pk_column}`"))
+        columns = list(result.keys())
+        data = ReplicaData(columns, [tuple(row) for row in result], self.pk_column, self.category_max)
+        with self._lock:
+            self.data = data
+            self.engine_key = engine_key(db.get_bind())
+            self.loaded_at = time.monotonic()
+            self.log_watermark = watermark
+            self.needs_reload = False
+            self.full_loads += 1
+
+    def _log_watermark(self, db: Session):
+        # Per id: le righe scritte dal journal hanno la data della modifica ma un id successivo
+        try:
+            return db.execute(text(f"SELECT COALESCE(MAX(`id`), 0) FROM `{self.log_table}`")).scalar()
+        except Exception:
+            db.rollback()
+            return None # Senza log delle modifiche restano le ricariche complete
+
+    def refresh(self) -> None:
+        """Applica le righe modificate secondo il log; ricarica tutto se la tabella è cambiata altrimenti."""
+        db = self.session_factory()
+        try:
+            data = self.data
+            if data is None or self.needs_reload or time.monotonic() - self.loaded_at > REPLICA_FULL_RELOAD:
+                self.load(db)
+                return
+            count, max_pk = db.execute(
+                text(f"SELECT COUNT(*), MAX(`{self.pk_column}`) FROM `{self.table_name}`")
+            ).one()
+            if count != data.size or max_pk != data.max_pk:
+                self.load(db) # Righe inserite o cancellate fuori dalla griglia
+                return
+            if self.log_watermark is None:
+                return
+            changed = db.execute(
+                text(f"SELECT `id_tabella`, `id` FROM `{self.log_table}` WHERE `id` > :since"),
+                {"since": self.log_watermark}
+            ).fetchall()
+            if not changed:
+                return
+            pks = list({row[0] for row in changed})
+            rows = db.execute(
+                text(f"SELECT * FROM `{self.table_name}` WHERE `{self.pk_column}` IN :pks")
+                .bindparams(bindparam("pks", expanding=True)),
+                {"pks": pks}
+            )
+            columns = list(rows.keys())
+            self.apply_rows([(values[self.pk_column], values) for values in (dict(zip(columns, row)) for row in rows)])
+            self.log_watermark = max(row[1] for row in changed)
+            self.delta_rows += len(pks)
+        finally:
+            db.close()
+
+    def apply_rows(self, rows: List[Tuple[Any, Dict[str, Any]]]) -> None:
+        """Applica le righe (pk, {colonna: valore}) pubblicando una nuova istantanea."""
+        with self._lock: # Solo tra scrittori: le letture usano l'istantanea che avevano preso
+            data = self.data
+            if data is None:
+                return
+            changes: Dict[int, Dict[str, Any]] = {}
+            for pk, values in rows:
+                position = data.positions.get(pk)
+                if position is None:
+                    self.needs_reload = True
+                    continue
+                changes.setdefault(position, {}).update(
+                    (column, value) for column, value in values.items()
+                    if column in data.raw and column != self.pk_column)
+            changes = {position: values for position, values in changes.items() if values}
+            if changes:
+                self.data = data.with_changes(changes)
+
+    def apply_update(self, pk: Any, column: str, value: Any) -> None:
+        """Modifica di una cella appena salvata sul database."""
+        data = self.data
+        if data is None:
+            return
+        if pk not in data.positions and isinstance(pk, str) and pk.strip().lstrip('-').isdigit():
+            pk = int(pk) # PK numerica arrivata come testo dal client
+        self.apply_rows([(pk, {column: value})])
+
+    def start(self, interval: float = REPLICA_REFRESH) -> None:
+        """Primo caricamento e aggiornamento periodico in un thread in background."""
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+
+        def loop():
+            while True:
+                try:
+                    self.refresh()
+                except Exception:
+                    traceback.print_exc() # La griglia continua a leggere dal database finché la replica non è pronta
+                if self._stop.wait(interval):
+                    break
+
+        self._thread = threading.Thread(target=loop, name="ge-replica", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    # --- lettura ---
+
+    def _column_mask(self, data: ReplicaData, filter_manager, column: str, search_obj: Any) -> np.ndarray:
+        val = search_obj.get('value') if isinstance(search_obj, dict) else search_obj
+        is_regex = search_obj.get('regex', False) if isinstance(search_obj, dict) else False
+        mode, operand, kind = filter_manager.parse_column_filter(column, str(val), is_regex)
+        if mode == 'typed':
+            values = data.typed_values(column, kind)
+            mask = np.ones(data.size, dtype=bool)
+            for op, bound in operand:
+                bound = float(bound) if kind == 'number' else np.datetime64(pd.Timestamp(bound))
+                with np.errstate(invalid='ignore'):
+                    mask &= {'>=': np.greater_equal, '<=': np.less_equal, '>': np.greater,
+                             '<': np.less, '=': np.equal}[op](values, bound)
+            return mask
+        target = operand.upper()
+        if mode == 'exact':
+            return data.text_mask(column, lambda s: s == target)
+        if mode == 'prefix':
+            return data.text_mask(column, lambda s: s.str.startswith(target))
+        return data.text_mask(column, lambda s: s.str.contains(target, regex=False))
+
+    def page(self, filter_manager, draw: Any, start: int, length: int, orderings,
+             month_filter: Optional[str], search_value: Optional[str], column_searches: Dict[str, Any],
+             columns: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Stessa risposta di DataManager.get_filtered_data, calcolata sulla replica."""
+        data = self.data # Istantanea immutabile: nessun lock, le modifiche ne pubblicano una nuova
+        mask = np.ones(data.size, dtype=bool)
+        if month_filter and month_filter.strip().upper() != 'TUTTO' and 'MesePresentazione' in data.norm:
+            month = month_filter.strip().upper()
+            mask &= data.text_mask('MesePresentazione', lambda s: s == month)
+        if search_value:
+            needle = search_value.upper()
+            search_text = pd.Series(data.global_search_text(filter_manager.column_names), dtype=object)
+            mask &= search_text.str.contains(needle, regex=False).to_numpy(dtype=bool)
+        for column, search_obj in column_searches.items():
+            if column in data.norm:
+                mask &= self._column_mask(data, filter_manager, column, search_obj)
+
+        selected = np.flatnonzero(mask)
+        if orderings and len(selected):
+            keys = []
+            for column, direction in reversed(orderings):
+                rank = data.rank(column, filter_manager._column_kind(column))[selected]
+                keys.append(rank if direction.lower() == 'asc' else -rank)
+            selected = selected[np.lexsort(keys)] # Stabile: a parità resta l'ordine per ID
+        page = selected[start:] if length == -1 else selected[start:start + length]
+        out_columns = [c for c in (columns or data.columns) if c in data.raw]
+        rows = [{c: data.raw[c][i] for c in out_columns} for i in page]
+        self.reads += 1
+        return {"draw": draw, "recordsTotal": data.size, "recordsFiltered": int(len(selected)), "data": rows}
+
+    def stats(self) -> Dict[str, Any]:
+        data = self.data
+        return {
+            "enabled": self.enabled,
+            "size": data.size if data else 0,
+            "categorical_columns": sum(isinstance(v, pd.Categorical) for v in data.norm.values()) if data else 0,
+            "reads": self.reads,
+            "full_loads": self.full_loads,
+            "delta_rows": self.delta_rows,
+        }
+
+
+__all__ = ['ColumnarReplica', 'REPLICA_ENABLED']
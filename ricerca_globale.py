@@ -0,0 +1,244 @@
+"""
+Indice full-text per la ricerca globale della griglia GE.
+
+La ricerca globale di DataTables veniva tradotta in un LIKE '%x%' su ogni colonna
+(scansione completa con CAST riga per riga). Qui si mantiene una tabella di
+supporto `<tabella>_ricerca` con una colonna di testo concatenato indicizzata:
+  - MySQL: tabella InnoDB con indice FULLTEXT, interrogata con MATCH ... AGAINST
+  - SQLite (test): tabella virtuale FTS5 con rowid = ID
+
+Se l'indice non esiste, non è allineato alla tabella (numero di righe o ID massimo diversi,
+es. righe inserite fuori dalla griglia) o i termini cercati sono troppo corti per l'indice,
+compile_match() restituisce None e FilterManager torna al LIKE tradizionale.
+Le modifiche fatte fuori dalla griglia non cambiano righe né ID massimo: l'indice ricorda
+l'id di carrefour_log a cui è allineato (tabella `<tabella>_ricerca_stato`) e al controllo
+reindicizza le righe comparse nel log da allora. Le modifiche non registrate nel log
+richiedono la ricostruzione.
+
+Attenzione: l'indice cerca per inizio di parola ("tori" trova "Torino", "orin" no),
+mentre il LIKE cerca la sottostringa ovunque.
+
+Uso da riga di comando per (ri)costruire l'indice:
+    python ricerca_globale.py
+"""
+import logging
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, inspect, text
+from sqlalchemy.orm import Session
+
+from cache import TTLCache, TABLE_METADATA_TTL, engine_key, get_table_metadata
+from chiave_mese import MONTH_KEY_COLUMN
+
+# Abilita/disabilita la ricerca indicizzata senza toccare il codice
+FULLTEXT_SEARCH_ENABLED = os.getenv("GE_FULLTEXT_SEARCH", "1").strip().lower() not in ("0", "false", "no")
+# innodb_ft_min_token_size di default è 3: termini più corti non sono nell'indice MySQL
+MYSQL_MIN_TOKEN_LEN = int(os.getenv("FULLTEXT_MIN_TOKEN_LEN", "3"))
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Ogni quanti secondi confrontare tabella e indice (righe, ID massimo, log delle modifiche)
+SYNC_CHECK_TTL = float(os.getenv("GE_FULLTEXT_SYNC_TTL", "60"))
+
+# Esistenza della tabella indice, per non interrogare information_schema ad ogni ricerca
+_availability_cache = TTLCache(ttl=TABLE_METADATA_TTL)
+# Allineamento dell'indice alla tabella sorgente
+_sync_cache = TTLCache(ttl=SYNC_CHECK_TTL)
+
+logger = logging.getLogger(__name__)
+
+
+class GlobalSearchIndex:
+    def __init__(self, db, table_name: str, pk_column: str = "ID", log_table: str = "carrefour_log"):
+        self.db = db
+        self.table_name = table_name
+        self.pk_column = pk_column
+        self.log_table = log_table
+        self.index_table = f"{table_name}_ricerca"
+        # id di log_table a cui l'indice è allineato
+        self.state_table = f"{table_name}_ricerca_stato"
+
+    @property
+    def bind(self):
+        return getattr(self.db, "bind", None) or getattr(self.db, "engine", None)
+
+    @property
+    def dialect(self) -> str:
+        return self.bind.dialect.name
+
+    @property
+    def min_token_len(self) -> int:
+        return MYSQL_MIN_TOKEN_LEN if self.dialect == "mysql" else 1
+
+    @property
+    def _index_pk(self) -> str:
+        return "`ID`" if self.dialect == "mysql" else "rowid"
+
+    def _has_table(self, table_name: str) -> bool:
+        # Ispeziona sulla connessione della sessione, senza aprirne una nuova
+        connection = self.db.connection() if isinstance(self.db, Session) else self.db
+        return inspect(connection).has_table(table_name)
+
+    def exists(self) -> bool:
+        """
+        True se la tabella indice esiste, senza controllarne l'allineamento: è il controllo degli
+        aggiornamenti, che non devono avviare il riallineamento mentre tengono bloccate le righe.
+        """
+        try:
+            key = (engine_key(self.bind), self.index_table)
+            available = _availability_cache.get(key)
+            if available is None:
+                available = self._has_table(self.index_table)
+                _availability_cache.set(key, available)
+            return available
+        except Exception:
+            return False
+
+    def is_available(self) -> bool:
+        """True se l'indice esiste ed è allineato alla tabella (controllo ripetuto ogni SYNC_CHECK_TTL)."""
+        try:
+            return self.exists() and _sync_cache.get_or_load((engine_key(self.bind), self.index_table),
+                                                             self.is_in_sync)
+        except Exception:
+            return False
+
+    def is_in_sync(self) -> bool:
+        """
+        True se l'indice ha le stesse righe della tabella (numero e ID massimo) e le modifiche
+        registrate nel log dopo l'ultimo allineamento sono state reindicizzate.
+        La griglia lo tiene allineato con refresh_rows; righe inserite o cancellate per altre vie
+        lo rendono non affidabile finché non viene ricostruito.
+        """
+        source = self.db.execute(text(
+            f"SELECT COUNT(*), MAX(`{self.pk_column}`) FROM `{self.table_name}`")).fetchone()
+        indexed = self.db.execute(text(
+            f"SELECT COUNT(*), MAX({self._index_pk}) FROM `{self.index_table}`")).fetchone()
+        if tuple(source) != tuple(indexed):
+            logger.warning("Indice %s non allineato a %s (righe/ID massimo %s invece di %s): ricerca con LIKE. "
+                           "Ricostruirlo con: python ricerca_globale.py",
+                           self.index_table, self.table_name, tuple(indexed), tuple(source))
+            return False
+        return self._catch_up_with_log()
+
+    def _log_high_water(self) -> Optional[int]:
+        """Ultimo id del log delle modifiche; None se il log non esiste."""
+        if not self._has_table(self.log_table):
+            return None
+        return self.db.execute(text(f"SELECT COALESCE(MAX(`id`), 0) FROM `{self.log_table}`")).scalar()
+
+    def _catch_up_with_log(self) -> bool:
+        """Reindicizza le righe comparse nel log dopo l'ultimo allineamento; False se non è possibile."""
+        latest = self._log_high_water()
+        if latest is None:
+            return True # Senza log restano visibili solo inserimenti e cancellazioni
+        mark = (self.db.execute(text(f"SELECT MAX(`log_id`) FROM `{self.state_table}`")).scalar()
+                if self._has_table(self.state_table) else None)
+        if mark is None:
+            logger.warning("Indice %s senza allineamento a %s: ricerca con LIKE. "
+                           "Ricostruirlo con: python ricerca_globale.py", self.index_table, self.log_table)
+            return False
+        if latest <= mark:
+            return True
+        pks = [row[0] for row in self.db.execute(
+            text(f"SELECT DISTINCT `id_tabella` FROM `{self.log_table}` WHERE `id` > :mark AND `id` <= :latest"),
+            {"mark": mark, "latest": latest}) if row[0] is not None]
+        # Le richieste di lettura non fanno commit: la reindicizzazione ha una transazione propria
+        try:
+            with Session(bind=self.bind) as session, session.begin():
+                index = GlobalSearchIndex(session, self.table_name, self.pk_column, self.log_table)
+                index.refresh_rows(pks, self._indexed_columns())
+                session.execute(text(f"UPDATE `{self.state_table}` SET `log_id` = :latest WHERE `log_id` < :latest"),
+                                {"latest": latest})
+        except Exception:
+            logger.warning("Riallineamento dell'indice %s al log non riuscito: ricerca con LIKE.",
+                           self.index_table, exc_info=True)
+            return False
+        return True
+
+    def _indexed_columns(self) -> List[str]:
+        # Come grid_columns di ordini_servizi_ge: la chiave interna del mese non è nel testo indicizzato
+        return [col for col in get_table_metadata(self.bind, self.table_name).column_names
+                if col != MONTH_KEY_COLUMN]
+
+    def tokenize(self, search_value: str) -> List[str]:
+        return _TOKEN_RE.findall(search_value or "")
+
+    def compile_match(self, search_value: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Traduce la ricerca globale in un lookup sull'indice, o None se non applicabile."""
+        tokens = self.tokenize(search_value)
+        if not tokens or any(len(tok) < self.min_token_len for tok in tokens):
+            return None
+        if not self.is_available():
+            return None
+        if self.dialect == "mysql":
+            # Modalità booleana: ogni termine obbligatorio, ricerca per inizio di parola
+            fts_query = " ".join(f"+{tok}*" for tok in tokens)
+            clause = (f"`{self.pk_column}` IN (SELECT `ID` FROM `{self.index_table}` "
+                      f"WHERE MATCH(`search_text`) AGAINST (:fts_query IN BOOLEAN MODE))")
+        else:
+            fts_query = " ".join(f'"{tok}"*' for tok in tokens)
+            clause = (f"`{self.pk_column}` IN (SELECT rowid FROM `{self.index_table}` "
+                      f"WHERE `{self.index_table}` MATCH :fts_query)")
+        return clause, {"fts_query": fts_query}
+
+    def _concat_expr(self, column_names: Iterable[str]) -> str:
+        if self.dialect == "mysql":
+            return "CONCAT_WS(' ', " + ", ".join(f"CAST(`{col}` AS CHAR)" for col in column_names) + ")"
+        return " || ' ' || ".join(f"COALESCE(CAST(`{col}` AS TEXT), '')" for col in column_names)
+
+    def _insert_sql(self, column_names: Iterable[str], where_sql: str = "") -> str:
+        return (f"INSERT INTO `{self.index_table}` ({self._index_pk}, `search_text`) "
+                f"SELECT `{self.pk_column}`, {self._concat_expr(column_names)} "
+                f"FROM `{self.table_name}`{where_sql}")
+
+    def create(self) -> None:
+        if self.dialect == "mysql":
+            ddl = (f"CREATE TABLE IF NOT EXISTS `{self.index_table}` ("
+                   f"`ID` INT NOT NULL PRIMARY KEY, `search_text` LONGTEXT, "
+                   f"FULLTEXT KEY `ft_search_text` (`search_text`)) ENGINE=InnoDB")
+        else:
+            ddl = f"CREATE VIRTUAL TABLE IF NOT EXISTS `{self.index_table}` USING fts5(search_text)"
+        self.db.execute(text(ddl))
+        self.db.execute(text(f"CREATE TABLE IF NOT EXISTS `{self.state_table}` (`log_id` BIGINT NOT NULL)"))
+        _availability_cache.invalidate((engine_key(self.bind), self.index_table))
+        _sync_cache.invalidate((engine_key(self.bind), self.index_table))
+
+    def rebuild(self, column_names: Iterable[str]) -> None:
+        """Crea l'indice se manca e lo ripopola interamente dalla tabella sorgente."""
+        column_names = [col for col in column_names if col != self.pk_column]
+        self.create()
+        # Letto prima di ripopolare: le modifiche registrate nel frattempo vengono reindicizzate
+        latest = self._log_high_water() or 0
+        self.db.execute(text(f"DELETE FROM `{self.index_table}`"))
+        self.db.execute(text(self._insert_sql(column_names)))
+        self.db.execute(text(f"DELETE FROM `{self.state_table}`"))
+        self.db.execute(text(f"INSERT INTO `{self.state_table}` (`log_id`) VALUES (:latest)"), {"latest": latest})
+        _sync_cache.invalidate((engine_key(self.bind), self.index_table))
+
+    def refresh_rows(self, pks: List[Any], column_names: Iterable[str]) -> None:
+        """Riallinea l'indice per le righe modificate (da chiamare nella stessa transazione dell'UPDATE)."""
+        if not pks:
+            return
+        column_names = [col for col in column_names if col != self.pk_column]
+        delete_query = text(f"DELETE FROM `{self.index_table}` WHERE {self._index_pk} IN :pks").bindparams(
+            bindparam("pks", expanding=True))
+        insert_query = text(self._insert_sql(column_names, f" WHERE `{self.pk_column}` IN :pks")).bindparams(
+            bindparam("pks", expanding=True))
+        self.db.execute(delete_query, {"pks": list(pks)})
+        self.db.execute(insert_query, {"pks": list(pks)})
+
+
+__all__ = ['GlobalSearchIndex', 'FULLTEXT_SEARCH_ENABLED']
+
+
+if __name__ == "__main__":
+    from database_config import engine
+    from cache import get_table_metadata
+    from ordini_servizi_ge import TABLE_NAME, grid_columns
+
+    with engine.begin() as conn:
+        index = GlobalSearchIndex(conn, TABLE_NAME)
+        index.rebuild(grid_columns(get_table_metadata(engine, TABLE_NAME).column_names))
+    print(f"Indice {index.index_table} ricostruito.")
@@ -0,0 +1,83 @@
+"""
+Formato compatto (a colonne) per le risposte delle griglie.
+
+La risposta classica è una lista di oggetti che ripete il nome di ogni colonna su ogni riga
+e passa per jsonable_encoder. Il formato a colonne invia i nomi una sola volta:
+
+    {"draw": 1, "recordsTotal": ..., "columns": ["ID", "PDV", ...], "rows": [[1, "P1", ...], ...]}
+
+serializzato con orjson (se installato, altrimenti json) oppure in MessagePack quando il
+client lo chiede con `Accept: application/x-msgpack` e msgpack è installato.
+orjson e msgpack sono dipendenze opzionali.
+"""
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Any, Dict, List
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError: # Senza orjson si usa il modulo json della libreria standard
+    orjson = None
+
+try:
+    import msgpack
+except ImportError: # Senza msgpack il formato binario non è disponibile e si risponde in JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+
+
+def _default(value: Any) -> Any:
+    """Tipi non nativi, convertiti come fa jsonable_encoder."""
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+def to_columnar(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Risultato di DataManager.get_filtered_data con `data` trasformato in `columns` + `rows`."""
+    data: List[Dict[str, Any]] = result.get("data") or []
+    columns = list(data[0].keys()) if data else []
+    compact = {key: value for key, value in result.items() if key != "data"}
+    compact["columns"] = columns
+    compact["rows"] = [[row.get(col) for col in columns] for row in data]
+    return compact
+
+
+class CompactJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class MsgpackResponse(Response):
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, default=_default, use_bin_type=True)
+
+
+def wants_msgpack(accept: str) -> bool:
+    return msgpack is not None and MSGPACK_MEDIA_TYPE in (accept or "")
+
+
+def columnar_response(result: Dict[str, Any], accept: str = "") -> Response:
+    """Risposta a colonne in MessagePack se richiesto e disponibile, altrimenti JSON compatto."""
+    compact = to_columnar(result)
+    if wants_msgpack(accept):
+        return MsgpackResponse(compact)
+    return CompactJSONResponse(compact)
+
+
+__all__ = ['CompactJSONResponse', 'MsgpackResponse', 'columnar_response', 'to_columnar', 'wants_msgpack',
+           'MSGPACK_MEDIA_TYPE']
@@ -357,3 +357,40 @@ document.addEventListener("DOMContentLoaded", function () {
 
 
 });
+
+// === ESPORTAZIONI IN BACKGROUND ===
+// Crea il job, ne segue l'avanzamento e avvia il download quando il file è pronto
+window.avviaEsportazioneJob = async function (url, payload, button) {
+  const originalText = button ? button.innerHTML : null;
+  const setLabel = (text) => { if (button) button.innerHTML = text; };
+  if (button) button.disabled = true;
+  try {
+    const response = await fetch(url, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(payload)
+    });
+    const job = await response.json();
+    if (!response.ok) throw new Error(job.error || job.detail || `Errore HTTP: ${response.status}`);
+
+    let status = job;
+    while (status.status === 'queued' || status.status === 'running') {
+      await new Promise(resolve => setTimeout(resolve, 1000));
+      const poll = await fetch(`/api/exports/${job.id}`);
+      status = await poll.json();
+      if (!poll.ok) throw new Error(status.detail || `Errore HTTP: ${poll.status}`);
+      const total = status.total_estimate ? ` / ${status.total_estimate}` : '';
+      setLabel(`Esportazione... ${status.rows_written}${total}`);
+    }
+    if (status.status !== 'done') throw new Error(status.error || 'Esportazione non riuscita');
+    window.location.href = status.download_url;
+  } catch (error) {
+    console.error('Errore esportazione:', error);
+    alert(`Errore durante l'esportazione: ${error.message}`);
+  } finally {
+    if (button) {
+      button.disabled = false;
+      button.innerHTML = originalText;
+    }
+  }
+};
@@ -177,12 +177,18 @@
         });
 
         $('#exportBtn').on('click', function () {
-            const params = new URLSearchParams({
+            const filters = {
                 year: $('#year').val() || '',
                 codice: $('#codice').val() || '',
                 codicenet: $('#codicenet').val() || '',
                 descrizione: $('#descrizione').val() || ''
-            });
+            };
+            // L'esportazione gira in background sul server: si segue il job fino al download
+            if (typeof window.avviaEsportazioneJob === 'function') {
+                window.avviaEsportazioneJob('/ordini_materiale/export/jobs', { ...filters, format: 'xlsx' }, this);
+                return;
+            }
+            const params = new URLSearchParams(filters);
             window.location.href = `/ordini_materiale/export?${params.toString()}`;
         });
     }
@@ -24,6 +24,15 @@ function handleAjaxError(xhr, status, error) {
     handleError(new Error(errorMessage), 'Errore nella richiesta AJAX');
 }
 
+// Modifica in conflitto (409): un altro utente ha cambiato la cella, si mostra il valore attuale
+function handleEditConflict(response) {
+    return response.json().then(conflict => {
+        const error = new Error(`${conflict.message} Valore attuale: ${conflict.current_value ?? ''}`);
+        error.currentValue = conflict.current_value ?? '';
+        throw error;
+    });
+}
+
 // Funzione di utilità per ottenere i filtri attivi
 function getActiveFilters() {
     const filters = {};
@@ -197,6 +206,18 @@ function handleExport() {
         params.append('column_filters', JSON.stringify(columnFilters));
     }
 
+    // L'esportazione gira in background sul server: si segue il job fino al download
+    if (typeof window.avviaEsportazioneJob === 'function') {
+        window.avviaEsportazioneJob('/api/servizi/ge/export/jobs', {
+            month: selectedMonth,
+            global_search: params.get('global_search') || '',
+            column_filters: columnFilters,
+            visible_columns: visibleColumns,
+            format: 'xlsx'
+        }, document.getElementById('exportBtn'));
+        return;
+    }
+
     const query = params.toString();
     window.location.href = `/api/servizi/ge/export?${query}`;
 }
@@ -237,6 +258,16 @@ async function aggiornaFiltroRTC() {
     }
 }
 
+function columnarToObjects(columns, rows) {
+    return (rows || []).map(row => {
+        const obj = {};
+        for (let i = 0; i < columns.length; i++) {
+            obj[columns[i]] = row[i];
+        }
+        return obj;
+    });
+}
+
 async function initializeDataTable() {
     console.log('[initializeDataTable] Inizio inizializzazione DataTable.');
     const selectedMonth = $('#month-filter').val();
@@ -277,7 +308,9 @@ async function initializeDataTable() {
             columnsConfig = columnsData.map((col, idx) => ({
                 data: col.field,
                 title: col.title || col.field.replace(/_/g, ' ').replace(/\b\w/g, l => l.toUpperCase()),
-                className: col.editable ? 'editable' : 'readonly',
+                // Le colonne nascoste per il ruolo non arrivano dal server: vuote e fuori da "Visibilità Colonne"
+                className: (col.editable ? 'editable' : 'readonly') + (col.visible === false ? ' role-hidden' : ''),
+                defaultContent: '',
                 visible: typeof col.visible === 'boolean' ? col.visible : (visibleColumnsState.length > 0 ? visibleColumnsState.includes(idx) : true),
                 editable: !!col.editable,
                 validation: col.validation || null
@@ -315,10 +348,19 @@ async function initializeDataTable() {
                     const payload = {
                         ...d,
                         month_filter: $('#month-filter').val() || '',
-                        rtc_filter: $('#rtc-filter').val() || ''
+                        rtc_filter: $('#rtc-filter').val() || '',
+                        // Paginazione keyset: il server usa il cursore per le pagine adiacenti
+                        pagination: 'keyset',
+                        cursor: window.geDataCursor || null,
+                        // Risposta a colonne: nomi delle colonne una sola volta, righe come array
+                        format: 'columnar'
                     };
                     return JSON.stringify(payload);
                 },
+                dataSrc: function (json) {
+                    window.geDataCursor = json.cursor || null;
+                    return json.columns ? columnarToObjects(json.columns, json.rows) : json.data;
+                },
                 error: handleAjaxError
             },
             columns: columnsConfig,
@@ -330,6 +372,7 @@ async function initializeDataTable() {
                     extend: 'colvis',
                     text: 'Visibilità Colonne',
                     className: 'buttons-colvis',
+                    columns: ':not(.role-hidden)',
                 }
             ],
             language: { url: "/static/i18n/Italian.json" },
@@ -609,9 +652,10 @@ async function initializeDataTable() {
                         fetch('/api/servizi/ge/update', {
                             method: 'POST',
                             headers: { 'Content-Type': 'application/json' },
-                            body: JSON.stringify({ pk: rowData.ID, field: columnName, value: newValue })
+                            body: JSON.stringify({ pk: rowData.ID, field: columnName, value: newValue, old_value: data })
                         })
                             .then(response => {
+                                if (response.status === 409) return handleEditConflict(response);
                                 if (!response.ok) throw new Error('Errore nella risposta del server');
                                 return response.json();
                             })
@@ -626,7 +670,7 @@ async function initializeDataTable() {
                             .catch(error => {
                                 console.error('Errore:', error);
                                 $(cell.node()).empty();
-                                cell.data(data).draw(false);
+                                cell.data(error.currentValue !== undefined ? error.currentValue : data).draw(false);
                                 if (error.message !== 'Errore nella risposta del server') {
                                     alert(error.message);
                                 }
@@ -643,9 +687,10 @@ async function initializeDataTable() {
                     fetch('/api/servizi/ge/update', {
                         method: 'POST',
                         headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ pk: rowData.ID, field: columnName, value: newValue })
+                        body: JSON.stringify({ pk: rowData.ID, field: columnName, value: newValue, old_value: data })
                     })
                         .then(response => {
+                            if (response.status === 409) return handleEditConflict(response);
                             if (!response.ok) throw new Error('Errore nella risposta del server');
                             return response.json();
                         })
@@ -660,7 +705,7 @@ async function initializeDataTable() {
                         .catch(error => {
                             console.error('Errore:', error);
                             $(cell.node()).empty();
-                            cell.data(data).draw(false);
+                            cell.data(error.currentValue !== undefined ? error.currentValue : data).draw(false);
                             if (error.message !== 'Errore nella risposta del server') {
                                 alert(error.message);
                             }
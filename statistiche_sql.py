@@ -0,0 +1,311 @@
+"""
+Strumentazione SQL per richiesta: quante query esegue ogni route, quanto tempo e quante righe.
+
+instrument_engine() aggancia gli eventi before/after_cursor_execute dell'Engine (lo fa
+database_config per l'engine dell'applicazione); SQLStatsMiddleware apre per ogni richiesta HTTP
+un contatore in una ContextVar, che segue la richiesta anche nel pool di thread del database.
+A fine richiesta il contatore viene sommato negli aggregati della route (template del path,
+es. "POST /api/servizi/ge/data"); le query eseguite fuori da una richiesta (thread in
+background) finiscono sotto FUORI_RICHIESTA.
+
+Le query oltre SQL_SLOW_MS millisecondi vengono registrate con route, utente, forma dei
+parametri (nomi e tipi, mai i valori) e piano di esecuzione (EXPLAIN sulla stessa connessione):
+le ultime SQL_SLOW_KEEP in memoria, tutte in SQL_SLOW_LOG (JSONL) se impostato.
+Aggregati e query lente: GET /internal/metrics/sql.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy import event
+
+SQL_STATS_ENABLED = os.getenv("SQL_STATS", "1").strip().lower() not in ("0", "false", "no")
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "500"))
+SQL_SLOW_LOG = os.getenv("SQL_SLOW_LOG", "")
+SQL_SLOW_EXPLAIN = os.getenv("SQL_SLOW_EXPLAIN", "1").strip().lower() not in ("0", "false", "no")
+SQL_SLOW_KEEP = int(os.getenv("SQL_SLOW_KEEP", "100"))
+# Lunghezza massima del testo SQL conservato per una query lenta
+STATEMENT_MAX_CHARS = 2000
+FUORI_RICHIESTA = "(fuori richiesta)"
+
+logger = logging.getLogger(__name__)
+
+_START_KEY = "sql_stats_start"
+
+
+@dataclass
+class RequestStats:
+    """Contatori della richiesta in corso."""
+    route: str = FUORI_RICHIESTA
+    user: Optional[str] = None
+    queries: int = 0
+    db_ms: float = 0.0
+    rows: int = 0
+    errors: int = 0
+    slow: int = 0
+    scope: Optional[Dict[str, Any]] = field(default=None, repr=False) # Scope ASGI: la route è nota solo dopo il routing
+
+    def route_name(self) -> str:
+        return route_label(self.scope) if self.scope is not None else self.route
+
+
+@dataclass
+class RouteStats:
+    requests: int = 0
+    queries: int = 0
+    db_ms: float = 0.0
+    rows: int = 0
+    errors: int = 0
+    slow: int = 0
+    max_queries: int = 0
+    max_db_ms: float = 0.0
+    request_ms: float = 0.0
+
+    def to_dict(self, route: str) -> Dict[str, Any]:
+        requests = self.requests or 1
+        return {
+            "route": route, "requests": self.requests, "queries": self.queries,
+            "queries_avg": round(self.queries / requests, 2), "queries_max": self.max_queries,
+            "db_ms": round(self.db_ms, 3), "db_ms_avg": round(self.db_ms / requests, 3),
+            "db_ms_max": round(self.max_db_ms, 3), "request_ms_avg": round(self.request_ms / requests, 3),
+            "rows": self.rows, "errors": self.errors, "slow": self.slow,
+        }
+
+
+_current: ContextVar[Optional[RequestStats]] = ContextVar("sql_request_stats", default=None)
+
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _current.get()
+
+
+def parameter_shape(parameters: Any) -> Any:
+    """Forma dei parametri senza valori: nomi e tipi, lunghezza delle liste (es. IN espansi, executemany)."""
+    if isinstance(parameters, dict):
+        return {str(key): parameter_shape(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and all(isinstance(item, (dict, list, tuple)) for item in parameters):
+            return {"items": len(parameters), "shape": parameter_shape(parameters[0])}
+        return [parameter_shape(item) for item in parameters]
+    return type(parameters).__name__
+
+
+def _compact(statement: str) -> str:
+    statement = " ".join(statement.split())
+    return statement if len(statement) <= STATEMENT_MAX_CHARS else statement[:STATEMENT_MAX_CHARS] + "…"
+
+
+def _row_count(cursor, context) -> int:
+    if context is not None and context.execution_options.get("stream_results"):
+        return 0 # Cursore lato server: il numero di righe non è noto all'esecuzione
+    rowcount = getattr(cursor, "rowcount", -1)
+    return rowcount if isinstance(rowcount, int) and 0 <= rowcount < 2 ** 63 else 0
+
+
+def explain(cursor, statement: str, parameters: Any, dialect: str, context=None) -> Optional[List[Dict[str, Any]]]:
+    """Piano di esecuzione di una SELECT su un nuovo cursore della stessa connessione DBAPI."""
+    if context is not None and context.execution_options.get("stream_results"):
+        return None # Risultato ancora in lettura sulla connessione: un'altra query la interromperebbe
+    head = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    if head not in ("SELECT", "WITH"):
+        return None
+    prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute(prefix + statement, parameters)
+        columns = [description[0] for description in explain_cursor.description or ()]
+        return [dict(zip(columns, row)) for row in explain_cursor.fetchall()]
+    finally:
+        explain_cursor.close()
+
+
+class SQLStatsRecorder:
+    """Aggregati per route (thread-safe) e registro delle query lente."""
+
+    def __init__(self, slow_ms: float = SQL_SLOW_MS, slow_log: str = SQL_SLOW_LOG, keep: int = SQL_SLOW_KEEP,
+                 explain_slow: bool = SQL_SLOW_EXPLAIN, enabled: bool = SQL_STATS_ENABLED):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.explain_slow = explain_slow
+        self.enabled = enabled
+        self._routes: Dict[str, RouteStats] = {}
+        self._slow: Deque[Dict[str, Any]] = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def record_statement(self, elapsed_ms: float, rows: int) -> None:
+        stats = _current.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_ms += elapsed_ms
+            stats.rows += rows
+            return
+        with self._lock:
+            route = self._routes.setdefault(FUORI_RICHIESTA, RouteStats())
+            route.queries += 1
+            route.db_ms += elapsed_ms
+            route.rows += rows
+
+    def record_error(self) -> None:
+        stats = _current.get()
+        if stats is not None:
+            stats.errors += 1
+            return
+        with self._lock:
+            self._routes.setdefault(FUORI_RICHIESTA, RouteStats()).errors += 1
+
+    def record_slow(self, statement: str, parameters: Any, elapsed_ms: float, rows: int,
+                    plan: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+        stats = _current.get()
+        entry = {
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "route": stats.route_name() if stats is not None else FUORI_RICHIESTA,
+            "user": stats.user if stats is not None else None,
+            "ms": round(elapsed_ms, 3), "rows": rows,
+            "statement": _compact(statement), "params": parameter_shape(parameters),
+            "explain": plan,
+        }
+        if stats is not None:
+            stats.slow += 1
+        else:
+            with self._lock:
+                self._routes.setdefault(FUORI_RICHIESTA, RouteStats()).slow += 1
+        with self._lock:
+            self._slow.append(entry)
+        logger.warning("SQL lenta: %s ms %s (%s): %s", entry['ms'], entry['route'], entry['user'] or '-',
+                       entry['statement'][:200])
+        if self.slow_log:
+            self._append(entry)
+        return entry
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.slow_log) or ".", exist_ok=True)
+            with open(self.slow_log, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, default=str) + "\n")
+        except OSError:
+            pass # La strumentazione non deve mai far fallire una richiesta
+
+    def finish_request(self, stats: RequestStats, elapsed_ms: float) -> None:
+        with self._lock:
+            route = self._routes.setdefault(stats.route, RouteStats())
+            route.requests += 1
+            route.queries += stats.queries
+            route.db_ms += stats.db_ms
+            route.rows += stats.rows
+            route.errors += stats.errors
+            route.slow += stats.slow
+            route.max_queries = max(route.max_queries, stats.queries)
+            route.max_db_ms = max(route.max_db_ms, stats.db_ms)
+            route.request_ms += elapsed_ms
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Aggregati per route, dalla route con più tempo speso sul database."""
+        with self._lock:
+            routes = [stats.to_dict(route) for route, stats in self._routes.items()]
+        return sorted(routes, key=lambda route: -route["db_ms"])
+
+    def slow_queries(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(reversed(self._slow))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"enabled": self.enabled, "slow_ms": self.slow_ms, "routes": len(self._routes),
+                    "queries": sum(route.queries for route in self._routes.values())}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._routes.clear()
+            self._slow.clear()
+
+
+sql_stats = SQLStatsRecorder()
+
+
+def instrument_engine(engine, recorder: SQLStatsRecorder = sql_stats) -> None:
+    """Registra sull'Engine gli eventi che misurano ogni statement eseguito."""
+    if not recorder.enabled:
+        return
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(_START_KEY, []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get(_START_KEY)
+        if not starts:
+            return
+        elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+        rows = _row_count(cursor, context)
+        recorder.record_statement(elapsed_ms, rows)
+        if elapsed_ms >= recorder.slow_ms:
+            plan = None
+            if recorder.explain_slow and not executemany:
+                try:
+                    plan = explain(cursor, statement, parameters, conn.dialect.name, context)
+                except Exception as e:
+                    plan = [{"error": str(e)}]
+            recorder.record_slow(statement, parameters, elapsed_ms, rows, plan)
+
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        starts = connection.info.get(_START_KEY) if connection is not None else None
+        if starts:
+            starts.pop()
+        recorder.record_error()
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+def route_label(scope: Dict[str, Any]) -> str:
+    """Metodo e template del path della route (non il path effettivo, che contiene gli ID)."""
+    method = scope.get("method", "")
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    if path:
+        return f"{method} {path}"
+    return f"{method} (altro)" # File statici, 404: un solo aggregato
+
+
+def _session_user(scope: Dict[str, Any]) -> Optional[str]:
+    """Login dal cookie di sessione JSON, come per il log delle modifiche."""
+    from starlette.requests import HTTPConnection
+    try:
+        session = HTTPConnection(scope).cookies.get("session")
+        return json.loads(session).get("login") if session else None
+    except Exception:
+        return None
+
+
+class SQLStatsMiddleware:
+    """Middleware ASGI: contatori SQL per ogni richiesta HTTP, sommati alla route a fine richiesta."""
+
+    def __init__(self, app, recorder: SQLStatsRecorder = sql_stats):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.recorder.enabled:
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(user=_session_user(scope), scope=scope)
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
+            stats.route = stats.route_name() # Il router ha aggiunto la route allo scope
+            self.recorder.finish_request(stats, (time.perf_counter() - start) * 1000)
+
+
+__all__ = ['SQLStatsMiddleware', 'SQLStatsRecorder', 'RequestStats', 'current_request_stats', 'explain',
+           'instrument_engine', 'parameter_shape', 'route_label', 'sql_stats']
@@ -0,0 +1,184 @@
+"""
+Storico delle modifiche della griglia GE (lettura di carrefour_log).
+
+Filtri per record (id_tabella), utente, colonna e intervallo di date; ordinamento dal più
+recente con paginazione a cursore su (data, id), servito dagli indici dichiarati su
+CarrefourLog. L'esportazione usa la stessa query letta a blocchi.
+Serve una sessione con ruolo; le modifiche alle colonne nascoste per il ruolo non vengono
+restituite, come nella griglia.
+
+Per creare gli indici su una tabella carrefour_log già esistente:
+    python storico_modifiche.py
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session
+
+from database_config import get_db
+from ordini_servizi_ge import get_role_permissions, session_role
+from esportazione import ExportFormatError, QueryRows, check_export_format, export_response
+from models.carrefour_log import CarrefourLog
+
+router = APIRouter()
+
+LOG_TABLE = CarrefourLog.__tablename__
+HISTORY_COLUMNS = ['id', 'data', 'utente', 'id_tabella', 'colonna', 'campo_old', 'campo_new']
+HISTORY_MAX_LIMIT = 500
+
+
+def encode_cursor(data: datetime, log_id: int) -> str:
+    raw = json.dumps([data.isoformat() if isinstance(data, datetime) else str(data), log_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        data, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return datetime.fromisoformat(data), int(log_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursore non valido.")
+
+
+def parse_date(value: Optional[str], name: str) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Data non valida per '{name}': usare il formato AAAA-MM-GG[THH:MM:SS].")
+
+
+def build_history_where(id_tabella: Optional[int] = None, utente: Optional[str] = None,
+                        colonna: Optional[str] = None, date_from: Optional[datetime] = None,
+                        date_to: Optional[datetime] = None,
+                        hidden_columns: Iterable[str] = ()) -> Tuple[str, Dict[str, Any]]:
+    """Condizioni di uguaglianza e range sulle colonne indicizzate (nessuna funzione sulle colonne)."""
+    # Le righe senza data non hanno posto nell'ordinamento del cursore (data, id)
+    clauses, params = ["`data` IS NOT NULL"], {}
+    for column, value in (('id_tabella', id_tabella), ('utente', utente), ('colonna', colonna)):
+        if value is not None and value != '':
+            clauses.append(f"`{column}` = :{column}")
+            params[column] = value
+    if date_from:
+        clauses.append("`data` >= :date_from")
+        params['date_from'] = date_from
+    if date_to:
+        # date_to senza orario comprende tutto il giorno
+        if date_to.time() == datetime.min.time():
+            date_to = date_to.replace(hour=23, minute=59, second=59, microsecond=999999)
+        clauses.append("`data` <= :date_to")
+        params['date_to'] = date_to
+    hidden_columns = sorted(hidden_columns)
+    for i, column in enumerate(hidden_columns):
+        clauses.append(f"`colonna` <> :hidden_{i}")
+        params[f'hidden_{i}'] = column
+    return " WHERE " + " AND ".join(clauses), params
+
+
+def get_history_page(db: Session, where_sql: str, params: Dict[str, Any], limit: int,
+                     cursor: Optional[str] = None) -> Dict[str, Any]:
+    """Pagina dello storico dal più recente; `next_cursor` è None sull'ultima pagina."""
+    params = dict(params)
+    if cursor:
+        cursor_data, cursor_id = decode_cursor(cursor)
+        seek = "(`data` < :cursor_data OR (`data` = :cursor_data AND `id` < :cursor_id))"
+        where_sql = f"{where_sql} AND {seek}" if where_sql else f" WHERE {seek}"
+        params.update(cursor_data=cursor_data, cursor_id=cursor_id)
+    params['limit'] = limit + 1 # Una riga in più per sapere se esiste una pagina successiva
+    query = text(f"""
+        SELECT {', '.join(f'`{c}`' for c in HISTORY_COLUMNS)} FROM `{LOG_TABLE}`
+        {where_sql}
+        ORDER BY `data` DESC, `id` DESC
+        LIMIT :limit
+    """)
+    rows = [dict(row._mapping) for row in db.execute(query, params)]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1]['data'], rows[-1]['id']) if has_more else None
+    for row in rows:
+        if isinstance(row['data'], datetime):
+            row['data'] = row['data'].isoformat()
+    return {"data": rows, "next_cursor": next_cursor}
+
+
+def _hidden_columns(request: Request, db: Session) -> frozenset:
+    """Colonne nascoste per il ruolo della sessione; 401 senza una sessione valida con ruolo."""
+    ruolo_id = session_role(request)
+    if not isinstance(ruolo_id, int) or isinstance(ruolo_id, bool):
+        raise HTTPException(status_code=401, detail="Utente non autenticato.")
+    return get_role_permissions(db, ruolo_id).hidden_columns
+
+
+@router.get("/api/servizi/ge/history")
+def get_history(
+    request: Request,
+    id_tabella: Optional[int] = Query(None),
+    utente: Optional[str] = Query(None),
+    colonna: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None),
+    date_to: Optional[str] = Query(None),
+    limit: int = Query(100, ge=1, le=HISTORY_MAX_LIMIT),
+    cursor: Optional[str] = Query(None),
+    db: Session = Depends(get_db)
+):
+    hidden = _hidden_columns(request, db)
+    where_sql, params = build_history_where(id_tabella, utente, colonna,
+                                            parse_date(date_from, 'date_from'), parse_date(date_to, 'date_to'),
+                                            hidden)
+    return JSONResponse(get_history_page(db, where_sql, params, limit, cursor))
+
+
+@router.get("/api/servizi/ge/history/export")
+def export_history(
+    request: Request,
+    id_tabella: Optional[int] = Query(None),
+    utente: Optional[str] = Query(None),
+    colonna: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None),
+    date_to: Optional[str] = Query(None),
+    export_format: str = Query('csv', alias='format'),
+    db: Session = Depends(get_db)
+):
+    hidden = _hidden_columns(request, db)
+    try:
+        export_format = check_export_format(export_format)
+    except ExportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    where_sql, params = build_history_where(id_tabella, utente, colonna,
+                                            parse_date(date_from, 'date_from'), parse_date(date_to, 'date_to'),
+                                            hidden)
+    query = text(f"SELECT {', '.join(f'`{c}`' for c in HISTORY_COLUMNS)} FROM `{LOG_TABLE}`{where_sql} "
+                 "ORDER BY `data` DESC, `id` DESC")
+    rows = QueryRows(db, query, params)
+    return export_response(
+        export_format, rows.columns, rows.batches(),
+        filename_base=f"storico_modifiche_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}",
+        sheet_name="Storico",
+        header_format={'bold': True, 'bg_color': '#F7DC6F', 'border': 1},
+        description=rows.description
+    )
+
+
+def create_history_indexes(bind) -> List[str]:
+    """Crea gli indici dichiarati su CarrefourLog che mancano nel database; restituisce i nomi creati."""
+    existing = {index['name'] for index in inspect(bind).get_indexes(LOG_TABLE)}
+    created = []
+    for index in CarrefourLog.__table__.indexes:
+        if index.name not in existing:
+            index.create(bind=bind)
+            created.append(index.name)
+    return created
+
+
+__all__ = ['router', 'build_history_where', 'get_history_page', 'create_history_indexes']
+
+
+if __name__ == "__main__":
+    from database_config import engine
+    print("Indici creati:", create_history_indexes(engine) or "nessuno (già presenti)")
@@ -0,0 +1,166 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import ordini_servizi_ge as ge
+from database_config import get_db
+
+SESSION = {"session": json.dumps({"login": "mario", "id": 1, "ruolo_id": 2})}
+
+
+@pytest.fixture
+def client():
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    with engine.begin() as conn:
+        conn.execute(text(f"CREATE TABLE {ge.TABLE_NAME} (ID INTEGER PRIMARY KEY, PDV TEXT, RTC TEXT, TIPOLOGIA_OPEX TEXT)"))
+        conn.execute(text(f"INSERT INTO {ge.TABLE_NAME} VALUES (1, 'a', 'R1', NULL), (2, 'b', 'R2', NULL)"))
+        conn.execute(text("CREATE TABLE carrefour_log (id INTEGER PRIMARY KEY AUTOINCREMENT, utente TEXT, campo_old TEXT, "
+                          "campo_new TEXT, data DATETIME, id_tabella INT, colonna TEXT)"))
+        conn.execute(text("CREATE TABLE carrefour_configurazione (competenza TEXT, tipologia TEXT, categoria TEXT, "
+                          "tipo TEXT, CONFERMA TEXT, approvazionecarrefour TEXT, stati TEXT)"))
+        conn.execute(text("INSERT INTO carrefour_configurazione (tipo) VALUES ('OPEX1')"))
+        conn.execute(text("CREATE TABLE utente_ruoli_permessi (ruolo_id INTEGER PRIMARY KEY, "
+                          "colonne_ordini_servizio_ge TEXT, colonne_ordini_servizio_ge_edit TEXT)"))
+        conn.execute(text("INSERT INTO utente_ruoli_permessi VALUES (2, '', 'PDV,TIPOLOGIA_OPEX')"))
+    ge.invalidate_validation_lists()
+    ge.invalidate_role_permissions()
+    Session = sessionmaker(bind=engine)
+
+    def override_get_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app = FastAPI()
+    app.include_router(ge.router)
+    app.dependency_overrides[get_db] = override_get_db
+    yield TestClient(app), engine
+    engine.dispose()
+
+
+def test_batch_update_reports_per_cell_results(client):
+    cl, engine = client
+    changes = [
+        {"pk": 1, "field": "PDV", "value": "x"},
+        {"pk": 2, "field": "PDV", "value": "y"},
+        {"pk": 1, "field": "PDV", "value": "z"},          # stessa cella: vale l'ultima
+        {"pk": 2, "field": "TIPOLOGIA_OPEX", "value": "OPEX1"},
+        {"pk": 1, "field": "RTC", "value": "R9"},        # non editabile per il ruolo
+        {"pk": 1, "field": "TIPOLOGIA_OPEX", "value": "NO"},  # non in elenco
+        {"pk": 99, "field": "PDV", "value": "w"},        # record inesistente
+    ]
+    response = cl.post("/api/servizi/ge/update/batch", json={"changes": changes}, cookies=SESSION)
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["status"], body["updated"], body["failed"]) == ("partial", 4, 3)
+    assert [r["status"] for r in body["results"]] == ["success"] * 4 + ["error"] * 3
+    assert [r["code"] for r in body["results"][4:]] == [403, 400, 404]
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT ID, PDV, RTC, TIPOLOGIA_OPEX FROM {ge.TABLE_NAME} ORDER BY ID")).fetchall()
+        log = conn.execute(text("SELECT id_tabella, colonna, campo_old, campo_new, utente FROM carrefour_log ORDER BY id")).fetchall()
+    assert [tuple(r) for r in rows] == [(1, "z", "R1", None), (2, "y", "R2", "OPEX1")]
+    assert [tuple(r) for r in log] == [
+        (1, "PDV", "a", "x", "mario"),
+        (2, "PDV", "b", "y", "mario"),
+        (1, "PDV", "x", "z", "mario"),
+        (2, "TIPOLOGIA_OPEX", None, "OPEX1", "mario"),
+    ]
+
+
+def test_batch_update_requires_session_and_changes(client):
+    cl, _ = client
+    assert cl.post("/api/servizi/ge/update/batch", json={"changes": [{"pk": 1, "field": "PDV", "value": "x"}]}).status_code == 401
+    assert cl.post("/api/servizi/ge/update/batch", json={"changes": []}, cookies=SESSION).status_code == 400
+
+
+def test_conditional_update_is_compare_and_set(client):
+    cl, engine = client
+    ok = cl.post("/api/servizi/ge/update", json={"pk": 1, "field": "PDV", "value": "x", "old_value": "a"}, cookies=SESSION)
+    assert ok.status_code == 200
+    # Secondo utente con il valore ormai superato: conflitto con il valore attuale
+    stale = cl.post("/api/servizi/ge/update", json={"pk": 1, "field": "PDV", "value": "y", "old_value": "a"}, cookies=SESSION)
+    assert stale.status_code == 409
+    assert stale.json()["current_value"] == "x"
+    assert cl.post("/api/servizi/ge/update", json={"pk": 99, "field": "PDV", "value": "y", "old_value": "a"},
+                   cookies=SESSION).status_code == 404
+    # NULL in tabella corrisponde alla cella vuota della griglia
+    assert cl.post("/api/servizi/ge/update", json={"pk": 1, "field": "TIPOLOGIA_OPEX", "value": "OPEX1", "old_value": ""},
+                   cookies=SESSION).status_code == 200
+
+    batch = cl.post("/api/servizi/ge/update/batch", cookies=SESSION, json={"changes": [
+        {"pk": 2, "field": "PDV", "value": "q", "old_value": "b"},
+        {"pk": 1, "field": "PDV", "value": "q", "old_value": "a"},
+    ]}).json()
+    assert [r["status"] for r in batch["results"]] == ["success", "error"]
+    assert (batch["results"][1]["code"], batch["results"][1]["current_value"]) == (409, "x")
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT PDV, TIPOLOGIA_OPEX FROM {ge.TABLE_NAME} ORDER BY ID")).fetchall()
+        log = conn.execute(text("SELECT campo_old, campo_new FROM carrefour_log ORDER BY id")).fetchall()
+    assert [tuple(r) for r in rows] == [("x", "OPEX1"), ("q", None)]
+    assert [tuple(r) for r in log] == [("a", "x"), (None, "OPEX1"), ("b", "q")]
+
+
+def test_saved_cells_reach_dictionary_with_column_type(client):
+    from cache import engine_key, invalidate_table_metadata
+    from dizionario_valori import distinct_values
+    cl, engine = client
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {ge.TABLE_NAME} ADD COLUMN IMPORTO NUMERIC(10, 2)"))
+        conn.execute(text(f"UPDATE {ge.TABLE_NAME} SET IMPORTO = 250"))
+        conn.execute(text("UPDATE utente_ruoli_permessi SET colonne_ordini_servizio_ge_edit = 'PDV,IMPORTO'"))
+    ge.invalidate_role_permissions()
+    invalidate_table_metadata()
+    key = (engine_key(engine), ge.TABLE_NAME)
+    distinct_values.invalidate()
+    assert distinct_values.schedule_build(engine, key, ge.TABLE_NAME)
+    distinct_values.wait(key)
+    index = distinct_values._indexes[key]
+    try:
+        # Il client invia testo: sul dizionario arriva il valore riletto, l'indice resta valido
+        assert cl.post("/api/servizi/ge/update", json={"pk": "1", "field": "IMPORTO", "value": "300"},
+                       cookies=SESSION).status_code == 200
+        assert distinct_values._indexes.get(key) is index
+        assert index.unique_values('IMPORTO', {'RTC': lambda v: v == 'R1'}) == ['300']
+    finally:
+        distinct_values.invalidate()
+
+
+def test_single_and_batch_updates_compare_like_the_grid(client):
+    from cache import invalidate_table_metadata
+    cl, engine = client
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {ge.TABLE_NAME} ADD COLUMN IMPORTO REAL"))
+        # Collation case-insensitive come sul database: 'Milano' = 'MILANO' in SQL
+        conn.execute(text(f"ALTER TABLE {ge.TABLE_NAME} ADD COLUMN NOTE TEXT COLLATE NOCASE"))
+        conn.execute(text(f"UPDATE {ge.TABLE_NAME} SET IMPORTO = 0.1 + 0.2, NOTE = 'MILANO'"))
+        conn.execute(text("UPDATE utente_ruoli_permessi SET colonne_ordini_servizio_ge_edit = 'IMPORTO,NOTE'"))
+    ge.invalidate_role_permissions()
+    invalidate_table_metadata()
+
+    # Il client vede il float serializzato in JSON: nessun falso conflitto
+    assert cl.post("/api/servizi/ge/update", json={"pk": 1, "field": "IMPORTO", "value": "1", "old_value": 0.30000000000000004},
+                   cookies=SESSION).status_code == 200
+    # Cambio solo di maiuscole fatto da un altro utente: conflitto in entrambi i percorsi
+    single = cl.post("/api/servizi/ge/update", json={"pk": 1, "field": "NOTE", "value": "x", "old_value": "Milano"},
+                     cookies=SESSION)
+    assert (single.status_code, single.json()["current_value"]) == (409, "MILANO")
+    batch = cl.post("/api/servizi/ge/update/batch", cookies=SESSION, json={"changes": [
+        {"pk": 1, "field": "NOTE", "value": "x", "old_value": "Milano"},
+    ]}).json()
+    assert batch["results"][0]["code"] == 409
+
+    with engine.connect() as conn:
+        log = conn.execute(text("SELECT colonna, campo_old, campo_new FROM carrefour_log ORDER BY id")).fetchall()
+    assert [tuple(r) for r in log] == [("IMPORTO", "0.30000000000000004", "1")] # valore letto dal database
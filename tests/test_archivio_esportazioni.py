@@ -0,0 +1,73 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+from archivio_esportazioni import ExportArtifactStore
+
+
+def _writer(calls, size=10):
+    def write(path):
+        calls.append(path)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+    return write
+
+
+def test_same_filters_reuse_file_within_window(tmp_path):
+    store = ExportArtifactStore(directory=str(tmp_path), dedup_window=60)
+    calls = []
+    first = store.get_or_create("ordini_materiale_", {"codice": "A"}, "xlsx", _writer(calls))
+    second = store.get_or_create("ordini_materiale_", {"codice": "A"}, "xlsx", _writer(calls))
+    other = store.get_or_create("ordini_materiale_", {"codice": "B"}, "xlsx", _writer(calls))
+    assert first == second != other
+    assert len(calls) == 2
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+    # Fuori dalla finestra il file viene rigenerato
+    old = time.time() - 120
+    os.utime(first, (old, old))
+    store.get_or_create("ordini_materiale_", {"codice": "A"}, "xlsx", _writer(calls))
+    assert len(calls) == 3
+
+
+def test_sweep_applies_age_and_size_limits(tmp_path):
+    store = ExportArtifactStore(directory=str(tmp_path), max_bytes=25, max_age=3600, dedup_window=0)
+    now = time.time()
+    for i, age in enumerate([7200, 300, 200, 100]):
+        path = tmp_path / f"ordini_materiale_{i}.xlsx"
+        path.write_bytes(b"x" * 10)
+        os.utime(path, (now - age, now - age))
+    (tmp_path / "altro.xlsx").write_bytes(b"x" * 100) # non gestito dall'archivio
+
+    assert store.sweep() == 2
+    assert sorted(os.listdir(tmp_path)) == ["altro.xlsx", "ordini_materiale_2.xlsx", "ordini_materiale_3.xlsx"]
+
+
+def test_file_in_download_is_not_replaced(tmp_path, monkeypatch):
+    import archivio_esportazioni
+    store = ExportArtifactStore(directory=str(tmp_path), dedup_window=60)
+    calls = []
+    first = store.get_or_create("ordini_materiale_", {"codice": "A"}, "xlsx", _writer(calls))
+    old = time.time() - 120
+    os.utime(first, (old, old))
+
+    replace = os.replace
+
+    def locked_replace(src, dst):
+        if dst == first: # come su Windows con il file aperto da un download
+            raise PermissionError(13, "file in uso", dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(archivio_esportazioni.os, "replace", locked_replace)
+    second = store.get_or_create("ordini_materiale_", {"codice": "A"}, "xlsx", _writer(calls))
+    assert second != first and os.path.exists(second) and os.path.exists(first)
+    assert second.endswith(".xlsx") and os.path.basename(second).startswith("ordini_materiale_")
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+
+    # File scritto nel frattempo da un'altra richiesta: viene riusato
+    os.utime(first, None)
+    monkeypatch.setattr(store, "lookup", lambda path, lookup=store.lookup: None if len(calls) == 2 else lookup(path))
+    assert store.get_or_create("ordini_materiale_", {"codice": "A"}, "xlsx", _writer(calls)) == first
+    assert len(calls) == 3
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
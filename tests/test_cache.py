@@ -0,0 +1,65 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from sqlalchemy import create_engine, text
+import cache
+from cache import TTLCache, get_table_metadata, invalidate_table_metadata
+
+
+def _engine():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE t (ID INTEGER PRIMARY KEY, nome VARCHAR(20) NOT NULL, importo FLOAT)"))
+    return engine
+
+
+def test_ttl_cache_expiry_and_lru(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    c = TTLCache(ttl=10, maxsize=2)
+    c.set("a", 1)
+    c.set("b", 2)
+    assert c.get("a") == 1
+    c.set("c", 3)  # espelle "b", il meno usato di recente
+    assert c.get("b") is None
+    now[0] += 11
+    assert c.get("a") is None
+    assert c.stats()["hits"] == 1
+
+
+def test_table_metadata_is_cached(monkeypatch):
+    invalidate_table_metadata()
+    engine = _engine()
+    calls = []
+    original = cache._load_table_metadata
+    monkeypatch.setattr(cache, "_load_table_metadata", lambda b, t: calls.append(t) or original(b, t))
+
+    meta = get_table_metadata(engine, "t")
+    assert meta.column_names == ["ID", "nome", "importo"]
+    assert meta.primary_key == ["ID"]
+    assert meta.column("nome").nullable is False
+    get_table_metadata(engine, "t")
+    assert calls == ["t"]
+
+    invalidate_table_metadata(engine, "t")
+    get_table_metadata(engine, "t")
+    assert calls == ["t", "t"]
+    engine.dispose()
+
+
+def test_tagged_cache_invalidates_by_tag_and_bounds_bytes():
+    from cache import TaggedCache
+    tagged = TaggedCache(max_bytes=100)
+    tagged.set("a", [1], tags=[("pk", 1), ("col", "X")], size=40)
+    tagged.set("b", [2], tags=[("pk", 2)], size=40)
+    assert tagged.get("a") == [1]
+
+    assert tagged.invalidate_tags([("col", "X")]) == 1
+    assert tagged.get("a") is None and tagged.get("b") == [2]
+
+    tagged.set("c", [3], size=40)
+    tagged.set("d", [4], size=40) # oltre 100 byte: esce la voce usata meno di recente
+    assert tagged.get("b") is None
+    assert tagged.stats()["bytes"] == 80
+    assert tagged.stats()["evictions"] == 1
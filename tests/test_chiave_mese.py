@@ -0,0 +1,65 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from chiave_mese import (MONTH_KEY_COLUMN, available_months, create_month_key, has_month_key,
+                         invalidate_available_months, month_number)
+
+
+@pytest.fixture
+def ge_db():
+    from cache import invalidate_table_metadata
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ge_mesi (ID INTEGER PRIMARY KEY, MesePresentazione VARCHAR(20), PDV VARCHAR(20))"))
+        rows = [(1, 'GENNAIO', 'P1'), (2, ' gennaio ', 'P2'), (3, 'Marzo', 'P3'), (4, None, 'P4'), (5, 'N/D', 'P5')]
+        for row in rows:
+            conn.execute(text("INSERT INTO ge_mesi VALUES (:id, :mese, :pdv)"), dict(zip(("id", "mese", "pdv"), row)))
+    invalidate_table_metadata()
+    invalidate_available_months()
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+    invalidate_table_metadata()
+    invalidate_available_months()
+
+
+def test_month_number():
+    assert month_number(' marzo ') == 3 and month_number('DICEMBRE') == 12
+    assert month_number('TUTTO') is None and month_number(None) is None
+
+
+def test_month_filter_uses_generated_key(ge_db):
+    from ordini_servizi_ge import DataManager, FilterManager, page_cache
+    page_cache.invalidate()
+    assert not has_month_key(ge_db, 'ge_mesi') and available_months(ge_db, 'ge_mesi') == []
+    where_sql, params = FilterManager(ge_db, 'ge_mesi').build_where_clause(month_filter='gennaio')
+    assert 'UPPER(TRIM(`MesePresentazione`))' in where_sql and params == {'month_filter': 'GENNAIO'}
+
+    assert create_month_key(ge_db.connection(), 'ge_mesi')
+    ge_db.commit()
+    assert not create_month_key(ge_db.connection(), 'ge_mesi')
+
+    filter_manager = FilterManager(ge_db, 'ge_mesi')
+    assert MONTH_KEY_COLUMN not in filter_manager.column_names
+    where_sql, params = filter_manager.build_where_clause(month_filter=' Gennaio')
+    assert where_sql == f' WHERE `{MONTH_KEY_COLUMN}` = :month_filter' and params == {'month_filter': 1}
+    assert filter_manager.predicates['equality'] == [MONTH_KEY_COLUMN]
+    plan = ' '.join(str(row) for row in ge_db.execute(text(f"EXPLAIN QUERY PLAN SELECT ID FROM ge_mesi{where_sql}"), params))
+    assert 'ix_mese_presentazione_num' in plan
+
+    # Valore che non è un mese: filtro testuale come prima
+    where_sql, _ = filter_manager.build_where_clause(month_filter='N/D')
+    assert 'UPPER(TRIM(`MesePresentazione`))' in where_sql
+
+    result = DataManager(ge_db, 'ge_mesi').get_filtered_data(
+        {"draw": 1, "start": 0, "length": 10, "month_filter": "gennaio", "order": [{"column": 0, "dir": "asc"}]})
+    assert [row['ID'] for row in result['data']] == [1, 2] and result['recordsFiltered'] == 2
+    assert all(MONTH_KEY_COLUMN not in row for row in result['data'])
+
+    assert available_months(ge_db, 'ge_mesi') == ['GENNAIO', 'MARZO']
@@ -0,0 +1,82 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+
+from consigli_indici import (QueryShape, QueryShapeRecorder, aggregate, create_index_sql, load_records,
+                             query_shapes, suggest_indexes)
+
+
+def test_recorder_aggregates_and_writes_log(tmp_path):
+    log_path = tmp_path / "shapes.jsonl"
+    recorder = QueryShapeRecorder(max_shapes=2, log_path=str(log_path))
+    shape = QueryShape(table="ge", kind="page", equality=("RTC",), order_by=(("ID", "asc"),))
+    recorder.record(shape, 10)
+    recorder.record(shape, 30)
+    recorder.record(QueryShape(table="ge", kind="count"), 5)
+    recorder.record(QueryShape(table="ge", kind="unique_values"), 5) # oltre max_shapes
+    snapshot = recorder.snapshot()
+    assert snapshot[0]["count"] == 2 and snapshot[0]["total_ms"] == 40 and snapshot[0]["max_ms"] == 30
+    assert recorder.stats() == {"shapes": 2, "dropped": 1, "queries": 3}
+
+    # Log JSONL e snapshot producono la stessa aggregazione
+    from_log = aggregate(load_records(str(log_path)))
+    assert from_log[shape].count == 2 and from_log[shape].total_ms == 40
+    dump = tmp_path / "dump.json"
+    dump.write_text(json.dumps({"shapes": snapshot}))
+    assert aggregate(load_records(str(dump)))[shape].total_ms == 40
+
+
+def test_suggest_composite_indexes():
+    stats = aggregate([
+        {"table": "ge", "kind": "page", "equality": ["RTC", "STATO"], "ranges": ["DATA"], "count": 50, "total_ms": 5000},
+        {"table": "ge", "kind": "page", "equality": ["RTC"], "count": 30, "total_ms": 900},
+        {"table": "ge", "kind": "page", "scans": ["PDV"], "count": 100, "total_ms": 8000},
+        {"table": "ge", "kind": "page", "order_by": [["PDV", "asc"], ["ID", "asc"]], "count": 10, "total_ms": 100},
+    ])
+    proposals = suggest_indexes(stats)
+    best = proposals[0]
+    # Uguaglianze (la più frequente prima), poi l'intervallo; serve anche il filtro solo su RTC
+    assert best["columns"] == ["RTC", "STATO", "DATA"]
+    assert best["queries"] == 80 and best["benefit_ms"] == 5900
+    assert ["RTC"] not in [p["columns"] for p in proposals] # prefisso di un indice già proposto
+    assert ["PDV", "ID"] in [p["columns"] for p in proposals]
+    assert all("PDV" not in p["columns"][:1] or p["columns"] == ["PDV", "ID"] for p in proposals)
+    assert create_index_sql(best) == "CREATE INDEX `ix_rtc_stato_data` ON `ge` (`RTC`, `STATO`, `DATA`);"
+
+    covered = suggest_indexes(stats, existing={"ge": [("RTC", "STATO", "DATA", "ID")]})
+    assert covered[0]["existing"]
+
+
+def test_data_manager_records_query_shapes(tmp_path):
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import sessionmaker
+    from cache import invalidate_table_metadata
+    from ordini_servizi_ge import DataManager, invalidate_counts, page_cache
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ge_forme (ID INTEGER PRIMARY KEY, RTC VARCHAR(20), IMPORTO INTEGER)"))
+        conn.execute(text("INSERT INTO ge_forme VALUES (1, 'NORD', 10), (2, 'SUD', 20)"))
+    db = sessionmaker(bind=engine)()
+    try:
+        invalidate_table_metadata()
+        invalidate_counts('ge_forme')
+        page_cache.invalidate()
+        query_shapes.reset()
+        params = {"draw": 1, "start": 0, "length": 10, "search": {"value": ""},
+                  "order": [{"column": 2, "dir": "desc"}],
+                  "columns": [{"search": {"value": ""}}, {"search": {"value": "^NORD$", "regex": True}},
+                              {"search": {"value": ">5"}}]}
+        result = DataManager(db, 'ge_forme').get_filtered_data(params)
+        assert [row["ID"] for row in result["data"]] == [1]
+
+        shapes = {shape["kind"]: shape for shape in query_shapes.snapshot()}
+        assert shapes["page"]["equality"] == ["RTC"]
+        assert shapes["page"]["ranges"] == ["IMPORTO"]
+        assert shapes["page"]["order_by"] == [["IMPORTO", "desc"]]
+        assert shapes["count"]["count"] == 1
+    finally:
+        query_shapes.reset()
+        db.close()
+        engine.dispose()
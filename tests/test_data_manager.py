@@ -72,4 +72,254 @@ def test_get_filtered_data_error(monkeypatch):
         "columns": [{"search": {"value": ""}}, {"search": {"value": ""}}]
     }
     result = manager.get_filtered_data(params)
-    assert "error" in result 
+    assert "error" in result 
+
+
+@pytest.fixture
+def sqlite_db():
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import sessionmaker
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ge_keyset (ID INTEGER PRIMARY KEY, PDV VARCHAR(20))"))
+        for i in range(1, 11):
+            conn.execute(text("INSERT INTO ge_keyset VALUES (:id, :pdv)"), {"id": i, "pdv": f"PDV{i % 3}"})
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def test_get_filtered_data_keyset_pagination(sqlite_db):
+    db = sqlite_db
+    manager = DataManager(db, 'ge_keyset')
+    base = {"draw": 1, "length": 3, "search": {"value": ""}, "order": [{"column": 1, "dir": "desc"}],
+            "pagination": "keyset"}
+    expected = [row["ID"] for row in manager.get_filtered_data({**base, "start": 0, "length": 10})["data"]]
+
+    page = manager.get_filtered_data({**base, "start": 0})
+    pages = [row["ID"] for row in page["data"]]
+    executed = []
+    original_execute = db.execute
+    db.execute = lambda query, params=None: executed.append(str(query)) or original_execute(query, params)
+    for start in (3, 6, 9):
+        page = manager.get_filtered_data({**base, "start": start, "cursor": page["cursor"]})
+        pages += [row["ID"] for row in page["data"]]
+    assert pages == expected
+    assert not any("OFFSET" in sql for sql in executed)
+
+    # Pagina precedente a partire dal cursore della pagina 6-8
+    page = manager.get_filtered_data({**base, "start": 6})
+    back = manager.get_filtered_data({**base, "start": 3, "cursor": page["cursor"]})
+    assert [row["ID"] for row in back["data"]] == expected[3:6]
+
+
+def test_keyset_pagination_keeps_null_sort_values(sqlite_db):
+    from sqlalchemy import text
+    from ordini_servizi_ge import page_cache
+    db = sqlite_db
+    db.execute(text("UPDATE ge_keyset SET PDV = NULL WHERE ID >= 7"))
+    db.execute(text("UPDATE ge_keyset SET PDV = 'PDV' || ID WHERE ID < 7"))
+    db.commit()
+    page_cache.invalidate()
+    manager = DataManager(db, 'ge_keyset')
+    for direction in ("desc", "asc"):
+        base = {"draw": 1, "length": 3, "search": {"value": ""}, "order": [{"column": 1, "dir": direction}],
+                "pagination": "keyset"}
+        expected = [row["ID"] for row in manager.get_filtered_data({**base, "start": 0, "length": -1})["data"]]
+        assert len(expected) == 10
+
+        page = manager.get_filtered_data({**base, "start": 0})
+        pages, cursors = [row["ID"] for row in page["data"]], [page["cursor"]]
+        for start in (3, 6, 9):
+            page = manager.get_filtered_data({**base, "start": start, "cursor": page["cursor"]})
+            pages += [row["ID"] for row in page["data"]]
+            cursors.append(page["cursor"])
+        assert pages == expected, direction
+
+        # All'indietro, anche da pagine con valori NULL nel cursore
+        for start in (6, 3, 0):
+            back = manager.get_filtered_data({**base, "start": start, "cursor": cursors[start // 3 + 1]})
+            assert [row["ID"] for row in back["data"]] == expected[start:start + 3], (direction, start)
+
+
+def test_counts_are_cached_until_invalidated(sqlite_db):
+    from ordini_servizi_ge import invalidate_counts
+    db = sqlite_db
+    manager = DataManager(db, 'ge_keyset')
+    params = {"draw": 1, "start": 0, "length": 3, "search": {"value": ""}, "order": [{"column": 0, "dir": "asc"}],
+              "columns": [{"search": {"value": ""}}, {"search": {"value": "PDV1"}}]}
+    invalidate_counts('ge_keyset')
+    first = manager.get_filtered_data(params)
+    assert (first["recordsTotal"], first["recordsFiltered"]) == (10, 4)
+
+    executed = []
+    original_execute = db.execute
+    db.execute = lambda query, params=None: executed.append(str(query)) or original_execute(query, params)
+    manager.get_filtered_data({**params, "start": 3})
+    assert not any("COUNT(*)" in sql for sql in executed)
+
+    invalidate_counts('ge_keyset')
+    manager.get_filtered_data(params)
+    assert any("COUNT(*)" in sql for sql in executed)
+
+
+def test_validation_lists_are_cached(sqlite_db):
+    from sqlalchemy import text
+    from ordini_servizi_ge import get_allowed_values, invalidate_validation_lists
+    db = sqlite_db
+    db.execute(text("CREATE TABLE carrefour_configurazione (competenza TEXT, tipologia TEXT, categoria TEXT, "
+                    "tipo TEXT, CONFERMA TEXT, approvazionecarrefour TEXT, stati TEXT)"))
+    db.execute(text("INSERT INTO carrefour_configurazione VALUES ('PRIVATO', 'A', NULL, ' ', 'SI', 'OK', 'APERTO')"))
+    db.execute(text("INSERT INTO carrefour_configurazione VALUES ('AZIENDA ', 'B', NULL, NULL, 'NO', 'KO', 'CHIUSO')"))
+    invalidate_validation_lists()
+
+    executed = []
+    original_execute = db.execute
+    db.execute = lambda query, params=None: executed.append(str(query)) or original_execute(query, params)
+    assert get_allowed_values(db, 'categoria_cliente') == {'PRIVATO', 'AZIENDA'}
+    assert get_allowed_values(db, 'TIPOLOGIA_OPEX') == frozenset()
+    assert get_allowed_values(db, 'STATO_APPROVAZIONE') == {'OK', 'KO'}
+    assert get_allowed_values(db, 'PDV') is None
+    assert len(executed) == 1
+
+    invalidate_validation_lists()
+    get_allowed_values(db, 'PRESENZA_GAS')
+    assert len(executed) == 2
+
+
+def test_role_permissions_cached_and_invalidated_on_change(sqlite_db):
+    from models.utente import UtenteRuoliPermessi
+    from ordini_servizi_ge import get_role_permissions, invalidate_role_permissions
+    db = sqlite_db
+    UtenteRuoliPermessi.__table__.create(bind=db.get_bind())
+    db.add(UtenteRuoliPermessi(ruolo_id=7, colonne_ordini_servizio_ge="RTC, PDV,", colonne_ordini_servizio_ge_edit="PDV"))
+    db.commit()
+    invalidate_role_permissions()
+
+    permessi = get_role_permissions(db, 7)
+    assert permessi.hidden_columns == {"RTC", "PDV"}
+    assert permessi.editable_columns == {"PDV"}
+    assert get_role_permissions(db, 99).editable_columns == frozenset()
+
+    executed = []
+    original_execute = db.execute
+    db.execute = lambda *args, **kwargs: executed.append(args) or original_execute(*args, **kwargs)
+    assert get_role_permissions(db, 7) is permessi
+    assert not executed
+    db.execute = original_execute
+
+    # La modifica via ORM invalida la cache del ruolo
+    db.query(UtenteRuoliPermessi).filter_by(ruolo_id=7).one().colonne_ordini_servizio_ge_edit = "PDV,RTC"
+    db.commit()
+    assert get_role_permissions(db, 7).editable_columns == {"PDV", "RTC"}
+
+
+def test_pages_are_cached_and_invalidated_precisely(sqlite_db):
+    from ordini_servizi_ge import invalidate_pages, page_cache
+    db = sqlite_db
+    manager = DataManager(db, 'ge_keyset')
+    page_cache.invalidate()
+    params = {"draw": 1, "start": 0, "length": 3, "search": {"value": ""}, "order": [{"column": 1, "dir": "asc"}]}
+    first = manager.get_filtered_data(params)
+    ids = [row["ID"] for row in first["data"]]
+
+    executed = []
+    original_execute = db.execute
+    db.execute = lambda query, params=None: executed.append(str(query)) or original_execute(query, params)
+
+    def data_queries():
+        return [sql for sql in executed if "LIMIT" in sql]
+
+    assert manager.get_filtered_data(params)["data"] == first["data"]
+    assert not data_queries()
+
+    # Riga non in pagina e colonna non usata da filtri/ordinamento: la pagina resta valida
+    outside = next(i for i in range(1, 11) if i not in ids)
+    assert invalidate_pages('ge_keyset', [outside], ['ALTRA']) == 0
+    manager.get_filtered_data(params)
+    assert not data_queries()
+
+    # Colonna di ordinamento modificata: la pagina viene ricalcolata
+    assert invalidate_pages('ge_keyset', [outside], ['PDV']) == 1
+    manager.get_filtered_data(params)
+    assert len(data_queries()) == 1
+    assert page_cache.stats()["hits"] >= 2
+
+
+def test_column_filters_are_type_aware(sqlite_db):
+    from sqlalchemy import text
+    from cache import invalidate_table_metadata
+    db = sqlite_db
+    db.execute(text("CREATE TABLE ge_tipi (ID INTEGER PRIMARY KEY, PDV VARCHAR(20), IMPORTO NUMERIC(10, 2), "
+                    "DATA_ORDINE DATETIME)"))
+    rows = [(1, 'Milano_1', 10, '2024-03-01 09:00:00'), (2, 'MILANO 2', 250, '2024-03-01 18:30:00'),
+            (3, 'Roma', 99.5, '2024-03-02 10:00:00'), (4, 'Milano%', 500, '2024-04-10 08:00:00')]
+    for row in rows:
+        db.execute(text("INSERT INTO ge_tipi VALUES (:id, :pdv, :importo, :data)"),
+                    dict(zip(("id", "pdv", "importo", "data"), row)))
+    db.commit()
+    invalidate_table_metadata()
+    manager = FilterManager(db, 'ge_tipi')
+
+    def ids(column, value, regex=False):
+        clause, params = manager.compile_column_filter(column, value, regex)
+        assert "UPPER" not in clause and "TRIM" not in clause
+        return [r[0] for r in db.execute(text(f"SELECT ID FROM ge_tipi WHERE {clause} ORDER BY ID"), params)]
+
+    assert ids('PDV', r'^milano 2$', True) == [2]
+    assert ids('PDV', r'^Milano\%$', True) == [4]
+    assert ids('PDV', '^milano', True) == [1, 2, 4]
+    assert ids('PDV', 'o_') == [1]
+    assert ids('IMPORTO', '>=99,5') == [2, 3, 4]
+    assert ids('IMPORTO', '100..500') == [2, 4]
+    assert ids('IMPORTO', r'^250$', True) == [2]
+    # Numero senza operatore: sottostringa come in precedenza; l'uguaglianza richiede '='
+    assert ids('IMPORTO', '50') == [2, 4]
+    assert ids('IMPORTO', '=250') == [2]
+    assert ids('DATA_ORDINE', '2024-03-01') == [1, 2]
+    assert ids('DATA_ORDINE', '01/03/2024..2024-03-02') == [1, 2, 3]
+    assert ids('DATA_ORDINE', '>2024-04-01') == [4]
+    # Testo libero su colonna numerica: ricerca testuale come in precedenza
+    assert ids('IMPORTO', 'abc') == []
+
+
+def test_column_projection_limits_selected_columns(sqlite_db):
+    from sqlalchemy import text
+    from cache import invalidate_table_metadata
+    from models.utente import UtenteRuoliPermessi
+    import ordini_servizi_ge
+    db = sqlite_db
+    db.execute(text("CREATE TABLE ge_larga (ID INTEGER PRIMARY KEY, PDV VARCHAR(20), RTC VARCHAR(20), NOTE TEXT)"))
+    for i in range(1, 6):
+        db.execute(text("INSERT INTO ge_larga VALUES (:id, :pdv, :rtc, 'x')"), {"id": i, "pdv": f"P{i}", "rtc": f"R{6 - i}"})
+    UtenteRuoliPermessi.__table__.create(bind=db.get_bind())
+    db.add(UtenteRuoliPermessi(ruolo_id=3, colonne_ordini_servizio_ge="RTC,NOTE"))
+    db.commit()
+    invalidate_table_metadata()
+    ordini_servizi_ge.invalidate_role_permissions()
+    ordini_servizi_ge.page_cache.invalidate()
+
+    original_table = ordini_servizi_ge.TABLE_NAME
+    ordini_servizi_ge.TABLE_NAME = 'ge_larga'
+    try:
+        columns = ordini_servizi_ge.column_projection(db, 3)
+        assert columns == ['ID', 'PDV']
+        assert ordini_servizi_ge.column_projection(db, 3, ['PDV', 'RTC']) == ['ID', 'PDV']
+        assert ordini_servizi_ge.column_projection(db, None) is None
+    finally:
+        ordini_servizi_ge.TABLE_NAME = original_table
+
+    executed = []
+    original_execute = db.execute
+    db.execute = lambda query, params=None: executed.append(str(query)) or original_execute(query, params)
+    manager = DataManager(db, 'ge_larga', columns)
+    # Ordinamento su una colonna nascosta con paginazione keyset: letta per il cursore, non restituita
+    params = {"draw": 1, "start": 0, "length": 2, "search": {"value": ""}, "order": [{"column": 2, "dir": "asc"}],
+              "pagination": "keyset"}
+    first = manager.get_filtered_data(params)
+    assert [row for row in first["data"]] == [{"ID": 5, "PDV": "P5"}, {"ID": 4, "PDV": "P4"}]
+    second = manager.get_filtered_data({**params, "start": 2, "cursor": first["cursor"]})
+    assert [row["ID"] for row in second["data"]] == [3, 2]
+    assert not any("SELECT *" in sql for sql in executed if "LIMIT" in sql)
+    assert not any("NOTE" in sql for sql in executed if "LIMIT" in sql)
@@ -0,0 +1,126 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from dizionario_valori import DistinctValueIndex, DistinctValueStore
+
+
+@pytest.fixture
+def ge_db():
+    # StaticPool: la costruzione in background gira in un altro thread sullo stesso database
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ge_valori (ID INTEGER PRIMARY KEY, RTC VARCHAR(20), STATO VARCHAR(20), "
+                          "IMPORTO INTEGER, MesePresentazione VARCHAR(20), NOTE VARCHAR(50))"))
+        rows = [(1, 'nord ', 'APERTO', 10, 'GENNAIO', 'a'), (2, 'NORD', 'CHIUSO', 200, 'GENNAIO', 'b'),
+                (3, 'SUD', 'APERTO', 300, 'FEBBRAIO', 'c'), (4, None, 'APERTO', 50, 'GENNAIO', 'd'),
+                (5, 'CENTRO', '', 70, 'FEBBRAIO', 'e')]
+        for row in rows:
+            conn.execute(text("INSERT INTO ge_valori VALUES (:id, :rtc, :stato, :importo, :mese, :note)"),
+                         dict(zip(("id", "rtc", "stato", "importo", "mese", "note"), row)))
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def test_unique_values_intersect_bitmaps(ge_db):
+    index = DistinctValueIndex.build(ge_db, 'ge_valori', max_values=4)
+    assert index.unique_values('RTC', {}) == ['CENTRO', 'NORD', 'SUD']
+    assert index.unique_values('RTC', {'STATO': lambda v: v == 'APERTO'}) == ['NORD', 'SUD']
+    assert index.unique_values('STATO', {'RTC': lambda v: v.strip() == 'NORD',
+                                         'MesePresentazione': lambda v: v == 'GENNAIO'}) == ['APERTO', 'CHIUSO']
+    assert index.unique_values('RTC', {'STATO': lambda v: False}) == []
+    # NOTE e IMPORTO hanno più valori distinti di max_values: niente dizionario, il chiamante usa SQL
+    assert 'NOTE' not in index.columns and 'IMPORTO' not in index.columns
+    assert index.unique_values('NOTE', {}) is None
+    assert index.unique_values('RTC', {'NOTE': lambda v: True}) is None
+
+
+def test_updates_move_rows_between_values(ge_db):
+    store = DistinctValueStore(ttl=60)
+    assert store.get(ge_db, 'ge', 'ge_valori') is None # costruzione in background, intanto SQL
+    store.wait('ge')
+    index = store.get(ge_db, 'ge', 'ge_valori')
+    assert index is not None and store.get(ge_db, 'ge', 'ge_valori') is index
+
+    store.apply_update('ge', '3', 'RTC', 'centro') # PK in forma di testo come dal client
+    assert index.unique_values('RTC', {'MesePresentazione': lambda v: v == 'FEBBRAIO'}) == ['CENTRO']
+    store.apply_update('ge', 4, 'RTC', 'Isole')
+    assert index.unique_values('RTC', {}) == ['CENTRO', 'ISOLE', 'NORD']
+
+    # Valore col tipo della colonna: riusa la chiave già presente anche se il tipo Python differisce
+    store.apply_update('ge', 1, 'IMPORTO', 200.0)
+    assert index.unique_values('IMPORTO', {'RTC': lambda v: v.strip() == 'NORD'}) == ['200']
+    assert store.get(ge_db, 'ge', 'ge_valori') is index
+
+    # Riga sconosciuta: indice ricostruito alla richiesta successiva
+    store.apply_update('ge', 99, 'RTC', 'Isole')
+    assert store.get(ge_db, 'ge', 'ge_valori') is None
+    store.wait('ge')
+    assert store.get(ge_db, 'ge', 'ge_valori') not in (None, index)
+    assert store.stats()["builds"] == 2
+
+
+def test_updates_during_build_are_replayed(ge_db, monkeypatch):
+    import threading
+    build, started, resume = DistinctValueIndex.build, threading.Event(), threading.Event()
+
+    def slow_build(*args, **kwargs):
+        index = build(*args, **kwargs) # lettura fatta prima della modifica
+        started.set()
+        resume.wait(5)
+        return index
+
+    monkeypatch.setattr(DistinctValueIndex, "build", slow_build)
+    store = DistinctValueStore(ttl=60)
+    assert store.schedule_build(ge_db.get_bind(), 'ge', 'ge_valori')
+    assert not store.schedule_build(ge_db.get_bind(), 'ge', 'ge_valori') # già in corso
+    started.wait(5)
+    store.apply_update('ge', 5, 'RTC', 'Isole')
+    resume.set()
+    store.wait('ge')
+    assert store.get(ge_db, 'ge', 'ge_valori').unique_values('RTC', {}) == ['ISOLE', 'NORD', 'SUD']
+
+
+def test_unknown_row_during_build_keeps_index_expired(ge_db):
+    store = DistinctValueStore(ttl=60)
+    store._updates_during_build['ge'] = [(6, 'RTC', 'Isole'), (5, 'RTC', 'Isole')] # 6 inserita dopo la lettura
+    store._builders['ge'] = None
+    store._build(ge_db.get_bind(), 'ge', 'ge_valori', 'ID')
+    index = store._indexes['ge']
+    assert index.unique_values('RTC', {}) == ['ISOLE', 'NORD', 'SUD']
+    assert store.get(ge_db, 'ge', 'ge_valori') is index # usato, scaduto: ricostruzione avviata
+    store.wait('ge')
+    assert store.get(ge_db, 'ge', 'ge_valori') is not index
+
+
+def test_transient_positions_count_against_budget(ge_db):
+    # 5 righe × 8 byte per posizione: con 60 byte non stanno tutte le colonne nemmeno in costruzione
+    index = DistinctValueIndex.build(ge_db, 'ge_valori', max_values=4, max_bytes=60)
+    assert index.columns and len(index.columns) < 3 and 'STATO' not in index.columns
+
+
+def test_dictionary_matches_column_filters(ge_db):
+    from cache import engine_key, invalidate_table_metadata
+    from dizionario_valori import distinct_values
+    from ordini_servizi_ge import FilterManager, dictionary_unique_values
+    invalidate_table_metadata()
+    distinct_values.invalidate()
+    filter_manager = FilterManager(ge_db, 'ge_valori')
+
+    def values(column, month='', search=None, **filters):
+        return dictionary_unique_values(ge_db, filter_manager, column, month, search, filters)
+
+    assert values('STATO') is None # dizionario non ancora costruito: query SQL
+    distinct_values.wait((engine_key(ge_db.bind), 'ge_valori'))
+    assert values('STATO', RTC={'value': '^NORD$', 'regex': True}) == ['APERTO', 'CHIUSO']
+    assert values('RTC', IMPORTO={'value': '50..250'}) == ['CENTRO', 'NORD']
+    assert values('RTC', month='febbraio', STATO={'value': 'aper'}) == ['SUD']
+    assert values('RTC', search='nord') is None # ricerca globale: query SQL
+    distinct_values.invalidate()
@@ -0,0 +1,111 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+from datetime import datetime
+from openpyxl import load_workbook
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from esportazione import (
+    QueryRows, ExportFormatError, check_export_format, iter_csv, iter_file_and_remove,
+    temporary_export_path, write_export_file, write_xlsx,
+)
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ge (ID INTEGER PRIMARY KEY, PDV VARCHAR(20))"))
+        for i in range(1, 26):
+            conn.execute(text("INSERT INTO ge VALUES (:id, :pdv)"), {"id": i, "pdv": f"PDV{i}"})
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def test_query_rows_reads_in_batches(db):
+    rows = QueryRows(db, text("SELECT * FROM ge ORDER BY ID"), batch_size=10)
+    assert rows.columns == ["ID", "PDV"]
+    assert [len(batch) for batch in rows.batches()] == [10, 10, 5]
+
+
+def test_write_xlsx_streams_rows_to_file(db):
+    rows = QueryRows(db, text("SELECT ID, PDV, '2024-01-01' AS giorno FROM ge ORDER BY ID"), batch_size=7)
+    path = temporary_export_path('.xlsx')
+    count = write_xlsx(path, rows.columns, ([*row[:2], datetime(2024, 1, 1)] for row in rows),
+                       header_format={'bold': True})
+    assert count == 25
+
+    sheet = load_workbook(path).active
+    assert [cell.value for cell in sheet[1]] == ["ID", "PDV", "giorno"]
+    assert sheet.max_row == 26
+    assert sheet["C2"].value == datetime(2024, 1, 1)
+
+    content = b"".join(iter_file_and_remove(path))
+    assert content.startswith(b"PK")
+    assert not os.path.exists(path)
+
+
+def test_iter_csv_streams_batches(db):
+    rows = QueryRows(db, text("SELECT * FROM ge ORDER BY ID"), batch_size=10)
+    chunks = list(iter_csv(rows.columns, rows.batches()))
+    assert len(chunks) == 3
+    lines = b"".join(chunks).decode("utf-8").splitlines()
+    assert lines[0] == "ID,PDV" and lines[1] == "1,PDV1" and len(lines) == 26
+
+
+def test_write_parquet_row_groups(db):
+    pq = pytest.importorskip("pyarrow.parquet")
+    rows = QueryRows(db, text("SELECT * FROM ge ORDER BY ID"), batch_size=10)
+    path = temporary_export_path('.parquet')
+    assert write_export_file('parquet', path, rows.columns, rows.batches()) == 25
+    parquet_file = pq.ParquetFile(path)
+    assert parquet_file.metadata.num_row_groups == 3
+    assert parquet_file.read().column("PDV").to_pylist()[:2] == ["PDV1", "PDV2"]
+    os.remove(path)
+
+
+def test_write_parquet_widens_types_across_batches():
+    pq = pytest.importorskip("pyarrow.parquet")
+    from datetime import date
+    from decimal import Decimal
+    from esportazione import write_parquet
+    path = temporary_export_path('.parquet')
+    # Decimali che crescono di cifre e colonna tutta NULL nel primo blocco
+    batches = [[(Decimal('9.50'), None, None)], [(Decimal('1234.50'), 'a', date(2024, 1, 2))],
+               [(Decimal('1234567.25'), None, Decimal('1.5'))]]
+    assert write_parquet(path, ['Importo', 'Note', 'Altro'], batches) == 3
+    table = pq.read_table(path)
+    assert table.column('Importo').to_pylist() == [Decimal('9.50'), Decimal('1234.50'), Decimal('1234567.25')]
+    assert table.column('Note').to_pylist() == [None, 'a', None]
+    assert table.column('Altro').to_pylist() == [None, '2024-01-02', '1.5']
+    os.remove(path)
+
+    # Tipi dal cursore MySQL: DECIMAL(12,2) e DATETIME noti anche se il primo blocco è NULL
+    description = [('Importo', 246, None, 14, 14, 2, True), ('Data', 12, None, 19, 19, 0, True)]
+    write_parquet(path, ['Importo', 'Data'], [[(None, None)], [(Decimal('10.00'), datetime(2024, 1, 2))]],
+                  description=description)
+    schema = pq.read_schema(path)
+    assert str(schema.field('Importo').type) == 'decimal128(38, 2)'
+    assert str(schema.field('Data').type) == 'timestamp[us]'
+    os.remove(path)
+
+
+def test_write_parquet_without_rows_writes_empty_file():
+    pq = pytest.importorskip("pyarrow.parquet")
+    from esportazione import write_parquet
+    path = temporary_export_path('.parquet')
+    os.remove(path)
+    assert write_parquet(path, ['A'], iter([])) == 0
+    table = pq.read_table(path)
+    assert table.num_rows == 0 and table.column_names == ['A']
+    os.remove(path)
+
+
+def test_check_export_format():
+    assert check_export_format("CSV") == "csv"
+    with pytest.raises(ExportFormatError):
+        check_export_format("pdf")
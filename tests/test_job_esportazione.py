@@ -0,0 +1,115 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import pytest
+from job_esportazione import ExportJobManager, ExportJobLimitError, ExportSource
+
+
+class DummySession:
+    def close(self):
+        pass
+
+
+def _wait(job):
+    for _ in range(200):
+        if not job.active:
+            return
+        time.sleep(0.01)
+
+
+def test_export_job_writes_file_and_reports_progress(tmp_path):
+    manager = ExportJobManager(max_workers=1, directory=str(tmp_path), session_factory=DummySession)
+    batches = [[(1, "a"), (2, "b")], [(3, "c")]]
+    job = manager.submit("mario", "csv", "export", lambda db: ExportSource(["ID", "PDV"], iter(batches), 3))
+    _wait(job)
+    assert job.status == "done"
+    assert (job.rows_written, job.total_estimate) == (3, 3)
+    assert open(job.path).read().splitlines() == ["ID,PDV", "1,a", "2,b", "3,c"]
+
+    # Scaduto il TTL il job e il file vengono eliminati
+    manager.ttl = 0
+    job.finished_at -= 1
+    assert manager.get(job.id) is None
+    assert os.path.exists(job.path) # eliminato dallo sweeper, non dalla richiesta
+    manager.sweep()
+    assert not os.path.exists(job.path)
+
+
+def test_job_without_file_is_an_error(tmp_path, monkeypatch):
+    import job_esportazione
+    monkeypatch.setattr(job_esportazione, "write_export_file", lambda *args, **kwargs: 0)
+    manager = ExportJobManager(max_workers=1, directory=str(tmp_path), session_factory=DummySession)
+    job = manager.submit("mario", "parquet", "export", lambda db: ExportSource(["ID"], iter([])))
+    _wait(job)
+    assert job.status == "error" and job.to_dict()["download_url"] is None
+
+
+def test_export_job_per_user_limit(tmp_path):
+    manager = ExportJobManager(max_workers=1, max_per_user=1, directory=str(tmp_path), session_factory=DummySession)
+
+    def slow(db):
+        time.sleep(0.2)
+        return ExportSource(["ID"], iter([[(1,)]]))
+
+    job = manager.submit("mario", "csv", "export", slow)
+    with pytest.raises(ExportJobLimitError):
+        manager.submit("mario", "csv", "export", slow)
+    manager.submit("luigi", "csv", "export", slow)
+    _wait(job)
+    assert job.status == "done"
+
+
+def test_export_job_error_is_reported(tmp_path):
+    manager = ExportJobManager(max_workers=1, directory=str(tmp_path), session_factory=DummySession)
+    job = manager.submit("mario", "csv", "export", lambda db: 1 / 0)
+    _wait(job)
+    assert job.status == "error" and "division" in job.error
+
+
+def test_sweep_removes_orphan_files(tmp_path):
+    manager = ExportJobManager(max_workers=1, ttl=60, directory=str(tmp_path), session_factory=DummySession)
+    job = manager.submit("mario", "csv", "export", lambda db: ExportSource(["ID"], iter([[(1,)]])))
+    _wait(job)
+    old = time.time() - 120
+    orphan = tmp_path / "precedente.csv" # lasciato da un'esecuzione precedente
+    orphan.write_text("ID\n")
+    os.utime(orphan, (old, old))
+    os.utime(job.path, (old, old))
+    recent = tmp_path / "altro_processo.csv"
+    recent.write_text("ID\n")
+
+    assert manager.sweep() == 1
+    assert not orphan.exists() and recent.exists() and os.path.exists(job.path)
+
+
+def test_export_job_routes_require_owner_session(tmp_path, monkeypatch):
+    import json
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    import job_esportazione
+
+    manager = ExportJobManager(max_workers=1, directory=str(tmp_path), session_factory=DummySession)
+    monkeypatch.setattr(job_esportazione, "export_jobs", manager)
+    job = manager.submit("mario", "csv", "export", lambda db: ExportSource(["ID"], iter([[(1,)]])))
+    _wait(job)
+    app = FastAPI()
+    app.include_router(job_esportazione.router)
+    client = TestClient(app)
+
+    assert client.get(f"/api/exports/{job.id}").status_code == 401
+    assert client.get(f"/api/exports/{job.id}", cookies={"session": "mario"}).status_code == 401
+    other = json.dumps({"login": "luigi", "ruolo_id": 3})
+    assert client.get(f"/api/exports/{job.id}/download", cookies={"session": other}).status_code == 404
+    owner = json.dumps({"login": "mario", "ruolo_id": 3})
+    assert client.get(f"/api/exports/{job.id}", cookies={"session": owner}).json()["status"] == "done"
+    assert client.get(f"/api/exports/{job.id}/download", cookies={"session": owner}).text.splitlines() == ["ID", "1"]
+
+
+def test_parquet_job_without_rows_can_be_downloaded(tmp_path):
+    pytest.importorskip("pyarrow")
+    manager = ExportJobManager(max_workers=1, directory=str(tmp_path), session_factory=DummySession)
+    job = manager.submit("mario", "parquet", "export", lambda db: ExportSource(["ID"], iter([]), 0))
+    _wait(job)
+    assert job.status == "done" and os.path.exists(job.path)
@@ -0,0 +1,59 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, exc, text
+
+from database_config import MonitoredQueuePool, pool_metrics, pool_status
+from metriche import router
+
+
+@pytest.fixture
+def pooled_engine():
+    pool_metrics.reset()
+    engine = create_engine("sqlite://", poolclass=MonitoredQueuePool, pool_size=1, max_overflow=0,
+                           pool_timeout=0.05, connect_args={"check_same_thread": False})
+    yield engine
+    engine.dispose()
+    pool_metrics.reset()
+
+
+def test_pool_metrics_track_checkouts_and_timeouts(pooled_engine):
+    with pooled_engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+        status = pool_status(pooled_engine.pool)
+        assert status["checked_out"] == 1
+        # Pool esaurito: la seconda richiesta va in timeout e viene contata
+        with pytest.raises(exc.TimeoutError):
+            pooled_engine.connect()
+    status = pool_status(pooled_engine.pool)
+    assert status["checked_out"] == 0
+    assert status["checkouts"] == 1
+    assert status["timeouts"] == 1
+    assert status["wait_max_ms"] >= 0
+
+
+def test_metrics_endpoint_requires_admin():
+    app = FastAPI()
+    app.include_router(router)
+    client = TestClient(app)
+    assert client.get("/internal/metrics/db").status_code == 403
+    response = client.get("/internal/metrics/db", cookies={"session": json.dumps({"login": "admin", "ruolo_id": 1})})
+    assert response.status_code == 200
+    body = response.json()
+    assert "pool" in body and "threadpool" in body
+
+
+def test_localhost_needs_explicit_flag(monkeypatch):
+    import metriche
+    from fastapi import HTTPException, Request
+    # Dietro un reverse proxy sulla stessa macchina ogni richiesta arriva da localhost
+    request = Request({"type": "http", "client": ("127.0.0.1", 50000), "headers": []})
+    with pytest.raises(HTTPException):
+        metriche.require_internal_access(request)
+    monkeypatch.setattr(metriche, "INTERNAL_ALLOW_LOCALHOST", True)
+    metriche.require_internal_access(request)
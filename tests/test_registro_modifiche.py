@@ -0,0 +1,151 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from models.carrefour_log import CarrefourLog
+from registro_modifiche import AuditJournal, AuditLogWriter
+
+
+@pytest.fixture
+def Session():
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    CarrefourLog.__table__.create(bind=engine)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+def _entry(pk):
+    return {"utente": "mario", "campo_old": "a", "campo_new": "b", "data": datetime(2025, 1, 2, 3, 4, 5),
+            "id_tabella": pk, "colonna": "PDV"}
+
+
+def _logged(Session):
+    with Session() as db:
+        return db.execute(text("SELECT id_tabella, data FROM carrefour_log ORDER BY id_tabella")).fetchall()
+
+
+def test_journal_mode_writes_after_commit_and_flushes_in_bulk(Session, tmp_path):
+    journal = AuditJournal(path=str(tmp_path / "log.jsonl"), batch_size=2, session_factory=Session)
+    writer = AuditLogWriter(mode="journal", journal=journal)
+
+    with Session() as db:
+        writer.record(db, [_entry(1), _entry(2)])
+        db.commit()
+        writer.record(db, [_entry(3)])
+        db.rollback() # transazione annullata: nessuna riga nel journal
+        writer.record(db, [_entry(4)])
+        db.commit()
+
+    assert journal.pending_count() == 3
+    assert _logged(Session) == []
+
+    assert journal.flush() == 3
+    assert journal.pending_count() == 0
+    rows = _logged(Session)
+    assert [r[0] for r in rows] == [1, 2, 4]
+    assert str(rows[0][1]).startswith("2025-01-02 03:04:05")
+
+
+def test_start_replays_leftover_journal(Session, tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    AuditJournal(path=path, session_factory=Session).append([_entry(7)])
+    os.replace(path, f"{path}.1.flushing") # flush interrotto dall'esecuzione precedente
+    AuditJournal(path=path, session_factory=Session).append([_entry(8)])
+
+    writer = AuditLogWriter(mode="journal", journal=AuditJournal(path=path, session_factory=Session))
+    writer.start()
+    writer.stop()
+    assert [r[0] for r in _logged(Session)] == [7, 8]
+
+
+def test_sync_mode_inserts_in_transaction(Session):
+    writer = AuditLogWriter(mode="sync")
+    with Session() as db:
+        writer.record(db, [_entry(5)])
+        db.rollback()
+        writer.record(db, [_entry(6)])
+        db.commit()
+    assert [r[0] for r in _logged(Session)] == [6]
+
+
+def test_journal_written_before_commit_and_discarded_on_failure(Session, tmp_path):
+    journal = AuditJournal(path=str(tmp_path / "log.jsonl"), session_factory=Session)
+    writer = AuditLogWriter(mode="journal", journal=journal)
+    with Session() as db:
+        db.add(CarrefourLog(id=1, utente="x"))
+        db.commit()
+        db.add(CarrefourLog(id=1, utente="y")) # chiave duplicata: il commit fallisce dopo before_commit
+        writer.record(db, [_entry(9)])
+        with pytest.raises(Exception):
+            db.commit()
+        db.rollback()
+        writer.record(db, [_entry(10)])
+        db.commit()
+    assert journal.flush() == 1
+    assert [r[0] for r in _logged(Session)] == [None, 10]
+
+
+def test_flush_during_commit_waits_for_outcome(Session, tmp_path):
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session as OrmSession
+    journal = AuditJournal(path=str(tmp_path / "log.jsonl"), session_factory=Session)
+    writer = AuditLogWriter(mode="journal", journal=journal)
+    flushed = []
+
+    def flush_before_commit(session):
+        # Il thread di flush gira tra l'accodamento nel journal e l'esito del commit
+        if session.info.get("audit_log_journaled"):
+            flushed.append(journal.flush())
+
+    event.listen(OrmSession, "before_commit", flush_before_commit)
+    try:
+        with Session() as db:
+            db.add(CarrefourLog(id=1, utente="x"))
+            db.commit()
+            db.add(CarrefourLog(id=1, utente="y")) # chiave duplicata: il commit fallisce dopo il flush
+            writer.record(db, [_entry(9)])
+            with pytest.raises(Exception):
+                db.commit()
+            db.rollback()
+            writer.record(db, [_entry(10)])
+            db.commit()
+    finally:
+        event.remove(OrmSession, "before_commit", flush_before_commit)
+    assert flushed == [0, 0]
+    assert journal.pending_count() == 1 # la riga 9 è già stata scartata, la 10 attendeva il commit
+    assert journal.flush() == 1
+    assert journal.pending_count() == 0
+    assert [r[0] for r in _logged(Session)] == [None, 10]
+
+
+def test_start_inserts_entries_without_outcome(Session, tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    journal = AuditJournal(path=path, session_factory=Session)
+    journal.append([_entry(5)], tx="interrotta") # processo fermato durante il commit
+    assert journal.flush() == 0
+    writer = AuditLogWriter(mode="journal", journal=AuditJournal(path=path, session_factory=Session))
+    writer.start()
+    writer.stop()
+    assert [r[0] for r in _logged(Session)] == [5]
+
+
+def test_torn_line_does_not_block_flush(Session, tmp_path):
+    path = str(tmp_path / "log.jsonl")
+    journal = AuditJournal(path=path, session_factory=Session)
+    journal.append([_entry(1)])
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"utente": "mar') # ultima riga troncata da un crash
+    os.replace(path, f"{path}.1.flushing")
+    journal.append([_entry(2)])
+
+    assert journal.flush() == 2
+    assert journal.flush() == 0
+    assert [r[0] for r in _logged(Session)] == [1, 2]
+    with open(f"{path}.corrupt", encoding="utf-8") as f:
+        assert f.read() == '{"utente": "mar\n'
@@ -0,0 +1,143 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from replica_colonnare import ColumnarReplica
+
+ROWS = [
+    (1, 'nord ', 'APERTO', 10, '2024-03-01 09:00:00', 'GENNAIO', 'Milano_1'),
+    (2, 'NORD', 'CHIUSO', 250, '2024-03-01 18:30:00', 'GENNAIO', 'MILANO 2'),
+    (3, 'SUD', 'aperto', 99.5, '2024-03-02 10:00:00', 'FEBBRAIO', 'Roma'),
+    (4, None, 'APERTO', 500, '2024-04-10 08:00:00', 'gennaio ', 'Milano%'),
+    (5, 'CENTRO', '', None, None, 'FEBBRAIO', 'Torino'),
+    (6, 'SUD', 'CHIUSO', 70, '2024-03-15 12:00:00', 'MARZO', 'Napoli'),
+]
+
+
+@pytest.fixture
+def ge_db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ge_replica (ID INTEGER PRIMARY KEY, RTC VARCHAR(20), STATO VARCHAR(20), "
+                          "IMPORTO NUMERIC(10, 2), DATA_ORDINE DATETIME, MesePresentazione VARCHAR(20), "
+                          "PDV VARCHAR(20))"))
+        conn.execute(text("CREATE TABLE carrefour_log (id INTEGER PRIMARY KEY, id_tabella INTEGER, data DATETIME)"))
+        for row in ROWS:
+            conn.execute(text("INSERT INTO ge_replica VALUES (:id, :rtc, :stato, :importo, :data, :mese, :pdv)"),
+                         dict(zip(("id", "rtc", "stato", "importo", "data", "mese", "pdv"), row)))
+        conn.execute(text("INSERT INTO carrefour_log (id_tabella, data) VALUES (1, '2024-01-01 00:00:00')"))
+    factory = sessionmaker(bind=engine)
+    session = factory()
+    yield session, factory
+    session.close()
+    engine.dispose()
+
+
+def _params(order=(), search='', month='', **filters):
+    columns = ['ID', 'RTC', 'STATO', 'IMPORTO', 'DATA_ORDINE', 'MesePresentazione', 'PDV']
+    return {
+        "draw": 2, "start": 0, "length": -1, "search": {"value": search}, "month_filter": month,
+        "order": [{"column": columns.index(col), "dir": dir} for col, dir in order],
+        "columns": [{"search": filters.get(col, {"value": ""})} for col in columns],
+    }
+
+
+def test_replica_matches_sql_path(ge_db):
+    from cache import invalidate_table_metadata
+    from ordini_servizi_ge import DataManager, page_cache
+    db, factory = ge_db
+    invalidate_table_metadata()
+    page_cache.invalidate()
+    replica = ColumnarReplica('ge_replica', session_factory=factory, enabled=True, category_max=3)
+    replica.refresh()
+    assert replica.ready and replica.serves(db.get_bind())
+    assert replica.stats()["categorical_columns"] >= 1 # MesePresentazione, STATO
+
+    cases = [
+        _params(),
+        _params(month='gennaio'),
+        _params(search='milano'),
+        _params(order=[('PDV', 'asc')]),
+        _params(order=[('IMPORTO', 'desc'), ('ID', 'asc')]),
+        _params(order=[('DATA_ORDINE', 'asc')], STATO={'value': '^aperto$', 'regex': True}),
+        _params(RTC={'value': '^nor', 'regex': True}),
+        _params(PDV={'value': 'o_'}),
+        _params(IMPORTO={'value': '50..300'}, order=[('IMPORTO', 'asc')]),
+        _params(DATA_ORDINE={'value': '2024-03-01'}),
+        _params(DATA_ORDINE={'value': '>=01/03/2024'}, month='febbraio'),
+        _params(STATO={'value': 'x'}),
+    ]
+    for params in cases:
+        expected = DataManager(db, 'ge_replica').get_filtered_data(params)
+        actual = DataManager(db, 'ge_replica', replica=replica).get_filtered_data(params)
+        assert [row['ID'] for row in actual['data']] == [row['ID'] for row in expected['data']], params
+        assert actual['recordsFiltered'] == expected['recordsFiltered']
+        assert actual['recordsTotal'] == expected['recordsTotal'] == len(ROWS)
+    assert replica.reads == len(cases)
+
+    page = DataManager(db, 'ge_replica', ['ID', 'PDV'], replica=replica).get_filtered_data(
+        {**_params(order=[('ID', 'desc')]), "start": 1, "length": 2})
+    assert page['data'] == [{'ID': 5, 'PDV': 'Torino'}, {'ID': 4, 'PDV': 'Milano%'}]
+
+
+def test_replica_follows_updates(ge_db):
+    db, factory = ge_db
+    replica = ColumnarReplica('ge_replica', session_factory=factory, enabled=True, category_max=3)
+    replica.refresh()
+    from ordini_servizi_ge import FilterManager
+
+    def ids(month='', **filters):
+        return [row['ID'] for row in replica.page(FilterManager(db, 'ge_replica'), 1, 0, -1, [], month, None,
+                                                  filters)['data']]
+
+    replica.apply_update('3', 'MesePresentazione', 'Marzo') # PK in forma di testo, nuova categoria
+    assert ids(month='marzo') == [3, 6]
+    assert replica.full_loads == 1
+
+    # Modifica fatta da un altro processo: letta dal log delle modifiche al refresh successivo
+    db.execute(text("UPDATE ge_replica SET RTC = 'ISOLE' WHERE ID = 5"))
+    db.execute(text("INSERT INTO carrefour_log (id_tabella, data) VALUES (5, '2024-01-02 00:00:00')"))
+    db.commit()
+    replica.refresh()
+    assert ids(RTC={'value': 'isole'}) == [5] and replica.delta_rows >= 1
+
+    # Log scritto in ritardo dal journal, con la data originale precedente all'ultimo controllo
+    db.execute(text("UPDATE ge_replica SET RTC = 'EST' WHERE ID = 6"))
+    db.execute(text("INSERT INTO carrefour_log (id_tabella, data) VALUES (6, '2023-12-31 00:00:00')"))
+    db.commit()
+    replica.refresh()
+    assert ids(RTC={'value': 'est'}) == [6]
+
+    # Riga inserita fuori dalla griglia: ricarica completa
+    db.execute(text("INSERT INTO ge_replica (ID, RTC) VALUES (7, 'ISOLE')"))
+    db.commit()
+    replica.refresh()
+    assert ids(RTC={'value': 'isole'}) == [5, 7] and replica.full_loads == 2
+
+
+def test_replica_reads_immutable_snapshots(ge_db):
+    db, factory = ge_db
+    from ordini_servizi_ge import FilterManager
+    replica = ColumnarReplica('ge_replica', session_factory=factory, enabled=True, category_max=3)
+    replica.refresh()
+    filter_manager = FilterManager(db, 'ge_replica')
+    before = replica.data
+    assert 'CENTRO' in before.global_search_text(filter_manager.column_names)[4]
+
+    # Una lettura in corso tiene la sua istantanea: le modifiche ne pubblicano una nuova
+    replica.apply_update(5, 'RTC', 'Isole')
+    replica.apply_update(3, 'STATO', 'Sospeso') # nuova categoria
+    after = replica.data
+    assert after is not before
+    assert before.raw['RTC'][4] == 'CENTRO' and before.norm['STATO'][2] == 'APERTO'
+    assert after.raw['RTC'][4] == 'Isole' and after.norm['STATO'][2] == 'SOSPESO'
+    assert 'ISOLE' in after.global_search_text(filter_manager.column_names)[4]
+    assert 'CENTRO' in before.global_search_text(filter_manager.column_names)[4]
+    assert after.raw['PDV'] is before.raw['PDV'] # colonne non modificate condivise
+    page = replica.page(filter_manager, 1, 0, -1, [('RTC', 'asc')], '', 'isole', {})
+    assert [row['ID'] for row in page['data']] == [5]
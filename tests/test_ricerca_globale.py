@@ -0,0 +1,101 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from ordini_servizi_ge import DataManager
+from ricerca_globale import GlobalSearchIndex
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ge (ID INTEGER PRIMARY KEY, PDV VARCHAR(20), RTC VARCHAR(20))"))
+        conn.execute(text("INSERT INTO ge VALUES (1, 'Torino Centro', 'ROSSI'), (2, 'Milano Nord', 'BIANCHI'), (3, 'Torino Sud', 'VERDI')"))
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def _params(search):
+    return {"draw": 1, "start": 0, "length": 10, "search": {"value": search}, "order": [{"column": 0, "dir": "asc"}]}
+
+
+def test_search_falls_back_to_like_without_index(db):
+    result = DataManager(db, "ge").get_filtered_data(_params("orin"))
+    assert [row["ID"] for row in result["data"]] == [1, 3]
+
+
+def test_search_uses_fulltext_index(db):
+    index = GlobalSearchIndex(db, "ge")
+    index.rebuild(["ID", "PDV", "RTC"])
+    where_sql, params = DataManager(db, "ge").filter_manager.build_where_clause(search_value="torino ver")
+    assert "MATCH" in where_sql and "LIKE" not in where_sql
+    result = DataManager(db, "ge").get_filtered_data(_params("torino ver"))
+    assert [row["ID"] for row in result["data"]] == [3]
+
+    db.execute(text("UPDATE ge SET PDV = 'Genova' WHERE ID = 3"))
+    index.refresh_rows([3], ["ID", "PDV", "RTC"])
+    result = DataManager(db, "ge").get_filtered_data(_params("torino"))
+    assert [row["ID"] for row in result["data"]] == [1]
+
+
+def test_stale_index_falls_back_to_like(db):
+    import ricerca_globale
+    index = GlobalSearchIndex(db, "ge")
+    index.rebuild(["ID", "PDV", "RTC"])
+    # Riga inserita fuori dalla griglia: l'indice non la conosce
+    db.execute(text("INSERT INTO ge VALUES (4, 'Torino Ovest', 'NERI')"))
+    ricerca_globale._sync_cache.invalidate()
+    where_sql, _ = DataManager(db, "ge").filter_manager.build_where_clause(search_value="torino")
+    assert "MATCH" not in where_sql and "LIKE" in where_sql
+    result = DataManager(db, "ge").get_filtered_data(_params("torino"))
+    assert [row["ID"] for row in result["data"]] == [1, 3, 4]
+
+    index.rebuild(["ID", "PDV", "RTC"])
+    where_sql, _ = DataManager(db, "ge").filter_manager.build_where_clause(search_value="torino")
+    assert "MATCH" in where_sql
+
+
+def test_logged_update_outside_grid_is_reindexed(tmp_path):
+    import ricerca_globale
+    # Database su file: il riallineamento usa una connessione propria
+    engine = create_engine(f"sqlite:///{tmp_path / 'ge.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ge (ID INTEGER PRIMARY KEY, PDV VARCHAR(20), RTC VARCHAR(20))"))
+        conn.execute(text("INSERT INTO ge VALUES (1, 'Torino Centro', 'ROSSI'), (2, 'Milano Nord', 'BIANCHI')"))
+        conn.execute(text("CREATE TABLE carrefour_log (id INTEGER PRIMARY KEY, id_tabella INT, colonna TEXT)"))
+        conn.execute(text("INSERT INTO carrefour_log VALUES (1, 1, 'PDV')"))
+    db = sessionmaker(bind=engine)()
+    try:
+        index = GlobalSearchIndex(db, "ge")
+        index.rebuild(["ID", "PDV", "RTC"])
+        db.commit()
+        # Modifica fatta da un altro processo: stesse righe e stesso ID massimo, ma registrata nel log
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE ge SET PDV = 'Genova Porto' WHERE ID = 2"))
+            conn.execute(text("INSERT INTO carrefour_log VALUES (2, 2, 'PDV')"))
+        ricerca_globale._sync_cache.invalidate()
+        where_sql, _ = DataManager(db, "ge").filter_manager.build_where_clause(search_value="genova")
+        assert "MATCH" in where_sql
+        result = DataManager(db, "ge").get_filtered_data(_params("genova"))
+        assert [row["ID"] for row in result["data"]] == [2]
+        assert db.execute(text("SELECT log_id FROM ge_ricerca_stato")).scalar() == 2
+    finally:
+        db.close()
+        engine.dispose()
+
+
+def test_index_without_log_mark_falls_back_to_like(db):
+    import ricerca_globale
+    index = GlobalSearchIndex(db, "ge")
+    index.rebuild(["ID", "PDV", "RTC"])
+    # Indice creato prima del punto di allineamento al log
+    db.execute(text("CREATE TABLE carrefour_log (id INTEGER PRIMARY KEY, id_tabella INT)"))
+    db.execute(text("DROP TABLE ge_ricerca_stato"))
+    ricerca_globale._sync_cache.invalidate()
+    assert not index.is_available() and index.exists()
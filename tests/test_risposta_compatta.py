@@ -0,0 +1,48 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from risposta_compatta import CompactJSONResponse, columnar_response, to_columnar
+
+
+RESULT = {
+    "draw": 3, "recordsTotal": 10, "recordsFiltered": 2, "cursor": {"key": "k", "start": 0},
+    "data": [
+        {"ID": 1, "IMPORTO": Decimal("10.50"), "QTA": Decimal("3"), "DATA": datetime(2024, 3, 1, 9, 30), "PDV": "P1"},
+        {"ID": 2, "IMPORTO": None, "QTA": Decimal("0"), "DATA": date(2024, 3, 2), "PDV": "P2"},
+    ],
+}
+
+
+def test_columnar_payload_matches_default_encoding():
+    body = json.loads(CompactJSONResponse(to_columnar(RESULT)).body)
+    assert body["columns"] == ["ID", "IMPORTO", "QTA", "DATA", "PDV"]
+    assert "data" not in body and body["cursor"] == RESULT["cursor"] and body["draw"] == 3
+    # Stessi valori che produrrebbe la risposta classica, ricostruendo gli oggetti riga
+    expected = jsonable_encoder(RESULT["data"])
+    assert [dict(zip(body["columns"], row)) for row in body["rows"]] == expected
+
+    empty = json.loads(CompactJSONResponse(to_columnar({**RESULT, "data": []})).body)
+    assert empty["columns"] == [] and empty["rows"] == []
+
+
+def test_columnar_is_smaller_than_list_of_objects():
+    result = {**RESULT, "data": [{f"COLONNA_{i}": i for i in range(40)} for _ in range(100)]}
+    compact = columnar_response(result).body
+    classic = json.dumps(jsonable_encoder(result)).encode()
+    assert len(compact) < len(classic) / 3
+
+
+def test_msgpack_when_requested():
+    msgpack = pytest.importorskip("msgpack")
+    response = columnar_response(RESULT, accept="application/x-msgpack")
+    assert response.media_type == "application/x-msgpack"
+    body = msgpack.unpackb(response.body)
+    assert body["rows"][0][:3] == [1, 10.5, 3]
@@ -0,0 +1,78 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+
+from statistiche_sql import SQLStatsMiddleware, SQLStatsRecorder, instrument_engine, parameter_shape
+
+
+@pytest.fixture
+def instrumented(tmp_path):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    recorder = SQLStatsRecorder(slow_ms=1e9, slow_log=str(tmp_path / "slow.jsonl"), keep=10, enabled=True)
+    instrument_engine(engine, recorder)
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE ge (ID INTEGER PRIMARY KEY, PDV VARCHAR(20))"))
+        conn.execute(text("INSERT INTO ge VALUES (:id, :pdv)"), [{"id": i, "pdv": f"P{i}"} for i in range(1, 6)])
+    recorder.reset()
+
+    app = FastAPI()
+    app.add_middleware(SQLStatsMiddleware, recorder=recorder)
+
+    @app.get("/righe/{pdv}")
+    def righe(pdv: str):
+        with engine.connect() as conn:
+            total = conn.execute(text("SELECT COUNT(*) FROM ge")).scalar()
+            rows = conn.execute(text("SELECT ID FROM ge WHERE PDV >= :pdv"), {"pdv": pdv}).fetchall()
+        return {"total": total, "rows": len(rows)}
+
+    yield engine, recorder, TestClient(app)
+    engine.dispose()
+
+
+def test_queries_are_attributed_to_the_route(instrumented):
+    engine, recorder, client = instrumented
+    client.cookies.set("session", json.dumps({"login": "mrossi"}))
+    assert client.get("/righe/P2").json() == {"total": 5, "rows": 4}
+    assert client.get("/righe/P4").status_code == 200
+    with engine.connect() as conn: # Fuori da una richiesta HTTP
+        conn.execute(text("SELECT 1"))
+
+    routes = {route["route"]: route for route in recorder.snapshot()}
+    route = routes["GET /righe/{pdv}"]
+    assert route["requests"] == 2 and route["queries"] == 4 and route["queries_max"] == 2
+    assert route["errors"] == 0 and route["slow"] == 0 and route["db_ms"] > 0
+    assert routes["(fuori richiesta)"]["queries"] == 1 and routes["(fuori richiesta)"]["requests"] == 0
+    assert recorder.slow_queries() == []
+
+
+def test_slow_queries_are_logged_with_plan(instrumented, caplog):
+    engine, recorder, client = instrumented
+    recorder.slow_ms = 0 # Ogni query è "lenta"
+    client.cookies.set("session", json.dumps({"login": "mrossi"}))
+    with caplog.at_level("WARNING", logger="statistiche_sql"):
+        client.get("/righe/P3")
+    assert [r.levelname for r in caplog.records] == ["WARNING", "WARNING"]
+
+    slow = recorder.slow_queries()
+    assert len(slow) == 2
+    entry = slow[0] # Più recente per prima
+    assert entry["route"] == "GET /righe/{pdv}" and entry["user"] == "mrossi"
+    assert entry["statement"] == "SELECT ID FROM ge WHERE PDV >= ?" and entry["params"] == ["str"]
+    assert entry["explain"] and "detail" in entry["explain"][0] # EXPLAIN QUERY PLAN di SQLite
+    with open(recorder.slow_log, encoding="utf-8") as f:
+        assert len(f.readlines()) == 2
+    assert {route["route"]: route for route in recorder.snapshot()}["GET /righe/{pdv}"]["slow"] == 2
+
+
+def test_parameter_shape_has_no_values():
+    assert parameter_shape({"pdv": "P1", "ids": [1, 2, 3], "n": None}) == \
+        {"pdv": "str", "ids": ["int", "int", "int"], "n": "NoneType"}
+    assert parameter_shape([{"id": 1, "pdv": "x"}, {"id": 2, "pdv": "y"}]) == {"items": 2, "shape": {"id": "int", "pdv": "str"}}
@@ -0,0 +1,113 @@
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+from datetime import datetime, timedelta
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, insert, inspect, text
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from database_config import get_db
+from models.carrefour_log import CarrefourLog
+from models.utente import UtenteRuoliPermessi
+from storico_modifiche import create_history_indexes, router
+
+SESSION = {"session": json.dumps({"login": "auditor", "ruolo_id": 1})}
+
+
+@pytest.fixture
+def client():
+    engine = create_engine("sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False})
+    CarrefourLog.__table__.create(bind=engine)
+    UtenteRuoliPermessi.__table__.create(bind=engine)
+    start = datetime(2025, 3, 1, 8, 0, 0)
+    with engine.begin() as conn:
+        conn.execute(insert(CarrefourLog), [
+            {"utente": "mario" if i % 2 else "anna", "campo_old": str(i), "campo_new": str(i + 1),
+             # Due righe con la stessa data: il cursore deve usare anche l'id
+             "data": start + timedelta(hours=i // 2), "id_tabella": 1 if i < 6 else 2, "colonna": "PDV"}
+            for i in range(10)
+        ])
+        conn.execute(insert(UtenteRuoliPermessi), [{"ruolo_id": 3, "colonne_ordini_servizio_ge": "IMPORTO"}])
+    from ordini_servizi_ge import invalidate_role_permissions
+    invalidate_role_permissions()
+    Session = sessionmaker(bind=engine)
+
+    def override_get_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[get_db] = override_get_db
+    yield TestClient(app), engine
+    engine.dispose()
+    invalidate_role_permissions()
+
+
+def test_history_keyset_pages_follow_index_order(client):
+    cl, engine = client
+    ids, cursor = [], None
+    while True:
+        params = {"id_tabella": 1, "limit": 4, **({"cursor": cursor} if cursor else {})}
+        page = cl.get("/api/servizi/ge/history", params=params, cookies=SESSION).json()
+        ids += [row["id"] for row in page["data"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert ids == [6, 5, 4, 3, 2, 1]
+
+    page = cl.get("/api/servizi/ge/history", params={"utente": "anna", "date_from": "2025-03-01T10:00:00",
+                                                     "date_to": "2025-03-01"}, cookies=SESSION).json()
+    assert [row["id"] for row in page["data"]] == [9, 7, 5]
+    assert cl.get("/api/servizi/ge/history").status_code == 401
+
+    # Gli indici dichiarati sul modello esistono già (create_all): nessuno da creare
+    assert create_history_indexes(engine) == []
+    assert {"ix_carrefour_log_record", "ix_carrefour_log_data"} <= {i["name"] for i in inspect(engine).get_indexes("carrefour_log")}
+
+
+def test_history_export_streams_csv(client):
+    cl, _ = client
+    response = cl.get("/api/servizi/ge/history/export", params={"colonna": "PDV", "id_tabella": 2}, cookies=SESSION)
+    assert response.status_code == 200
+    lines = response.text.strip().splitlines()
+    assert lines[0] == "id,data,utente,id_tabella,colonna,campo_old,campo_new"
+    assert [line.split(",")[0] for line in lines[1:]] == ["10", "9", "8", "7"]
+
+
+def test_history_requires_role_and_hides_columns(client):
+    cl, engine = client
+    with engine.begin() as conn:
+        conn.execute(insert(CarrefourLog), [
+            {"utente": "anna", "campo_old": "100", "campo_new": "200", "data": datetime(2025, 3, 2),
+             "id_tabella": 1, "colonna": "IMPORTO"},
+            # Riga senza data: esclusa, altrimenti il cursore successivo non sarebbe valido
+            {"utente": "anna", "campo_old": "x", "campo_new": "y", "data": None, "id_tabella": 1, "colonna": "PDV"},
+        ])
+    assert cl.get("/api/servizi/ge/history", cookies={"session": "qualsiasi"}).status_code == 401
+    assert cl.get("/api/servizi/ge/history/export", cookies={"session": json.dumps({"login": "x"})}).status_code == 401
+
+    role_3 = {"session": json.dumps({"login": "operatore", "ruolo_id": 3})}
+    ids, cursor = [], None
+    while True:
+        params = {"id_tabella": 1, "limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = cl.get("/api/servizi/ge/history", params=params, cookies=role_3)
+        assert response.status_code == 200
+        ids += [row["id"] for row in response.json()["data"]]
+        cursor = response.json()["next_cursor"]
+        if not cursor:
+            break
+    assert ids == [6, 5, 4, 3, 2, 1] # Né la modifica a IMPORTO (nascosta al ruolo 3) né la riga senza data
+
+    lines = cl.get("/api/servizi/ge/history/export", params={"id_tabella": 1}, cookies=role_3).text.strip().splitlines()
+    assert len(lines) == 7 and not any("IMPORTO" in line for line in lines)
+    page = cl.get("/api/servizi/ge/history", params={"id_tabella": 1}, cookies=SESSION).json()
+    assert page["data"][0]["colonna"] == "IMPORTO"